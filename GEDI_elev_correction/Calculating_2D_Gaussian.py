@@ -1,77 +1,203 @@
 import numpy as np
 import pandas as pd
 import os
-from scipy.optimize import curve_fit
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import least_squares
+from GEDI_elev_correction.accumulators import GridAccumulator
+from GEDI_elev_correction import results_store, intermediate, results_index, metrics, bootstrap
 
 
 def gaussian_2d(data, x0, y0, sigma_x, sigma_y, A):
     x, y = data
     return A * (5 - np.exp(-(((x - x0) ** 2) / (2 * sigma_x ** 2) + ((y - y0) ** 2) / (2 * sigma_y ** 2))))
 
-def fit_2d_inverted_gaussian(mean_elev_diff, init_center_x, init_center_y):
+def gaussian_2d_jacobian(data, x0, y0, sigma_x, sigma_y, A):
+    """Analytic partial derivatives of gaussian_2d, one column per parameter"""
+    x, y = data
+    dx, dy = x - x0, y - y0
+    E = np.exp(-((dx ** 2) / (2 * sigma_x ** 2) + (dy ** 2) / (2 * sigma_y ** 2)))
+    AE = A * E
+    return np.column_stack((-AE * dx / sigma_x ** 2,
+                            -AE * dy / sigma_y ** 2,
+                            -AE * dx ** 2 / sigma_x ** 3,
+                            -AE * dy ** 2 / sigma_y ** 3,
+                            5 - E))
+
+@lru_cache(maxsize=8)
+def fit_grid(shape):
+    """Coordinate grids of a mean_elev_diff of the given shape, built once and reused by every fit"""
+    x = np.linspace(-35, 35, shape[0])
+    y = np.linspace(-35, 35, shape[1])
+    X, Y = np.meshgrid(x, y)
+    xdata = np.vstack((X.ravel(), Y.ravel()))
+    return X, Y, xdata
+
+FIT_BOUNDS = ([-35, -35, 1e-6, 1e-6, 0], [35, 35, np.inf, np.inf, np.inf])
+
+def fit_2d_inverted_gaussian_details(mean_elev_diff, init_center_x, init_center_y, initial_params=None,
+                                     bounds=FIT_BOUNDS):
+    """Bounded least-squares fit of gaussian_2d with an analytic Jacobian
+
+    Same trust-region solver, bounds, tolerances and evaluation budget as curve_fit used before. Returns a
+    dict with the fitted parameters, fitted_data, bias, minRMSE and the solver's nfev, njev, status and
+    success; on failure the fitted values are None and success is False.
+    """
+    result = {'x0': None, 'y0': None, 'sigma_x': None, 'sigma_y': None, 'A': None, 'fitted_data': None,
+              'bias': None, 'minRMSE': None, 'nfev': 0, 'njev': 0, 'status': None, 'success': False}
     try:
-        x = np.linspace(-35, 35, mean_elev_diff.shape[0])
-        y = np.linspace(-35, 35, mean_elev_diff.shape[1])
-        X, Y = np.meshgrid(x, y)
-        xdata = np.vstack((X.ravel(), Y.ravel()))
+        X, Y, xdata = fit_grid(mean_elev_diff.shape)
         zdata = mean_elev_diff.ravel()
 
-        initial_guess = (init_center_x, init_center_y, 5.5, 5.5, np.max(mean_elev_diff))
-        bounds = ([-35, -35, 1e-6, 1e-6, 0], [35, 35, np.inf, np.inf, np.inf])
-
-        popt, _ = curve_fit(gaussian_2d, xdata, zdata, p0=initial_guess, bounds=bounds, maxfev=5000)
+        initial_guess = initial_params if initial_params is not None else \
+            (init_center_x, init_center_y, 5.5, 5.5, np.max(mean_elev_diff))
+        solution = least_squares(lambda p: gaussian_2d(xdata, *p) - zdata, initial_guess,
+                                 jac=lambda p: gaussian_2d_jacobian(xdata, *p), bounds=bounds,
+                                 method='trf', max_nfev=5000)
+        result.update(nfev=solution.nfev, njev=solution.njev, status=solution.status, success=solution.success)
+        if not solution.success:
+            raise RuntimeError(f"Optimal parameters not found: {solution.message}")
 
+        popt = solution.x
         x0, y0, sigma_x, sigma_y, A = popt
         fitted_data = gaussian_2d((X, Y), *popt).reshape(mean_elev_diff.shape)
         bias = gaussian_2d((np.array([x0]), np.array([y0])), *popt)[0]
         # 计算 RMSE
         residuals = mean_elev_diff - fitted_data
         minRMSE = np.sqrt(np.mean(residuals ** 2))
-        return x0, y0, sigma_x, sigma_y, fitted_data, bias, minRMSE
+        result.update(x0=x0, y0=y0, sigma_x=sigma_x, sigma_y=sigma_y, A=A, fitted_data=fitted_data, bias=bias,
+                      minRMSE=minRMSE)
+        return result
     except Exception as e:
         print(f"Error in Gaussian fit: {e}")
-        return None, None, None, None, None, None, None
+        return result
+
+def fit_2d_inverted_gaussian(mean_elev_diff, init_center_x, init_center_y):
+    fit = fit_2d_inverted_gaussian_details(mean_elev_diff, init_center_x, init_center_y)
+    return fit['x0'], fit['y0'], fit['sigma_x'], fit['sigma_y'], fit['fitted_data'], fit['bias'], fit['minRMSE']
+
+def _fit_job(job):
+    from GEDI_elev_correction import estimators
+    return estimators.estimate(*job)
+
+def fit_2d_inverted_gaussian_batch(mean_elev_diffs, init_centers, initial_params=None, max_workers=None,
+                                   min_parallel=4, bounds=FIT_BOUNDS, estimator='least_squares'):
+    """Fit many beam/orbit mean grids in one call, spread over a process pool
 
-def calculating_2d_gaussian():
+    init_centers holds one (init_x, init_y) per grid and initial_params optionally one full parameter
+    tuple per grid (a warm start). Batches smaller than min_parallel are fitted in this process.
+    estimator names one of estimators.ESTIMATORS; every result records it and its run time.
+    """
+    if initial_params is None:
+        initial_params = [None] * len(mean_elev_diffs)
+    jobs = [(grid, init_x, init_y, params, bounds, estimator)
+            for grid, (init_x, init_y), params in zip(mean_elev_diffs, init_centers, initial_params)]
+    if len(jobs) < min_parallel or max_workers == 1:
+        return [_fit_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_fit_job, jobs))
+
+def collect_beam_job(root, file_path, beam_name):
+    """(root, file_path, beam_name, n, mean |elev_diff|, init_x, init_y) of one beam, or None without footprints"""
+    # Fit from the running sum/count grids written by part 2; older outputs are streamed in chunks
+    accumulator_path = os.path.join(root, f'accum_abs_elev_diffs_{beam_name}.npz')
+    if os.path.exists(accumulator_path):
+        accumulator = GridAccumulator.load(accumulator_path)
+    elif file_path.endswith('.h5'):
+        accumulator = results_store.abs_accumulator(file_path)
+    else:
+        accumulator = GridAccumulator.from_npy(file_path)
+    if accumulator.n == 0:
+        print(f'No data available in {beam_name} of {file_path}.')
+        return None
+    n = accumulator.n
+    average_elevation = accumulator.mean()
+    min_pos = np.unravel_index(np.argmin(np.abs(average_elevation)), average_elevation.shape)
+    init_x, init_y = -35 + min_pos[1] * (70 / average_elevation.shape[1]), -35 + min_pos[0] * (70 / average_elevation.shape[0])
+    return root, file_path, beam_name, n, average_elevation, init_x, init_y
+
+def save_beam_fit(job, fit, intermediate_format='csv', index_path=results_index.INDEX_FILE, extra=None):
+    """Write abs_adjusted_elev_diffs_{beam}.npy and the beam's one-row results; returns the written paths
+
+    The result is also upserted into the results index at index_path (and removed from it when the fit failed);
+    an index created here is first backfilled from the results files of the granules next to root.
+    extra holds further result columns, e.g. the bootstrap confidence intervals.
+    """
+    root, file_path, beam_name, n, average_elevation, init_x, init_y = job
+    index = results_index.open_index(index_path, os.path.dirname(root))
+    if fit['x0'] is None:
+        print(f'Failed Gaussian fitting in {beam_name} of {file_path}.')
+        index.delete(os.path.basename(root), beam_name)
+        return []
+    filename = os.path.join(root, f'abs_adjusted_elev_diffs_{beam_name}.npy')
+    np.save(filename, fit['fitted_data'])
+
+    result = {
+        'Label': beam_name,
+        'n': n,
+        'bias': fit['bias'],
+        'minRMSE': fit['minRMSE'],
+        'init_x': init_x,
+        'init_y': init_y,
+        'adjusted_x': fit['x0'],
+        'adjusted_y': fit['y0'],
+        'nfev': fit['nfev'],
+        'fit_status': fit['status'],
+    }
+    if 'estimator' in fit:
+        result.update(estimator=fit['estimator'], estimator_seconds=fit['estimator_seconds'])
+    if extra:
+        result.update(extra)
+
+    if intermediate_format == 'parquet':
+        results_filename = intermediate.write_result(result, os.path.basename(root), beam_name)
+    else:
+        results_filename = os.path.join(root, f'results_{beam_name}.csv')
+        df = pd.DataFrame([result])
+        df.to_csv(results_filename, index=False)
+    index.upsert(os.path.basename(root), beam_name, result)
+    print(f"Saved progress to {filename}")
+    return [filename, results_filename]
+
+@metrics.stage('part3')
+def calculating_2d_gaussian(max_workers=None, intermediate_format='csv', bounds=FIT_BOUNDS, bootstrap_resamples=0,
+                            confidence=0.95, seed=0, estimator='least_squares'):
+    # intermediate_format='parquet' writes the results to the GEDI_data/results dataset instead of results_{beam}.csv
+    # estimator selects the offset estimator (estimators.py), e.g. 'hybrid' or the non-iterative 'quadratic'
+    # bootstrap_resamples > 0 adds bootstrap confidence intervals of the offsets to the results (bootstrap.py)
     base_dir = 'GEDI_data'
     beam_prefixes = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
 
+    # Backfill a missing results index from the existing results files before any beam is refitted
+    results_index.open_index(os.path.join(base_dir, 'results_index.sqlite'), base_dir)
+
+    # Collect the mean grids of all beams first, then fit them in one batched call
+    jobs = []
     for root, dirs, files in os.walk(base_dir):
         for file in files:
-            if any(file.startswith(f'abs_elev_diffs_{prefix}.npy') for prefix in beam_prefixes):
+            # Part 2 writes either abs_elev_diffs_{beam}.npy or a signed elev_diffs_{beam}.h5
+            if any(file in (f'abs_elev_diffs_{prefix}.npy', f'elev_diffs_{prefix}.h5') for prefix in beam_prefixes):
                 file_path = os.path.join(root, file)
-                elev_diffs = np.load(file_path)
-                beam_name_npy = file.split('_')[3]
-                beam_name = beam_name_npy.split('.')[0]
-                if elev_diffs.size == 0:
-                    print(f'No data available in {beam_name} of {file_path}.')
-                    continue
-                elev_diffs = np.array(elev_diffs)
-                n = elev_diffs.shape[0]
-                average_elevation = np.nanmean(elev_diffs, axis=0)
-                min_pos = np.unravel_index(np.argmin(np.abs(average_elevation)), average_elevation.shape)
-                init_x, init_y = -35 + min_pos[1] * (70 / average_elevation.shape[1]), -35 + min_pos[0] * (70 / average_elevation.shape[0])
-                gaussianfit_x, gaussianfit_y, sigma_x, sigma_y, fitted_data, bias, minRMSE = fit_2d_inverted_gaussian(average_elevation, init_x, init_y)
-                if gaussianfit_x is None:
-                    print(f'Failed Gaussian fitting in {beam_name} of {file_path}.')
+                beam_name = file.split('_')[-1].split('.')[0]
+                if file.endswith('.npy') and os.path.exists(os.path.join(root, f'elev_diffs_{beam_name}.h5')):
                     continue
-                filename = os.path.join(root, f'abs_adjusted_elev_diffs_{beam_name}.npy')
-                np.save(filename, fitted_data)
-
-                result = {
-                    'Label': beam_name,
-                    'n': n,
-                    'bias': bias,
-                    'minRMSE': minRMSE,
-                    'init_x': init_x,
-                    'init_y': init_y,
-                    'adjusted_x': gaussianfit_x,
-                    'adjusted_y': gaussianfit_y,
-                }
-
-                results_filename = os.path.join(root, f'results_{beam_name}.csv')
-                df = pd.DataFrame([result])
-                df.to_csv(results_filename, index=False)
-                print(f"Saved progress to {filename}")
+                with metrics.timer('part3.collect'):
+                    job = collect_beam_job(root, file_path, beam_name)
+                if job is not None:
+                    jobs.append(job)
+
+    with metrics.timer('part3.fit_batch'):
+        fits = fit_2d_inverted_gaussian_batch([job[4] for job in jobs], [(job[5], job[6]) for job in jobs],
+                                              max_workers=max_workers, bounds=bounds, estimator=estimator)
+
+    for job, fit in zip(jobs, fits):
+        metrics.count('part3.fits.succeeded' if fit['x0'] is not None else 'part3.fits.failed')
+        metrics.observe('part3.nfev', fit['nfev'])
+        metrics.observe(f"part3.estimator.{fit['estimator']}", fit['estimator_seconds'])
+        extra = None
+        if bootstrap_resamples:
+            extra = bootstrap.bootstrap_beam(job, fit, bootstrap_resamples, confidence, max_workers, seed=seed,
+                                             bounds=bounds, estimator=estimator)
+        save_beam_fit(job, fit, intermediate_format, os.path.join(base_dir, 'results_index.sqlite'), extra=extra)
 
     return 0
@@ -1,108 +1,91 @@
 import numpy as np
-from geopy.distance import geodesic
-import ee
 import pandas as pd
 from datetime import datetime
 import rasterio
 import pyproj
 import os
-from concurrent.futures import ThreadPoolExecutor
-from scipy.ndimage import gaussian_filter
+from functools import lru_cache
+from GEDI_elev_correction import offset_grid, elevation_sources, corridor, dem_cache, results_store, coverage_index
+from GEDI_elev_correction import smoothing, metrics
+
+FOOTPRINT_COLUMNS = ['Latitude', 'Longitude', 'Elevation', 'Smoothed_Tan', 'Granule']
+# Footprints with any |elev_GEDI - elev_3DEP| cell beyond this (m) are rejected
+ELEV_DIFF_THRESHOLD = 15
+
+
+class BeamAborted(Exception):
+    """Raised by process_beam when its abort event is set, e.g. when a work unit's lease was lost"""
+
+
+def _check_abort(abort, beam_name):
+    if abort is not None and abort.is_set():
+        raise BeamAborted(f"Aborted {beam_name} before writing any further footprints")
 
 
 def GEE_authorizing():
     # Initialize Google Earth Engine with a service account.
+    import ee
     service_account = "lobstyu@premium-cipher-424203-d0.iam.gserviceaccount.com"
     credentials = ee.ServiceAccountCredentials(service_account, 'GEDI_elev_correction\\premium-cipher-424203-d0-c6894a29d00c.json')
     ee.Initialize(credentials)
 
     return 0
 
-def get_matrix_elev_diff(center_lat, center_lon, elev_GEDI, tan_direction, spacing=1, extent=35, buffer_extent=10):
-    half_extent = extent
-    x = np.arange(-half_extent - buffer_extent, half_extent + spacing + buffer_extent, spacing)
-    y = np.arange(-half_extent - buffer_extent, half_extent + spacing + buffer_extent, spacing)
-    xx, yy = np.meshgrid(x, y)
-
-    angle = np.arctan(tan_direction)
-    cos_angle = np.cos(angle)
-    sin_angle = np.sin(angle)
-
-    # Calculate rotation in the UTM coordinate system
-    x_rot = xx * cos_angle - yy * sin_angle
-    y_rot = xx * sin_angle + yy * cos_angle
-
-    # Convert UTM displacement to WGS-84 lat/lon
-    points_lat = np.zeros_like(xx, dtype=float)
-    points_lon = np.zeros_like(yy, dtype=float)
-
-    for i in range(xx.shape[0]):
-        for j in range(xx.shape[1]):
-            displacement = (
-            y_rot[i, j], x_rot[i, j])  # Note the order: (latitude displacement, longitude displacement)
-            origin = (center_lat, center_lon)
-            destination = geodesic(meters=displacement[0]).destination(origin, 0)
-            destination = geodesic(meters=displacement[1]).destination(destination, 90)
-            points_lat[i, j] = destination.latitude
-            points_lon[i, j] = destination.longitude
-
-    # Split points into batches for parallel processing
-    num_points = points_lat.size
-    indices = np.arange(num_points)
-    batches = np.array_split(indices, 8)
-
-    def fetch_elevations(batch):
-        try:
-            latitudes = points_lat.flatten()[batch].reshape(-1, 1)
-            longitudes = points_lon.flatten()[batch].reshape(-1, 1)
-            points = ee.FeatureCollection([ee.Feature(ee.Geometry.Point([lon, lat])) for lat, lon in zip(latitudes.flatten(), longitudes.flatten())])
-
-            # Define the 3DEP dataset
-            dataset = ee.ImageCollection("USGS/3DEP/1m")
-            image = dataset.mosaic()
-
-            # Get the elevation at the points
-            elevations = image.reduceRegions(
-                collection=points,
-                reducer=ee.Reducer.first(),
-                scale=1  # Use 1 meter scale since 3DEP data is at 1m resolution
-            )
-
-            # Extract the results
-            elevation_values = []
-            for feature in elevations.getInfo().get('features', []):
-                value = feature.get('properties', {}).get('first')
-                if value is None:
-                    return None
-
-                elevation_values.append(value)
-            return elevation_values
-
-        except Exception as e:
-            print(f"Error fetching elevation data: {e}")
-            return None
-
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(fetch_elevations, batch) for batch in batches]
-        results = [f.result() for f in futures]
-
-    if any(result is None for result in results):
-        return None
-
-    elevation_values = [val for result in results for val in result]
-
-    # Reshape to 71x71 matrix
-    elevation_matrix = np.array(elevation_values).reshape(points_lat.shape)
-
-    # Apply 2D Gaussian filter to smooth the elevation matrix
-    smoothed_elevation_matrix = gaussian_filter(elevation_matrix, sigma=5.5)
-    elev_3DEP = smoothed_elevation_matrix[10:81, 10:81]
-
-    elev_diff = elev_GEDI - elev_3DEP
-    if np.any(np.abs(elev_diff) > 15):
+def get_matrix_elev_diff(center_lat, center_lon, elev_GEDI, tan_direction, spacing=1, extent=35, buffer_extent=10,
+                         elevation_source=None):
+    # Rotated 91x91 sample grid, computed in one vectorized geodesic pass
+    points_lat, points_lon = offset_grid.get_offset_grids(center_lat, center_lon, tan_direction,
+                                                          spacing, extent, buffer_extent)
+    points_lat, points_lon = points_lat[0], points_lon[0]
+
+    if elevation_source is None:
+        elevation_source = elevation_sources.get_elevation_source('gee')
+    try:
+        elevation_values = elevation_source.sample(points_lat.ravel(), points_lon.ravel())
+    except elevation_sources.ElevationFetchError:
         return None
 
-    return elev_diff
+    return get_elev_diff_from_dem(elevation_values.reshape(points_lat.shape), elev_GEDI)
+
+def get_elevation_windows(center_lats, center_lons, tan_directions, elevation_source, spacing=1, extent=35,
+                          buffer_extent=10):
+    """91x91 3DEP windows of a block of footprints, requested together; NaN where data is missing or failed"""
+    with metrics.timer('part2.offset_grid'):
+        points_lat, points_lon = offset_grid.get_offset_grids(center_lats, center_lons, tan_directions,
+                                                              spacing, extent, buffer_extent)
+    with metrics.timer('part2.elevation_fetch'):
+        elevation_values = elevation_sources.sample_allowing_failures(elevation_source, points_lat.ravel(),
+                                                                      points_lon.ravel())
+    return elevation_values.reshape(points_lat.shape)
+
+def get_elev_diff_from_dem(elevation_matrix, elev_GEDI):
+    """Smooth a 91x91 3DEP window, crop it to 71x71 and difference it with the GEDI elevation"""
+    elev_diffs, accepted = get_elev_diffs_from_dems(np.asarray(elevation_matrix)[np.newaxis], [elev_GEDI])
+    return elev_diffs[0] if accepted[0] else None
+
+def get_elev_diffs_from_dems(elevation_windows, elev_GEDI, smoothing_method='direct'):
+    """Batched get_elev_diff_from_dem for a (N, 91, 91) stack of windows
+
+    Returns (elev_diffs of shape (N, 71, 71), accepted): windows with missing data or a cell beyond ±15 m
+    are not accepted and their rows are left NaN.
+    """
+    elevation_windows = np.asarray(elevation_windows, dtype=np.float64)
+    elev_GEDI = np.asarray(elev_GEDI, dtype=np.float64)
+    n_crop = elevation_windows.shape[1] - 2 * smoothing.CROP
+    elev_diffs = np.full((elevation_windows.shape[0], n_crop, n_crop), np.nan)
+    accepted = ~np.isnan(elevation_windows).any(axis=(1, 2))
+    complete = np.flatnonzero(accepted)
+    if complete.size == 0:
+        return elev_diffs, accepted
+
+    # Apply 2D Gaussian filter to smooth the elevation matrices, filtering the spatial axes only
+    with metrics.timer('part2.smoothing'):
+        elev_3DEP = smoothing.smooth_and_crop(elevation_windows[complete], method=smoothing_method)
+
+    elev_diffs[complete] = elev_GEDI[complete, np.newaxis, np.newaxis] - elev_3DEP
+    accepted[complete] = ~np.any(np.abs(elev_diffs[complete]) > ELEV_DIFF_THRESHOLD, axis=(1, 2))
+    elev_diffs[~accepted] = np.nan
+    return elev_diffs, accepted
 
 def load_geoid(geoid_file):
     """加载GEOID12B数据并获取其属性"""
@@ -113,88 +96,263 @@ def load_geoid(geoid_file):
     return geoid_data, transform, crs
 
 
+@lru_cache(maxsize=None)
+def _geoid_transformer(geoid_crs_wkt):
+    return pyproj.Transformer.from_crs(pyproj.CRS("EPSG:4326"), pyproj.CRS.from_wkt(geoid_crs_wkt), always_xy=True)
+
+
+def get_geoid_heights(lats, lons, geoid_data, transform, geoid_crs, method='nearest'):
+    """Geoid heights of whole arrays of points in one vectorized pass
+
+    method='nearest' indexes the grid cell like get_geoid_height; method='bilinear' interpolates between
+    the four surrounding GEOID12B nodes. Returns (heights, inside): heights is NaN where inside is False,
+    i.e. for points outside the grid.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    transformer = _geoid_transformer(geoid_crs.to_wkt())
+    lons = np.where(lons < 0, lons + 360, lons)
+    x, y = transformer.transform(lons, lats)
+    cols, rows = ~transform * (np.asarray(x), np.asarray(y))
+    n_rows, n_cols = geoid_data.shape
+
+    # int() truncation as in get_geoid_height
+    row_idx = np.trunc(rows).astype(np.int64)
+    col_idx = np.trunc(cols).astype(np.int64)
+    inside = (row_idx >= 0) & (row_idx < n_rows) & (col_idx >= 0) & (col_idx < n_cols)
+    heights = np.full(lats.shape, np.nan)
+
+    if method == 'nearest':
+        heights[inside] = geoid_data[row_idx[inside], col_idx[inside]]
+    elif method == 'bilinear':
+        # Grid nodes sit at cell centres; points within half a cell of the edge use the edge nodes
+        r = np.clip(rows[inside] - 0.5, 0, n_rows - 1)
+        c = np.clip(cols[inside] - 0.5, 0, n_cols - 1)
+        r0 = np.minimum(np.floor(r).astype(np.int64), max(n_rows - 2, 0))
+        c0 = np.minimum(np.floor(c).astype(np.int64), max(n_cols - 2, 0))
+        r1 = np.minimum(r0 + 1, n_rows - 1)
+        c1 = np.minimum(c0 + 1, n_cols - 1)
+        fr, fc = r - r0, c - c0
+        heights[inside] = (geoid_data[r0, c0] * (1 - fr) * (1 - fc) + geoid_data[r0, c1] * (1 - fr) * fc +
+                           geoid_data[r1, c0] * fr * (1 - fc) + geoid_data[r1, c1] * fr * fc)
+    else:
+        raise ValueError(f"Unknown geoid interpolation method: {method}")
+
+    return heights, inside
+
+
 def get_geoid_height(lat, lon, geoid_data, transform, geoid_crs):
     """根据经纬度获取大地水准面高度"""
-    wgs84 = pyproj.CRS("EPSG:4326")
-    transformer = pyproj.Transformer.from_crs(wgs84, geoid_crs, always_xy=True)
-    lon = lon + 360 if lon < 0 else lon
-    x, y = transformer.transform(lon, lat)
-    col, row = ~transform * (x, y)
-    row, col = int(row), int(col)
-    if 0 <= row < geoid_data.shape[0] and 0 <= col < geoid_data.shape[1]:
-        return geoid_data[row, col]
+    heights, inside = get_geoid_heights([lat], [lon], geoid_data, transform, geoid_crs)
+    if inside[0]:
+        return geoid_data.dtype.type(heights[0])
     else:
         return None
 
 
-def calculating_elev_diffs():
-    GEE_authorizing()
+def process_beam(file_path, root, beam_name, geoid, elevation_source, corridor_mode=False, geoid_method='nearest',
+                 footprint_block_size=32, flush_every=50, coverage=None, cascade=None,
+                 smoothing_method='direct', storage='npy', quantize_decimals=None, footprints=None,
+                 footprint_range=None, abort=None):
+    """Compute the elev_diffs/abs_elev_diffs stacks of one *_Filtered_data.csv beam (or of a footprints table)
+
+    Accepted footprints are streamed to a FootprintStore, so memory stays bounded and an interrupted
+    beam resumes from the last flushed footprint. With a CascadeScreen, footprints that already fail the
+    ±15 m test on a coarse lattice are rejected before their dense window is fetched.
+    abort (a threading.Event) is checked before every block and every write; once set, BeamAborted is raised
+    and nothing more is written to the store.
+    footprint_range=(start, stop) limits the beam to one work unit of the sharded mode (work_queue.py): only
+    those rows are read and looked up, while the store still records beam-wide footprint indices.
+    """
+    geoid_data, transform, geoid_crs = geoid
+    offset = 0
+    if footprint_range is not None:
+        offset, stop = footprint_range
+        if footprints is None:
+            beam_data = pd.read_csv(file_path, skiprows=range(1, offset + 1), nrows=stop - offset)
+        else:
+            beam_data = footprints.iloc[offset:stop].reset_index(drop=True)
+    else:
+        beam_data = pd.read_csv(file_path) if footprints is None else footprints
+    start_time = datetime.now()
+    print("start_time:", start_time)
+    store = results_store.FootprintStore(root, beam_name, flush_every=flush_every)
+    if store.resumed:
+        print(f"Resuming {beam_name} of {file_path} at footprint {store.next_index}")
+    requested_points = 0
+    next_report = 0
+
+    latitudes = beam_data['Latitude'].to_numpy()
+    longitudes = beam_data['Longitude'].to_numpy()
+    elevations = beam_data['Elevation'].to_numpy()
+    tans = beam_data['Smoothed_Tan'].to_numpy()
+    with metrics.timer('part2.geoid'):
+        geoid_heights, geoid_inside = get_geoid_heights(latitudes, longitudes, geoid_data, transform, geoid_crs,
+                                                        method=geoid_method)
+    # Footprints outside 3DEP 1m coverage are rejected without any elevation request
+    usable = geoid_inside.copy()
+    # Rejection reason of the footprints dropped before the dense fetch
+    reasons = np.where(geoid_inside, '', 'outside_geoid').astype(object)
+    if coverage is not None and len(beam_data) > 0:
+        with metrics.timer('part2.coverage'):
+            covered = coverage.windows_covered(latitudes, longitudes, tans)
+        print(f"Skipping {np.count_nonzero(~covered)} of {len(beam_data)} footprints outside 3DEP 1m coverage")
+        reasons[usable & ~covered] = 'uncovered'
+        usable &= covered
+
+    # corridor mode fetches one DEM strip per run of consecutive footprints instead of one window per footprint;
+    # otherwise the windows of footprint_block_size footprints are requested together
+    # Positions below index the rows read (the unit's range); offset + position is the footprint of the beam
+    remaining = np.arange(max(store.next_index - offset, 0), len(beam_data))
+    if corridor_mode:
+        runs = [remaining[run] for run in corridor.split_runs(latitudes[remaining], longitudes[remaining])]
+    else:
+        runs = np.array_split(remaining, int(np.ceil(remaining.size / footprint_block_size))) if remaining.size else []
+
+    for run in runs:
+        _check_abort(abort, beam_name)
+        valid_footprints, invalid_footprints = store.valid_footprints, store.invalid_footprints
+        if valid_footprints + invalid_footprints >= next_report:
+            next_report = ((valid_footprints + invalid_footprints) // 10 + 1) * 10
+            print(
+                f'{valid_footprints + invalid_footprints} of {len(beam_data)} footprints were converted in {beam_name} at {datetime.now()}')
+            print(f'valid_footprints: {valid_footprints}; invalid_footprints: {invalid_footprints} ')
+
+        metrics.count('part2.footprints', len(run))
+        for idx in run[~usable[run]]:
+            store.reject(offset + idx)
+            metrics.count(f'part2.rejected.{reasons[idx]}')
+        kept = run[usable[run]]
+        screened = np.zeros(len(kept), dtype=bool)
+        if cascade is not None and len(kept) > 0:
+            # Coarse lattice first; only survivors (and a validation sample of rejections) get the dense fetch
+            with metrics.timer('part2.cascade'):
+                screened, n_points = cascade.screen(latitudes[kept], longitudes[kept], tans[kept],
+                                                    elevations[kept] - geoid_heights[kept], elevation_source)
+            requested_points += n_points
+            metrics.count('part2.elevation_points', n_points)
+            dense = ~screened | cascade.pick_validation(screened)
+            for idx in kept[~dense]:
+                store.reject(offset + idx)
+            metrics.count('part2.rejected.cascade', np.count_nonzero(~dense))
+            kept, screened = kept[dense], screened[dense]
+        if len(kept) > 0:
+            elev_GEDI = elevations[kept] - geoid_heights[kept]
+
+            if corridor_mode:
+                with metrics.timer('part2.corridor_fetch'):
+                    windows, n_points = corridor.fetch_corridor_elevations(latitudes[kept], longitudes[kept],
+                                                                           tans[kept], elevation_source)
+            else:
+                windows = get_elevation_windows(latitudes[kept], longitudes[kept], tans[kept], elevation_source)
+                n_points = windows.size
+            requested_points += n_points
+            metrics.count('part2.elevation_points', n_points)
+
+            elev_diffs, accepted = get_elev_diffs_from_dems(windows, elev_GEDI, smoothing_method)
+            missing = np.isnan(windows).any(axis=(1, 2))
+            metrics.count('part2.accepted', np.count_nonzero(accepted))
+            metrics.count('part2.rejected.missing_elevation', np.count_nonzero(missing))
+            metrics.count('part2.rejected.threshold', np.count_nonzero(~accepted & ~missing))
+            for idx, elev_diff, is_accepted, coarse_rejected in zip(kept, elev_diffs, accepted, screened):
+                if cascade is not None:
+                    cascade.record(coarse_rejected, is_accepted)
+                if not is_accepted:
+                    store.reject(offset + idx)
+                    continue
+                store.append(offset + idx, elev_diff, (latitudes[idx], longitudes[idx], tans[idx], geoid_heights[idx]))
+        _check_abort(abort, beam_name)
+        store.maybe_flush()
+
+    _check_abort(abort, beam_name)
+    with metrics.timer('part2.finalize'):
+        filename = store.finalize(storage=storage, quantize_decimals=quantize_decimals)[-1]
+    end_time = datetime.now()
+    runningtime = end_time - start_time
+
+    print(f"file_path:{file_path}")
+    print(f'valid_footprints: {store.valid_footprints}; invalid_footprints: {store.invalid_footprints} ')
+    print(f"Requested {requested_points} elevation points for {len(beam_data)} footprints")
+    print(f"Elevation requests: {elevation_source.stats()}")
+    if cascade is not None:
+        print(f"Cascaded screen: {cascade.stats()}")
+    print(f"Saved elev_diffs to {filename} in {runningtime} at {end_time}")
+    return 0
 
+
+def open_elevation_source(elevation_source='gee', dem_path=None, dem_cache_dir=None, dem_cache_size=4 * 1024 ** 3):
+    """Elevation source of part 2, authorized for GEE and wrapped in the DEM tile cache when dem_cache_dir is given"""
+    source_kwargs = {'dem_path': dem_path} if elevation_source == 'local' else {}
+    elevation_source = elevation_sources.get_elevation_source(elevation_source, **source_kwargs)
+    if isinstance(elevation_source, elevation_sources.GEEElevationSource):
+        GEE_authorizing()
+    # Opt-in: DEM samples are cached on disk per backend, snapped to a 1 m UTM lattice (see DEMTileCache),
+    # which changes the sampled points compared with the uncached default
+    if dem_cache_dir is not None:
+        cache = dem_cache.DEMTileCache(os.path.join(dem_cache_dir, elevation_source.cache_key), max_bytes=dem_cache_size)
+        elevation_source = dem_cache.CachedElevationSource(elevation_source, cache)
+    return elevation_source
+
+
+@metrics.stage('part2')
+def calculating_elev_diffs(elevation_source='gee', dem_path=None, corridor_mode=False,
+                           dem_cache_dir=None, dem_cache_size=4 * 1024 ** 3,
+                           geoid_method='nearest', footprint_block_size=32, flush_every=50, coverage_file=None,
+                           cascade_mode=False, cascade_margin=3.0, cascade_validate_fraction=0.05,
+                           smoothing_method='direct', storage='npy', quantize_decimals=None,
+                           intermediate_format='csv', land_cover_class=60, bbox=None):
+    # elevation_source: 'gee' (Earth Engine USGS/3DEP/1m) or 'local' (3DEP 1m GeoTIFF/VRT at dem_path)
+    elevation_source = open_elevation_source(elevation_source, dem_path, dem_cache_dir, dem_cache_size)
+
+    # intermediate_format: 'csv' (*_Filtered_data.csv of part 1) or 'parquet' (GEDI_data/footprints dataset,
+    # selected by land_cover_class and an optional (west, south, east, north) bbox)
+    # smoothing_method: 'direct' (stacked gaussian_filter) or 'fft'; both match the per-window filter
+    # storage: 'npy' (elev_diffs + abs_elev_diffs float64) or 'h5' (one compressed float32 signed stack with
+    # footprint metadata, optionally quantized to quantize_decimals)
     geoid_file = 'g2012bu0.bin'
-    geoid_data, transform, geoid_crs = load_geoid(geoid_file)
+    geoid = load_geoid(geoid_file)
+    coverage = coverage_index.CoverageIndex.from_file(coverage_file) if coverage_file else None
+    # cascade_mode: coarse-lattice early rejection; cascade_validate_fraction of its rejections are re-checked densely
+    cascade = None
+    if cascade_mode:
+        from GEDI_elev_correction import cascade as cascade_screen
+        cascade = cascade_screen.CascadeScreen(cascade_margin, validate_fraction=cascade_validate_fraction)
 
     base_dir = 'GEDI_data'
     beam_prefixes = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
     # beam_prefixes = ['BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
     # beam_prefixes = ['BEAM0000']
-    for root, dirs, files in os.walk(base_dir):
-        for file in files:
-            if any(file.startswith(prefix) and file.endswith('Filtered_data.csv') for prefix in beam_prefixes):
-                file_path = os.path.join(root, file)
-                beam_name = file.split('_')[0]
-                elev_diffs_filename = os.path.join(root, f'elev_diffs_{beam_name}.npy')
-                abs_elev_diffs_filename = os.path.join(root, f'abs_elev_diffs_{beam_name}.npy')
-
-                if os.path.exists(elev_diffs_filename) and os.path.exists(abs_elev_diffs_filename):
-                    print(
-                        f"Files {elev_diffs_filename} and {abs_elev_diffs_filename} already exist. Skipping computation.")
-                    continue
-                beam_data = pd.read_csv(file_path)
-                start_time = datetime.now()
-                print("start_time:", start_time)
-                valid_footprints = 0
-                invalid_footprints = 0
-                elev_diffs = []
-                abs_elev_diffs = []
-
-                for idx, row in beam_data.iterrows():
-                    if (valid_footprints + invalid_footprints) % 10 == 0:
-                        print(
-                            f'{valid_footprints + invalid_footprints} of {len(beam_data)} footprints were converted in {beam_name} at {datetime.now()}')
-                        print(f'valid_footprints: {valid_footprints}; invalid_footprints: {invalid_footprints} ')
-
-                    center_lat, center_lon, wgs84_elev_GEDI, tan_direction = row['Latitude'], row['Longitude'], row[
-                        'Elevation'], row['Smoothed_Tan']
-                    geoid_height = get_geoid_height(center_lat, center_lon, geoid_data, transform, geoid_crs)
-                    if geoid_height is not None:
-                        elev_GEDI = wgs84_elev_GEDI - geoid_height
-                    else:
-                        invalid_footprints += 1
-                        continue
-                    elev_diff = get_matrix_elev_diff(center_lat, center_lon, elev_GEDI, tan_direction)
-                    if elev_diff is None:
-                        invalid_footprints += 1
-                        continue
-                    valid_footprints += 1
-                    # 此处有异议
-                    abs_elev_diff = np.abs(elev_diff)
-                    elev_diffs.append(elev_diff)
-                    abs_elev_diffs.append(abs_elev_diff)
-
-                # 转换 elev_diffs 为三维数组
-                elev_diffs = np.array(elev_diffs)
-                abs_elev_diffs = np.array(abs_elev_diffs)
-
-                filename = os.path.join(root, f'elev_diffs_{beam_name}.npy')
-                np.save(filename, elev_diffs)
-                filename = os.path.join(root, f'abs_elev_diffs_{beam_name}.npy')
-                np.save(filename, abs_elev_diffs)
-                end_time = datetime.now()
-                runningtime = end_time - start_time
-
-                print(f"file_path:{file_path}")
-                print(f"Saved elev_diffs to {filename} in {runningtime} at {end_time}")
-                del beam_data, elev_diffs, abs_elev_diffs
-                # gc.collect()
-
-    return 0
\ No newline at end of file
+    # (file_path, output folder, beam, footprints) of every beam; footprints is None for CSV input
+    beams = []
+    if intermediate_format == 'parquet':
+        from GEDI_elev_correction import intermediate
+        # land_cover_class / bbox filters are pushed down into the Parquet scan
+        for granule, beam_name, footprints in intermediate.iter_beam_footprints(
+                beams=beam_prefixes, columns=FOOTPRINT_COLUMNS, land_cover=land_cover_class, bbox=bbox,
+                covered_only=True):
+            beams.append((f'{granule}/{beam_name}', os.path.join(base_dir, granule), beam_name, footprints))
+    else:
+        for root, dirs, files in os.walk(base_dir):
+            for file in files:
+                if any(file.startswith(prefix) and file.endswith('Filtered_data.csv') for prefix in beam_prefixes):
+                    beams.append((os.path.join(root, file), root, file.split('_')[0], None))
+
+    for file_path, root, beam_name, footprints in beams:
+        elev_diffs_filename = os.path.join(root, f'elev_diffs_{beam_name}.npy')
+        abs_elev_diffs_filename = os.path.join(root, f'abs_elev_diffs_{beam_name}.npy')
+        h5_filename = os.path.join(root, f'elev_diffs_{beam_name}.h5')
+
+        if os.path.exists(elev_diffs_filename) and os.path.exists(abs_elev_diffs_filename):
+            print(
+                f"Files {elev_diffs_filename} and {abs_elev_diffs_filename} already exist. Skipping computation.")
+            continue
+        if os.path.exists(h5_filename):
+            print(f"File {h5_filename} already exists. Skipping computation.")
+            continue
+        os.makedirs(root, exist_ok=True)
+        process_beam(file_path, root, beam_name, geoid, elevation_source, corridor_mode, geoid_method,
+                     footprint_block_size, flush_every, coverage, cascade, smoothing_method, storage,
+                     quantize_decimals, footprints)
+        # gc.collect()
+
+    return 0
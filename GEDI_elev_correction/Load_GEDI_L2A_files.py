@@ -1,98 +1,116 @@
 import h5py
 import numpy as np
-import ee
 import os
-import pandas as pd
 import time
+import itertools
+import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from GEDI_elev_correction import landcover, coverage_index, intermediate, metrics
+
+
+def _read_masked(dataset, mask, max_gap=4096):
+    """Read dataset[mask] through hyperslab reads of the masked index runs only
+
+    Runs separated by fewer than max_gap unselected elements are merged into one read, since many tiny
+    reads cost more than reading a few extra elements.
+    """
+    idx = np.flatnonzero(mask)
+    if idx.size == 0:
+        return np.empty(0, dtype=dataset.dtype)
+    breaks = np.flatnonzero(np.diff(idx) > max_gap) + 1
+    values = []
+    for run in np.split(idx, breaks):
+        start, stop = run[0], run[-1] + 1
+        values.append(dataset[start:stop][run - start])
+    return np.concatenate(values)
 
 
 def get_center_data(file_path, beams):
     data = {}
-    for beam in beams:
-        with h5py.File(file_path, 'r') as file:
-            lat = np.array(file[f'/{beam}/lat_lowestmode'])
-            lon = np.array(file[f'/{beam}/lon_lowestmode'])
-            elev = np.array(file[f'/{beam}/elev_lowestmode'])
-            surface_flag = np.array(file[f'/{beam}/surface_flag'])
-
-        dlat = np.diff(lat)
-        dlon = np.diff(lon)
-        instantaneous_tan = np.arctan2(dlat, dlon)
-        instantaneous_tan = np.pad(instantaneous_tan, (0, 1), mode='edge')
-        smoothed_tan = np.convolve(instantaneous_tan, np.ones(11) / 11, mode='same')
-        smoothed_tan[:5] = instantaneous_tan[:5]
-        smoothed_tan[-5:] = instantaneous_tan[-5:]
-
-        # data in range of GEOIDL2B
-        mask = (lat >= 24) & (lat <= 58) & (lon >= -130) & (lon <= -60) & (surface_flag == 1)
-        ranged_data = np.stack((lat[mask], lon[mask], elev[mask], instantaneous_tan[mask], smoothed_tan[mask]),
-                               axis=-1)
-
-        data[beam] = ranged_data
+    with h5py.File(file_path, 'r') as file:
+        for beam in beams:
+            lat = file[f'/{beam}/lat_lowestmode'][()]
+            lon = file[f'/{beam}/lon_lowestmode'][()]
+
+            dlat = np.diff(lat)
+            dlon = np.diff(lon)
+            instantaneous_tan = np.arctan2(dlat, dlon)
+            instantaneous_tan = np.pad(instantaneous_tan, (0, 1), mode='edge')
+            smoothed_tan = np.convolve(instantaneous_tan, np.ones(11) / 11, mode='same')
+            smoothed_tan[:5] = instantaneous_tan[:5]
+            smoothed_tan[-5:] = instantaneous_tan[-5:]
+
+            # data in range of GEOIDL2B; surface_flag and elevation are only read where the bounding box matches
+            mask = (lat >= 24) & (lat <= 58) & (lon >= -130) & (lon <= -60)
+            surface_flag = _read_masked(file[f'/{beam}/surface_flag'], mask)
+            mask[mask] = surface_flag == 1
+            elev = _read_masked(file[f'/{beam}/elev_lowestmode'], mask)
+
+            ranged_data = np.stack((lat[mask], lon[mask], elev, instantaneous_tan[mask], smoothed_tan[mask]),
+                                   axis=-1)
+
+            data[beam] = ranged_data
 
     return data
 
 
+def ingest_granules(file_paths, beams, max_workers=None, window=None):
+    """Run get_center_data over many granules in a process pool, yielding (file_path, data) in order
+
+    At most window granules (default 2 x max_workers) are submitted ahead of the one being consumed, so
+    the beam arrays of finished granules do not pile up while the caller is busy with land cover.
+    The beams of one granule are read in its worker one after another: HDF5 serializes reads within a
+    process, and the pool already keeps every core busy with other granules.
+    """
+    if max_workers == 1 or len(file_paths) < 2:
+        for file_path in file_paths:
+            yield file_path, get_center_data(file_path, beams)
+        return
+    max_workers = max_workers or os.cpu_count() or 1
+    window = window or 2 * max_workers
+    pending = deque()
+    remaining = iter(file_paths)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for file_path in itertools.islice(remaining, window):
+            pending.append((file_path, executor.submit(get_center_data, file_path, beams)))
+        while pending:
+            file_path, future = pending.popleft()
+            data = future.result()
+            for next_path in itertools.islice(remaining, 1):
+                pending.append((next_path, executor.submit(get_center_data, next_path, beams)))
+            yield file_path, data
+
+
 def GEE_authorizing():
     # Initialize Google Earth Engine
+    import ee
     service_account = "lobstyu@premium-cipher-424203-d0.iam.gserviceaccount.com"
     credentials = ee.ServiceAccountCredentials(service_account, 'GEDI_elev_correction\\premium-cipher-424203-d0-c6894a29d00c.json')
     ee.Initialize(credentials)
     return 0
 
-def get_center_LC_batch(latitudes, longitudes, batch_size=500):
-    try:
-        # 计算点的估计大小，并调整 batch_size 以接近 10MB 限制
-        estimated_point_size = 200  # 每个点大约 200 字节
-        max_batch_size = 10485760 // estimated_point_size  # 计算最大 batch size
-
-        batch_size = min(batch_size, max_batch_size)  # 确保 batch_size 不超过最大限制
-
-        land_cover_values = []
-        total_points = len(latitudes)
-
-        for start in range(0, total_points, batch_size):
-            end = min(start + batch_size, total_points)
-            batch_lat = latitudes[start:end]
-            batch_lon = longitudes[start:end]
-
-            start_time = time.time()
-
-            # Create a FeatureCollection of points
-            points = ee.FeatureCollection(
-                [ee.Feature(ee.Geometry.Point([lon, lat])) for lat, lon in zip(batch_lat, batch_lon)])
-
-            # Landcover dataset
-            dataset = ee.ImageCollection("ESA/WorldCover/v100")
-            image = dataset.first()
-
-            land_cover = image.reduceRegions(
-                collection=points,
-                reducer=ee.Reducer.first(),
-                scale=10
-            )
-
-            batch_land_cover_values = []
-            for feature in land_cover.getInfo().get('features', []):
-
-                value = feature.get('properties', {}).get('first', -999)
-                batch_land_cover_values.append(value)
+def get_center_LC_batch(latitudes, longitudes, batch_size=500, max_workers=4, max_retries=3):
+    # Batches run concurrently and are retried one by one; a failed batch only loses its own points
+    land_cover_values = landcover.get_land_cover(latitudes, longitudes, 'gee', batch_size=batch_size,
+                                                 max_workers=max_workers, max_retries=max_retries)
+    return land_cover_values.tolist()
 
-            land_cover_values.extend(batch_land_cover_values)
-
-            end_time = time.time()
-            progress = (end / total_points) * 100
-            print(f"Batch {start // batch_size + 1}: API request took {end_time - start_time:.2f} seconds, Progress: {progress:.2f}%")
-
-        return land_cover_values
-    except Exception as e:
-        print(f"Error fetching land cover: {e}")
-        return [-999] * len(latitudes)
-    return 0
-
-def LC_selection(df, output_folder, beam, typeID):
+def LC_selection(df, output_folder, beam, typeID, coverage=None):
 
     filtered_df = df[(df['Land_Cover'] == typeID)]
+    metrics.count('part1.rejected.land_cover', len(df) - len(filtered_df))
+
+    # Drop footprints whose sample window is not fully inside 3DEP 1m coverage
+    if coverage is not None and len(filtered_df) > 0:
+        with metrics.timer('part1.coverage'):
+            covered = coverage.windows_covered(filtered_df['Latitude'].to_numpy(),
+                                               filtered_df['Longitude'].to_numpy(),
+                                               filtered_df['Smoothed_Tan'].to_numpy())
+        print(f"Skipped {np.count_nonzero(~covered)} of {len(filtered_df)} footprints outside 3DEP 1m coverage in {beam}")
+        metrics.count('part1.rejected.uncovered', np.count_nonzero(~covered))
+        filtered_df = filtered_df[covered]
+    metrics.count('part1.selected', len(filtered_df))
 
     # 保存筛选后的数据到新的CSV文件
     filtered_csv_file_path = os.path.join(output_folder, f"{beam}_Filtered_data.csv")
@@ -100,41 +118,80 @@ def LC_selection(df, output_folder, beam, typeID):
 
     return 0
 
-def extracting_GEDI_data():
+def extract_granule(file_path, data_GEDI, landcover_source='gee', tile_index=None, coverage=None,
+                    intermediate_format='csv', land_cover_class=60):
+    """Land cover and output files of one granule whose beams were read by get_center_data"""
+    directory_path = os.path.dirname(file_path)
+    file_name = os.path.basename(file_path)
+    output_folder = os.path.join(directory_path, os.path.splitext(file_name)[0])
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Land cover of all beams of the orbit in one pass
+    all_points = np.concatenate([ranged_data[:, :2] for ranged_data in data_GEDI.values()])
+    metrics.count('part1.footprints', len(all_points))
+    with metrics.timer('part1.land_cover'):
+        all_land_cover = landcover.get_land_cover(all_points[:, 0], all_points[:, 1], landcover_source, tile_index)
+    beam_sizes = np.cumsum([len(ranged_data) for ranged_data in data_GEDI.values()])[:-1]
+    beam_land_cover = dict(zip(data_GEDI, np.split(all_land_cover, beam_sizes)))
+
+    for beam, ranged_data in data_GEDI.items():
+        land_cover = beam_land_cover[beam]
+
+        # Landcover
+        ranged_data_with_lc = np.column_stack((ranged_data, land_cover))
+        data_GEDI[beam] = ranged_data_with_lc
+
+        # save csv file
+        df = pd.DataFrame(ranged_data_with_lc,
+                          columns=['Latitude', 'Longitude', 'Elevation', 'Instantaneous_Tan', 'Smoothed_Tan',
+                                   'Land_Cover'])
+        if intermediate_format == 'parquet':
+            # Land-cover selection happens in part 2 through predicate pushdown; coverage is kept as a column
+            if coverage is not None and len(df) > 0:
+                df['Covered'] = coverage.windows_covered(df['Latitude'].to_numpy(), df['Longitude'].to_numpy(),
+                                                         df['Smoothed_Tan'].to_numpy())
+            parquet_file_path = intermediate.write_footprints(df, os.path.splitext(file_name)[0], beam)
+            print(f"file_path:{file_path}")
+            print(f"Saved footprints to {parquet_file_path}")
+            continue
+
+        csv_file_path = os.path.join(output_folder, f"{beam}.csv")
+        df.to_csv(csv_file_path, index=False)
+
+        # typeID: 50-impervious，60-barren https://developers.google.com/earth-engine/datasets/catalog/ESA_WorldCover_v100
+        LC_selection(df, output_folder, beam, land_cover_class, coverage)
+
+        print(f"file_path:{file_path}")
+        print(f"Saved elev_diffs to {csv_file_path}")
+    return 0
+
+@metrics.stage('part1')
+def extracting_GEDI_data(max_workers=None, landcover_source='gee', worldcover_dir=None, coverage_file=None,
+                         intermediate_format='csv', land_cover_class=60):
+    # landcover_source: 'gee' (ESA/WorldCover/v100 through Earth Engine) or 'local' (WorldCover tiles in worldcover_dir)
+    # intermediate_format: 'csv' ({beam}.csv + {beam}_Filtered_data.csv per granule) or 'parquet' (all footprints
+    # of every land-cover class in the GEDI_data/footprints dataset, partitioned by orbit and beam)
     directory_path = 'GEDI_data'
     beams = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
 
-    GEE_authorizing()
-
-    for file_name in os.listdir(directory_path):
-        if file_name.endswith('.h5'):
-            file_path = os.path.join(directory_path, file_name)
-            data_GEDI = get_center_data(file_path, beams)
-
-            output_folder = os.path.join(directory_path, os.path.splitext(file_name)[0])
-            os.makedirs(output_folder, exist_ok=True)
-
-            for beam, ranged_data in data_GEDI.items():
-                latitudes = ranged_data[:, 0]
-                longitudes = ranged_data[:, 1]
-                land_cover = get_center_LC_batch(latitudes, longitudes)
-
-                # Landcover
-                ranged_data_with_lc = np.column_stack((ranged_data, land_cover))
-                data_GEDI[beam] = ranged_data_with_lc
-
-                # save csv file
-                df = pd.DataFrame(ranged_data_with_lc,
-                                  columns=['Latitude', 'Longitude', 'Elevation', 'Instantaneous_Tan', 'Smoothed_Tan',
-                                           'Land_Cover'])
-                csv_file_path = os.path.join(output_folder, f"{beam}.csv")
-                df.to_csv(csv_file_path, index=False)
-
-                # typeID: 50-impervious，60-barren https://developers.google.com/earth-engine/datasets/catalog/ESA_WorldCover_v100
-                LC_selection(df, output_folder, beam, 60)
-
-                print(f"file_path:{file_path}")
-                print(f"Saved elev_diffs to {csv_file_path}")
+    if landcover_source == 'gee':
+        GEE_authorizing()
+        tile_index = None
+    else:
+        tile_index = landcover.WorldCoverTileIndex(worldcover_dir)
+
+    # Optional 3DEP 1m coverage polygons / tile list, used to drop uncovered footprints before part 2
+    coverage = coverage_index.CoverageIndex.from_file(coverage_file) if coverage_file else None
+
+    file_paths = [os.path.join(directory_path, file_name) for file_name in os.listdir(directory_path)
+                  if file_name.endswith('.h5')]
+    # HDF5 reads of the next granules overlap with the land-cover lookups of the current one
+    # (part1.read_granule is the time spent waiting for them)
+    start = time.perf_counter()
+    for file_path, data_GEDI in ingest_granules(file_paths, beams, max_workers):
+        metrics.observe('part1.read_granule', time.perf_counter() - start)
+        with metrics.timer('part1.granule'):
+            extract_granule(file_path, data_GEDI, landcover_source, tile_index, coverage, intermediate_format,
+                            land_cover_class)
+        start = time.perf_counter()
     return 0
-
-
@@ -0,0 +1,100 @@
+"""Command line entry point: python -m GEDI_elev_correction [stage ...] [options]
+
+Stages run in the order given; only the modules of the selected stages are imported. Options a stage
+does not take are ignored for it, and options left out keep the defaults of the stage functions.
+
+    python -m GEDI_elev_correction part1 --landcover-source local --worldcover-dir WorldCover
+    python -m GEDI_elev_correction part2 part3 --elevation-source local --dem-path 3DEP_1m.vrt
+    python -m GEDI_elev_correction pipeline --max-workers 8
+"""
+import argparse
+import sys
+
+
+def _run_enqueue(**kwargs):
+    from GEDI_elev_correction import work_queue
+    work_queue.enqueue_part2(**kwargs)
+    return 0
+
+
+def _run_worker(**kwargs):
+    from GEDI_elev_correction import work_queue
+    return work_queue.run_worker(**kwargs)
+
+
+def _run_stage(name):
+    def run(**kwargs):
+        from GEDI_elev_correction import core
+        return getattr(core, f'run_{name}')(**kwargs)
+    return run
+
+
+# stage -> (runner, keyword arguments it takes)
+STAGES = {
+    'part1': (_run_stage('part1'), ['max_workers', 'landcover_source', 'worldcover_dir', 'coverage_file',
+                                    'intermediate_format', 'land_cover_class']),
+    'part2': (_run_stage('part2'), ['elevation_source', 'dem_path', 'dem_cache_dir', 'corridor_mode',
+                                    'coverage_file', 'cascade_mode', 'smoothing_method', 'storage',
+                                    'intermediate_format', 'land_cover_class']),
+    'part3': (_run_stage('part3'), ['max_workers', 'intermediate_format', 'bootstrap_resamples', 'estimator']),
+    'part4': (_run_stage('part4'), ['max_workers', 'force']),
+    'pipeline': (_run_stage('pipeline'), ['max_workers', 'elevation_source', 'dem_path', 'dem_cache_dir',
+                                          'landcover_source', 'worldcover_dir', 'coverage_file',
+                                          'land_cover_class', 'corridor_mode', 'smoothing_method',
+                                          'bootstrap_resamples', 'estimator']),
+    'enqueue': (_run_enqueue, ['db_path']),
+    'worker': (_run_worker, ['db_path', 'elevation_source', 'dem_path', 'dem_cache_dir', 'corridor_mode',
+                             'coverage_file', 'smoothing_method']),
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m GEDI_elev_correction',
+                                     description='GEDI L2A geolocation offsets from 3DEP 1 m elevation.')
+    parser.add_argument('stages', nargs='+', choices=list(STAGES),
+                        help='part1: extract footprints, part2: elevation differences, part3: 2D Gaussian fit, '
+                             'part4: figures, pipeline: incremental run of all parts, enqueue/worker: '
+                             'distributed part 2')
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--landcover-source', choices=['gee', 'local'])
+    parser.add_argument('--worldcover-dir')
+    parser.add_argument('--elevation-source', choices=['gee', 'local'])
+    parser.add_argument('--dem-path')
+    parser.add_argument('--dem-cache-dir', help='cache DEM samples here, snapped to a 1 m UTM lattice (opt-in)')
+    parser.add_argument('--coverage-file')
+    parser.add_argument('--land-cover-class', type=int)
+    parser.add_argument('--intermediate-format', choices=['csv', 'parquet'])
+    parser.add_argument('--smoothing-method', choices=['direct', 'fft'])
+    parser.add_argument('--storage', choices=['npy', 'h5'])
+    parser.add_argument('--corridor', dest='corridor_mode', action='store_true', default=None)
+    parser.add_argument('--cascade', dest='cascade_mode', action='store_true', default=None)
+    parser.add_argument('--estimator', choices=['least_squares', 'quadratic', 'moment', 'grid_search', 'hybrid'],
+                        help='part3: offset estimator (default least_squares)')
+    parser.add_argument('--bootstrap-resamples', type=int,
+                        help='part3: add bootstrap confidence intervals of the offsets from this many resamples')
+    parser.add_argument('--force', action='store_true', default=None, help='part4: re-render up-to-date figures')
+    parser.add_argument('--queue', dest='db_path', help='SQLite file of the part 2 work queue')
+    parser.add_argument('--metrics-dir', help='write per-stage timers, counters and histograms as JSON lines here')
+    parser.add_argument('--profile-interval', type=float,
+                        help='with --metrics-dir: sample the stacks of all threads every this many seconds')
+    return parser
+
+
+def main(argv=None):
+    args = vars(build_parser().parse_args(argv))
+    metrics_dir, profile_interval = args.pop('metrics_dir'), args.pop('profile_interval')
+    if metrics_dir is not None:
+        from GEDI_elev_correction import metrics
+        print(f"Writing metrics to {metrics.enable(metrics_dir, profile_interval)}")
+    for stage in args.pop('stages'):
+        run, accepted = STAGES[stage]
+        kwargs = {name: args[name] for name in accepted if args[name] is not None}
+        status = run(**kwargs)
+        if status:
+            print(f"{stage} failed with status {status}")
+            return status
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
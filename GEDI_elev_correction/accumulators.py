@@ -0,0 +1,75 @@
+import os
+import numpy as np
+
+
+class GridAccumulator:
+    """Running per-cell sum, sum of squares and count of a stack of footprint grids
+
+    Holds everything part 3 needs (nanmean, variance and the number of footprints n) in a few
+    grid-sized arrays, independent of how many footprints the beam has.
+    """
+
+    def __init__(self, shape=(71, 71)):
+        self.shape = tuple(shape)
+        self.sum = np.zeros(self.shape)
+        self.sum_sq = np.zeros(self.shape)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self.n = 0
+
+    def add(self, stack):
+        """Add a (k, *shape) stack of grids; NaN cells are skipped like in np.nanmean"""
+        stack = np.asarray(stack, dtype=np.float64)
+        if stack.shape[0] == 0:
+            return
+        valid = ~np.isnan(stack)
+        values = np.where(valid, stack, 0.0)
+        self.sum += values.sum(axis=0)
+        self.sum_sq += (values ** 2).sum(axis=0)
+        self.count += valid.sum(axis=0)
+        self.n += stack.shape[0]
+
+    def merge(self, other):
+        """Add the footprints accumulated by another GridAccumulator (e.g. of another shard of the beam)"""
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.count += other.count
+        self.n += other.n
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.sum / self.count, np.nan)
+
+    def variance(self):
+        """Per-cell population variance (ddof=0, as np.nanvar)"""
+        mean = self.mean()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.maximum(np.where(self.count > 0, self.sum_sq / self.count, np.nan) - mean ** 2, 0.0)
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, sum=self.sum, sum_sq=self.sum_sq, count=self.count, n=self.n)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            accumulator = cls(data['sum'].shape)
+            accumulator.sum = data['sum']
+            accumulator.sum_sq = data['sum_sq']
+            accumulator.count = data['count']
+            accumulator.n = int(data['n'])
+        return accumulator
+
+    @classmethod
+    def from_stack(cls, stack, chunk_size=256, transform=None):
+        """Accumulate an (N, *shape) array chunk by chunk, e.g. a memory-mapped .npy"""
+        accumulator = cls(stack.shape[1:] if stack.ndim == 3 else ())
+        for start in range(0, stack.shape[0] if stack.ndim == 3 else 0, chunk_size):
+            chunk = np.asarray(stack[start:start + chunk_size])
+            accumulator.add(chunk if transform is None else transform(chunk))
+        return accumulator
+
+    @classmethod
+    def from_npy(cls, path, chunk_size=256):
+        """Fallback for beams processed before accumulators existed: stream an existing .npy stack"""
+        return cls.from_stack(np.load(path, mmap_mode='r'), chunk_size)
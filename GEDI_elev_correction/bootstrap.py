@@ -0,0 +1,83 @@
+import numpy as np
+import h5py
+from contextlib import contextmanager
+from GEDI_elev_correction import Calculating_2D_Gaussian, metrics
+
+N_RESAMPLES = 500
+CONFIDENCE = 0.95
+
+
+@contextmanager
+def _open_stack(path):
+    """The beam's (N, 71, 71) footprint stack, memory-mapped (.npy) or as an h5py dataset (.h5)"""
+    if path.endswith('.h5'):
+        with h5py.File(path, 'r') as f:
+            yield f['elev_diffs']
+    else:
+        yield np.load(path, mmap_mode='r')
+
+
+def resampled_means(path, n_resamples=N_RESAMPLES, chunk_size=256, seed=0):
+    """(n_resamples, *grid) mean |elev_diff| grids of bootstrap resamples of the beam's footprints
+
+    Uses the Poisson bootstrap: every footprint enters each resample Poisson(1) times, so the weights of a
+    chunk of footprints can be drawn independently of the others. The stack is read once, chunk by chunk,
+    and each chunk adds (n_resamples x chunk) weights @ (chunk x cells) to the per-resample sums and valid
+    counts, i.e. all resamples are formed with two matrix products per chunk. NaN cells are skipped like in
+    GridAccumulator.mean().
+    """
+    rng = np.random.default_rng(seed)
+    with _open_stack(path) as stack:
+        shape = stack.shape[1:]
+        sums = np.zeros((n_resamples, int(np.prod(shape))))
+        counts = np.zeros_like(sums)
+        for start in range(0, stack.shape[0], chunk_size):
+            chunk = np.abs(np.asarray(stack[start:start + chunk_size], dtype=np.float64)).reshape(-1, sums.shape[1])
+            valid = ~np.isnan(chunk)
+            weights = rng.poisson(1.0, size=(n_resamples, chunk.shape[0])).astype(np.float64)
+            sums += weights @ np.where(valid, chunk, 0.0)
+            counts += weights @ valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan).reshape((n_resamples,) + shape)
+
+
+def offset_intervals(x0s, y0s, confidence=CONFIDENCE):
+    """Percentile confidence intervals and standard errors of the resampled offsets"""
+    tail = (1 - confidence) / 2 * 100
+    x_low, x_high = np.percentile(x0s, [tail, 100 - tail])
+    y_low, y_high = np.percentile(y0s, [tail, 100 - tail])
+    return {'adjusted_x_ci_low': x_low, 'adjusted_x_ci_high': x_high,
+            'adjusted_y_ci_low': y_low, 'adjusted_y_ci_high': y_high,
+            'adjusted_x_se': np.std(x0s, ddof=1), 'adjusted_y_se': np.std(y0s, ddof=1)}
+
+
+def bootstrap_beam(job, fit, n_resamples=N_RESAMPLES, confidence=CONFIDENCE, max_workers=None, chunk_size=256,
+                   seed=0, bounds=None, estimator='least_squares'):
+    """Bootstrap confidence intervals of the offset of one fitted beam (a collect_beam_job job and its fit)
+
+    Every resampled grid is fitted starting from the parameters of the beam's own fit, which is close to
+    the resampled optimum, in one batched call spread over a process pool (with the given part 3
+    estimator, so a fast estimator also makes the bootstrap fast). Returns the interval columns
+    plus bootstrap_n/bootstrap_failed and the confidence level, or None when the beam fit failed.
+    bounds defaults to Calculating_2D_Gaussian.FIT_BOUNDS (looked up on call, as that module imports this one).
+    """
+    root, file_path, beam_name = job[:3]
+    if fit['x0'] is None:
+        return None
+    with metrics.timer('part3.bootstrap.resample'):
+        grids = resampled_means(file_path, n_resamples, chunk_size, seed)
+    warm_start = (fit['x0'], fit['y0'], fit['sigma_x'], fit['sigma_y'], fit['A'])
+    with metrics.timer('part3.bootstrap.fit'):
+        fits = Calculating_2D_Gaussian.fit_2d_inverted_gaussian_batch(
+            grids, [(job[5], job[6])] * n_resamples, [warm_start] * n_resamples, max_workers=max_workers,
+            bounds=Calculating_2D_Gaussian.FIT_BOUNDS if bounds is None else bounds, estimator=estimator)
+    x0s = np.array([f['x0'] for f in fits if f['x0'] is not None])
+    y0s = np.array([f['y0'] for f in fits if f['y0'] is not None])
+    metrics.count('part3.bootstrap.fits', len(fits))
+    metrics.count('part3.bootstrap.failed', len(fits) - len(x0s))
+    if len(x0s) < 2:
+        print(f'Bootstrap fits failed in {beam_name} of {file_path}.')
+        return {'bootstrap_n': len(x0s), 'bootstrap_failed': len(fits) - len(x0s)}
+    intervals = offset_intervals(x0s, y0s, confidence)
+    intervals.update(bootstrap_n=len(x0s), bootstrap_failed=len(fits) - len(x0s), ci_level=confidence)
+    return intervals
@@ -0,0 +1,87 @@
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from GEDI_elev_correction import offset_grid, elevation_sources, smoothing
+
+
+class CascadeScreen:
+    """Coarse first pass of the ±15 m outlier test, run before the dense 91x91 fetch
+
+    Each footprint's window is sampled on a sparse lattice (every coarse_step cells plus the centre and
+    the last row/column, so the corners are included), bilinearly upsampled to 91x91 and smoothed/cropped
+    exactly like get_elev_diffs_from_dems. A footprint is rejected early when
+      * a lattice point has no data (the dense window would contain NaN as well), or
+      * the estimated |elev_GEDI - elev_3DEP| exceeds threshold + margin somewhere in the 71x71 crop.
+    A validate_fraction of the early rejections still gets the dense evaluation so that stats() can report
+    how often the coarse screen disagrees with it.
+    """
+
+    def __init__(self, margin=3.0, coarse_step=15, threshold=15, validate_fraction=0.0, spacing=1, extent=35,
+                 buffer_extent=10, seed=0):
+        self.margin = margin
+        self.threshold = threshold
+        self.validate_fraction = validate_fraction
+        self.spacing = spacing
+        self.extent = extent
+        self.buffer_extent = buffer_extent
+        self._rng = np.random.default_rng(seed)
+
+        offsets = offset_grid.get_offset_axis(spacing, extent, buffer_extent)
+        n = offsets.size
+        self.n = n
+        self.lattice = np.unique(np.r_[np.arange(0, n, coarse_step), n // 2, n - 1])
+        self._xx, self._yy = np.meshgrid(offsets[self.lattice], offsets[self.lattice])
+        rows, cols = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+        self._dense_cells = np.column_stack((rows.ravel(), cols.ravel()))
+
+        self.screened = 0
+        self.coarse_rejected = 0
+        self.validated = 0
+        self.disagreements = 0
+        self.survivors = 0
+        self.survivors_rejected = 0
+
+    def estimate_windows(self, coarse):
+        """Upsample (N, k, k) lattice samples to (N, n, n) windows by bilinear interpolation"""
+        values = np.moveaxis(coarse, 0, -1)
+        interpolator = RegularGridInterpolator((self.lattice, self.lattice), values, method='linear')
+        return np.moveaxis(interpolator(self._dense_cells).reshape(self.n, self.n, -1), -1, 0)
+
+    def screen(self, center_lats, center_lons, tan_directions, elev_GEDI, elevation_source):
+        """Returns (rejected, number of points requested) for a block of footprints"""
+        points_lat, points_lon = offset_grid.get_offset_points(center_lats, center_lons, tan_directions,
+                                                               self._xx, self._yy)
+        coarse = elevation_sources.sample_allowing_failures(elevation_source, points_lat.ravel(), points_lon.ravel())
+        coarse = coarse.reshape(points_lat.shape)
+
+        rejected = np.isnan(coarse).any(axis=(1, 2))
+        estimable = np.flatnonzero(~rejected)
+        if estimable.size:
+            # Same smoothing and crop as get_elev_diffs_from_dems
+            elev_3DEP = smoothing.smooth_and_crop(self.estimate_windows(coarse[estimable]),
+                                                  crop=self.buffer_extent // self.spacing)
+            elev_diffs = np.asarray(elev_GEDI)[estimable, np.newaxis, np.newaxis] - elev_3DEP
+            rejected[estimable] = np.abs(elev_diffs).max(axis=(1, 2)) > self.threshold + self.margin
+
+        self.screened += rejected.size
+        self.coarse_rejected += int(np.count_nonzero(rejected))
+        return rejected, coarse.size
+
+    def pick_validation(self, rejected):
+        """Early rejections that should still be evaluated densely"""
+        return rejected & (self._rng.random(rejected.size) < self.validate_fraction)
+
+    def record(self, coarse_rejected, accepted):
+        """Record the dense outcome of a footprint that was evaluated after the screen"""
+        if coarse_rejected:
+            self.validated += 1
+            self.disagreements += bool(accepted)
+        else:
+            self.survivors += 1
+            self.survivors_rejected += not accepted
+
+    def stats(self):
+        return {'screened': self.screened, 'coarse_rejected': int(self.coarse_rejected),
+                'rejection_rate': self.coarse_rejected / self.screened if self.screened else 0.0,
+                'validated': self.validated, 'disagreements': self.disagreements,
+                'disagreement_rate': self.disagreements / self.validated if self.validated else 0.0,
+                'survivors_rejected': self.survivors_rejected}
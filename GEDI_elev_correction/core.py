@@ -1,22 +1,34 @@
-from GEDI_elev_correction import Load_GEDI_L2A_files, Calculating_elev_diffs, Calculating_2D_Gaussian
-from GEDI_elev_correction import plot_bullseye, plot_timeseries
+# Each stage imports its own modules when it runs, so importing core (or selecting one stage from the
+# command line) never loads Earth Engine, matplotlib or pyarrow for the other stages.
 
 
-def run_part1():
-    Load_GEDI_L2A_files.extracting_GEDI_data()
+def run_part1(**kwargs):
+    from GEDI_elev_correction import Load_GEDI_L2A_files
+    Load_GEDI_L2A_files.extracting_GEDI_data(**kwargs)
     return 0
 
 
-def run_part2():
-    Calculating_elev_diffs.calculating_elev_diffs()
+def run_part2(**kwargs):
+    from GEDI_elev_correction import Calculating_elev_diffs
+    Calculating_elev_diffs.calculating_elev_diffs(**kwargs)
     return 0
 
 
-def run_part3():
-    Calculating_2D_Gaussian.calculating_2d_gaussian()
+def run_part3(**kwargs):
+    from GEDI_elev_correction import Calculating_2D_Gaussian
+    Calculating_2D_Gaussian.calculating_2d_gaussian(**kwargs)
     return 0
 
-def run_part4():
-    plot_bullseye.plot_bullseye()
-    plot_timeseries.plot_timeseries()
-    return 0
\ No newline at end of file
+def run_part4(max_workers=None, force=False):
+    from GEDI_elev_correction import plot_bullseye, plot_timeseries
+    plot_bullseye.plot_bullseye(max_workers=max_workers, force=force)
+    plot_timeseries.plot_timeseries(force=force)
+    return 0
+
+
+def run_pipeline(**kwargs):
+    # Incremental run of all four parts: only tasks whose inputs, parameters or code changed are recomputed
+    # Returns 1 when a task failed (the task counts are printed by the pipeline), else 0
+    from GEDI_elev_correction import pipeline
+    counts = pipeline.run_pipeline(**kwargs)
+    return 1 if counts['failed'] else 0
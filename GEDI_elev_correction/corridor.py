@@ -0,0 +1,72 @@
+import numpy as np
+import pyproj
+from scipy.ndimage import map_coordinates
+from GEDI_elev_correction import offset_grid, elevation_sources
+
+_GEOD = pyproj.Geod(ellps='WGS84')
+
+
+def split_runs(latitudes, longitudes, max_gap=90, max_run=64):
+    """Split a beam into runs of consecutive footprints whose centres are at most max_gap metres apart"""
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    if latitudes.size == 0:
+        return []
+    _, _, gaps = _GEOD.inv(longitudes[:-1], latitudes[:-1], longitudes[1:], latitudes[1:])
+    breaks = np.flatnonzero(np.asarray(gaps) > max_gap) + 1
+    runs = []
+    for run in np.split(np.arange(latitudes.size), breaks):
+        runs.extend(np.array_split(run, int(np.ceil(run.size / max_run))))
+    return runs
+
+
+def fetch_corridor_elevations(center_lats, center_lons, tan_directions, elevation_source,
+                              spacing=1, extent=35, buffer_extent=10, margin=2):
+    """Elevation windows for a run of consecutive footprints from one shared DEM strip
+
+    The strip is a regular grid (at `spacing`) in a local transverse Mercator frame, aligned with the
+    run from its first to its last footprint and just wide enough to hold every rotated window.
+    Each footprint's 91x91 window is then resampled from the strip with bilinear interpolation.
+    Returns (elevation windows of shape (N, n, n) with NaN where the source has no data, number of
+    points requested from the source).
+    """
+    center_lats = np.atleast_1d(np.asarray(center_lats, dtype=float))
+    center_lons = np.atleast_1d(np.asarray(center_lons, dtype=float))
+    points_lat, points_lon = offset_grid.get_offset_grids(center_lats, center_lons, tan_directions,
+                                                          spacing, extent, buffer_extent)
+
+    local_crs = pyproj.CRS.from_proj4(f"+proj=tmerc +lat_0={center_lats.mean()} +lon_0={center_lons.mean()} "
+                                      f"+k=1 +x_0=0 +y_0=0 +ellps=WGS84 +units=m")
+    to_local = pyproj.Transformer.from_crs("EPSG:4326", local_crs, always_xy=True)
+    cx, cy = to_local.transform(center_lons, center_lats)
+    axis = np.array([cx[-1] - cx[0], cy[-1] - cy[0]])
+    if np.hypot(*axis) < spacing:
+        # A single footprint (or a stationary run): the strip would just be the window itself
+        elevations = elevation_sources.sample_allowing_failures(elevation_source, points_lat.ravel(),
+                                                                points_lon.ravel())
+        return elevations.reshape(points_lat.shape), elevations.size
+    ex, ey = axis / np.hypot(*axis)
+
+    # Window points in strip coordinates (u along the run, v across it)
+    px, py = to_local.transform(points_lon, points_lat)
+    u = (px - cx[0]) * ex + (py - cy[0]) * ey
+    v = -(px - cx[0]) * ey + (py - cy[0]) * ex
+
+    u_axis = np.arange(np.floor(u.min()) - margin, np.ceil(u.max()) + margin + spacing, spacing)
+    v_axis = np.arange(np.floor(v.min()) - margin, np.ceil(v.max()) + margin + spacing, spacing)
+    if u_axis.size * v_axis.size >= points_lat.size:
+        # Footprints too sparse or too curved for the strip to save anything
+        elevations = elevation_sources.sample_allowing_failures(elevation_source, points_lat.ravel(),
+                                                                points_lon.ravel())
+        return elevations.reshape(points_lat.shape), elevations.size
+
+    uu, vv = np.meshgrid(u_axis, v_axis)
+    strip_lon, strip_lat = to_local.transform(cx[0] + uu * ex - vv * ey, cy[0] + uu * ey + vv * ex,
+                                              direction=pyproj.enums.TransformDirection.INVERSE)
+    strip = elevation_sources.sample_allowing_failures(elevation_source, strip_lat.ravel(), strip_lon.ravel())
+    strip = strip.reshape(uu.shape)
+
+    rows = (v - v_axis[0]) / spacing
+    cols = (u - u_axis[0]) / spacing
+    elevations = map_coordinates(strip, [rows.ravel(), cols.ravel()], order=1, mode='constant', cval=np.nan)
+    return elevations.reshape(points_lat.shape), strip.size
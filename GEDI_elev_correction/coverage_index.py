@@ -0,0 +1,83 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from GEDI_elev_correction import offset_grid
+
+BOUNDS_COLUMNS = [('minx', 'miny', 'maxx', 'maxy'), ('xmin', 'ymin', 'xmax', 'ymax'), ('west', 'south', 'east', 'north')]
+
+
+def _rectangle(west, south, east, north):
+    return np.array([[west, south], [east, south], [east, north], [west, north], [west, south]])
+
+
+class CoverageIndex:
+    """Grid-bucket index of 3DEP 1 m coverage polygons (WGS-84 lon/lat) for bulk point queries
+
+    Every polygon is registered in the cell_size-degree cells its bounding box touches; a query only
+    runs point-in-polygon tests against the polygons of the cells its points fall in.
+    """
+
+    def __init__(self, polygons, cell_size=0.5):
+        from matplotlib.path import Path
+        self.cell_size = cell_size
+        self.paths = []
+        self.cells = {}
+        for rings in polygons:
+            path = Path.make_compound_path(*[Path(np.asarray(ring, dtype=float)[:, :2]) for ring in rings])
+            polygon_id = len(self.paths)
+            self.paths.append(path)
+            (west, south), (east, north) = path.get_extents().get_points()
+            for i in range(int(np.floor(west / cell_size)), int(np.floor(east / cell_size)) + 1):
+                for j in range(int(np.floor(south / cell_size)), int(np.floor(north / cell_size)) + 1):
+                    self.cells.setdefault((i, j), []).append(polygon_id)
+
+    @classmethod
+    def from_file(cls, coverage_file, cell_size=0.5):
+        """Load a GeoJSON of coverage (Multi)Polygons, or a CSV tile list with minx/miny/maxx/maxy columns"""
+        if os.path.splitext(coverage_file)[1].lower() in ('.geojson', '.json'):
+            with open(coverage_file) as f:
+                features = json.load(f)['features']
+            polygons = []
+            for feature in features:
+                geometry = feature['geometry']
+                if geometry['type'] == 'Polygon':
+                    polygons.append(geometry['coordinates'])
+                elif geometry['type'] == 'MultiPolygon':
+                    polygons.extend(geometry['coordinates'])
+        else:
+            tiles = pd.read_csv(coverage_file)
+            columns = next((names for names in BOUNDS_COLUMNS if set(names) <= set(tiles.columns)), None)
+            if columns is None:
+                raise ValueError(f"{coverage_file} needs one of the column sets {BOUNDS_COLUMNS}")
+            polygons = [[_rectangle(*bounds)] for bounds in tiles[list(columns)].to_numpy()]
+        print(f"Loaded {len(polygons)} 3DEP coverage polygons from {coverage_file}")
+        return cls(polygons, cell_size)
+
+    def contains(self, latitudes, longitudes):
+        latitudes = np.asarray(latitudes, dtype=float).ravel()
+        longitudes = np.asarray(longitudes, dtype=float).ravel()
+        covered = np.zeros(latitudes.size, dtype=bool)
+        cell_i = np.floor(longitudes / self.cell_size).astype(np.int64)
+        cell_j = np.floor(latitudes / self.cell_size).astype(np.int64)
+        for i, j in set(zip(cell_i.tolist(), cell_j.tolist())):
+            in_cell = np.flatnonzero((cell_i == i) & (cell_j == j))
+            for polygon_id in self.cells.get((i, j), []):
+                todo = in_cell[~covered[in_cell]]
+                if todo.size == 0:
+                    break
+                points = np.column_stack((longitudes[todo], latitudes[todo]))
+                covered[todo] = self.paths[polygon_id].contains_points(points)
+        return covered
+
+    def windows_covered(self, center_lats, center_lons, tan_directions, spacing=1, extent=35, buffer_extent=10):
+        """True for footprints whose whole 91x91 sample window lies in coverage
+
+        Checks the centre, the four corners and the four edge midpoints of each rotated window.
+        """
+        half = extent + buffer_extent
+        probe = np.array([-half, 0, half])
+        xx, yy = np.meshgrid(probe, probe)
+        points_lat, points_lon = offset_grid.get_offset_points(center_lats, center_lons, tan_directions, xx, yy)
+        covered = self.contains(points_lat.ravel(), points_lon.ravel()).reshape(points_lat.shape)
+        return covered.all(axis=(1, 2))
@@ -0,0 +1,229 @@
+import os
+import time
+import numpy as np
+import pyproj
+from GEDI_elev_correction.elevation_sources import ElevationSource, ElevationFetchError
+from GEDI_elev_correction import metrics
+
+# Tile cells that were fetched but have no 3DEP data; NaN marks cells that were never fetched
+_NODATA = np.float32(np.inf)
+
+
+class DEMTileCache:
+    """On-disk cache of DEM samples, stored as memory-mapped UTM tiles
+
+    Requested points are snapped to the centres of a `resolution` metre lattice in their WGS-84 UTM
+    zone, and the lattice is split into tile_size x tile_size tiles, each kept as one float32 .npy file
+    opened with np.load(mmap_mode). Only cells that are not cached yet are requested from the backend.
+    This lattice is not the NAD83 grid of 3DEP 1 m, so cached samples can differ from sampling the exact
+    points (the cache is therefore opt-in in part 2).
+
+    Tiles are evicted least-recently-used once the cache grows past max_bytes; file mtimes record use, so
+    several processes can share one cache directory. Each process re-measures the size on disk every time
+    it has written check_fraction * max_bytes of new tiles, so tiles written by other processes count too.
+    """
+
+    def __init__(self, cache_dir=os.path.join('GEDI_data', 'dem_cache'), max_bytes=4 * 1024 ** 3,
+                 tile_size=256, resolution=1.0, lock_timeout=60, check_fraction=1 / 64):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.resolution = resolution
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._transformers = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._check_bytes = max_bytes * check_fraction
+        # Bytes of new tiles written by this process since the size on disk was last measured
+        self._written = 0
+        self.check_size()
+
+    def _transformer(self, zone):
+        if zone not in self._transformers:
+            self._transformers[zone] = pyproj.Transformer.from_crs("EPSG:4326", f"EPSG:{32600 + zone}", always_xy=True)
+        return self._transformers[zone]
+
+    def _tile_path(self, zone, tx, ty):
+        return os.path.join(self.cache_dir, f'{zone:02d}', f'{tx}_{ty}.npy')
+
+    def _tiles(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith('.npy'):
+                    path = os.path.join(root, file)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_mtime, stat.st_size
+
+    def _lock(self, path):
+        # Portable lock file: O_EXCL creation is atomic on local and network filesystems alike
+        lock_path = path + '.lock'
+        start = time.time()
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return lock_path
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > self.lock_timeout:
+                        os.remove(lock_path)  # left behind by a crashed process
+                        continue
+                except OSError:
+                    continue
+                if time.time() - start > self.lock_timeout:
+                    raise TimeoutError(f"Could not lock DEM cache tile {path}")
+                time.sleep(0.05)
+
+    def _read_tile(self, path):
+        try:
+            tile = np.load(path, mmap_mode='r')
+            os.utime(path)  # mark as recently used
+            return tile
+        except (OSError, ValueError):
+            return None
+
+    def _write_tile(self, path, rows, cols, values):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_path = self._lock(path)
+        try:
+            if os.path.exists(path):
+                tile = np.load(path, mmap_mode='r+')
+            else:
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                tile = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                                 shape=(self.tile_size, self.tile_size))
+                tile[:] = np.nan
+                tile.flush()
+                del tile
+                os.replace(tmp_path, path)
+                self._written += os.path.getsize(path)
+                tile = np.load(path, mmap_mode='r+')
+            tile[rows, cols] = values
+            tile.flush()
+            del tile
+        finally:
+            os.remove(lock_path)
+
+    def check_size(self):
+        """Measure the cache on disk (tiles of every process) and evict if it is over max_bytes"""
+        self._written = 0
+        if sum(size for _, _, size in self._tiles()) > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least-recently-used tiles until the cache is back under 90% of max_bytes"""
+        tiles = sorted(self._tiles(), key=lambda item: item[1])
+        total = sum(size for _, _, size in tiles)
+        for path, _, size in tiles:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # still mapped by another process (Windows)
+            total -= size
+            self.evictions += 1
+            metrics.count('dem_cache.evictions')
+
+    def sample(self, latitudes, longitudes, fetch):
+        """Elevations at the given points, calling fetch(lats, lons) only for cells not cached yet"""
+        latitudes = np.asarray(latitudes, dtype=float).ravel()
+        longitudes = np.asarray(longitudes, dtype=float).ravel()
+        values = np.full(latitudes.size, np.nan, dtype=np.float32)
+        failed = np.zeros(latitudes.size, dtype=bool)
+        zones = (np.floor((longitudes + 180) / 6).astype(np.int64) % 60) + 1
+
+        for zone in np.unique(zones):
+            in_zone = np.flatnonzero(zones == zone)
+            x, y = self._transformer(zone).transform(longitudes[in_zone], latitudes[in_zone])
+            ix = np.floor(np.asarray(x) / self.resolution).astype(np.int64)
+            iy = np.floor(np.asarray(y) / self.resolution).astype(np.int64)
+            tx, ty = ix // self.tile_size, iy // self.tile_size
+
+            tile_keys = np.stack((tx, ty), axis=1)
+            unique_tiles, tile_index = np.unique(tile_keys, axis=0, return_inverse=True)
+            tile_index = tile_index.ravel()
+            missing = []
+            for t, (tile_x, tile_y) in enumerate(unique_tiles):
+                members = np.flatnonzero(tile_index == t)
+                rows = iy[members] - tile_y * self.tile_size
+                cols = ix[members] - tile_x * self.tile_size
+                tile = self._read_tile(self._tile_path(zone, tile_x, tile_y))
+                if tile is not None:
+                    values[in_zone[members]] = tile[rows, cols]
+                missing.append(members[np.isnan(values[in_zone[members]])])
+
+            missing = np.concatenate(missing)
+            self.hits += in_zone.size - missing.size
+            self.misses += missing.size
+            metrics.count('dem_cache.hits', in_zone.size - missing.size)
+            metrics.count('dem_cache.misses', missing.size)
+            if missing.size == 0:
+                continue
+
+            # Fetch each missing lattice cell once, at its centre
+            cells, cell_index = np.unique(np.stack((ix[missing], iy[missing]), axis=1), axis=0, return_inverse=True)
+            cell_lon, cell_lat = self._transformer(zone).transform(
+                (cells[:, 0] + 0.5) * self.resolution, (cells[:, 1] + 0.5) * self.resolution,
+                direction=pyproj.enums.TransformDirection.INVERSE)
+            try:
+                fetched = np.asarray(fetch(np.asarray(cell_lat), np.asarray(cell_lon)), dtype=np.float32)
+                fetch_failed = np.zeros(fetched.size, dtype=bool)
+            except ElevationFetchError as e:
+                if e.values is None:
+                    raise
+                fetched = np.asarray(e.values, dtype=np.float32)
+                fetch_failed = np.asarray(e.failed, dtype=bool)
+            fetched[np.isnan(fetched) & ~fetch_failed] = _NODATA
+            values[in_zone[missing]] = fetched[cell_index.ravel()]
+            failed[in_zone[missing]] = fetch_failed[cell_index.ravel()]
+
+            # Failed cells stay NaN in the tiles, so they are fetched again next time
+            keep = ~fetch_failed
+            cells, fetched = cells[keep], fetched[keep]
+
+            cell_tx, cell_ty = cells[:, 0] // self.tile_size, cells[:, 1] // self.tile_size
+            for tile_x, tile_y in np.unique(np.stack((cell_tx, cell_ty), axis=1), axis=0):
+                members = np.flatnonzero((cell_tx == tile_x) & (cell_ty == tile_y))
+                self._write_tile(self._tile_path(zone, tile_x, tile_y),
+                                 cells[members, 1] - tile_y * self.tile_size,
+                                 cells[members, 0] - tile_x * self.tile_size,
+                                 fetched[members])
+
+        if self._written >= self._check_bytes:
+            self.check_size()
+
+        values = values.astype(float)
+        values[np.isinf(values)] = np.nan
+        if np.any(failed):
+            raise ElevationFetchError(f"Error fetching elevation data for {np.count_nonzero(failed)} points",
+                                      values=values, failed=failed)
+        return values
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate, 'evictions': self.evictions}
+
+
+class CachedElevationSource(ElevationSource):
+    """Any elevation backend, served through a DEMTileCache"""
+
+    def __init__(self, source, cache):
+        self.source = source
+        self.cache = cache
+        self.name = f'cached_{source.name}'
+        self.cache_key = source.cache_key
+
+    def sample(self, latitudes, longitudes):
+        return self.cache.sample(latitudes, longitudes, self.source.sample)
+
+    def stats(self):
+        return {**self.source.stats(), **self.cache.stats()}
+
+    def close(self):
+        self.source.close()
@@ -0,0 +1,137 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+import numpy as np
+import rasterio
+import pyproj
+from GEDI_elev_correction import request_scheduler, raster_sampling
+
+
+class ElevationFetchError(Exception):
+    """A backend request failed; unlike missing data (NaN), the result must not be cached
+
+    values holds whatever was fetched (NaN for the failed points) and failed marks the failed points.
+    """
+
+    def __init__(self, message, values=None, failed=None):
+        super().__init__(message)
+        self.values = values
+        self.failed = failed
+
+
+class ElevationSource(ABC):
+    """Interface of the 3DEP elevation backends used by part 2
+
+    sample() takes flat arrays of WGS-84 latitudes/longitudes and returns a float array of
+    elevations of the same length, with NaN wherever the source has no data. Failed requests
+    raise ElevationFetchError.
+    """
+    name = 'base'
+    cache_key = 'base'
+
+    @abstractmethod
+    def sample(self, latitudes, longitudes):
+        pass
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class GEEElevationSource(ElevationSource):
+    """USGS/3DEP/1m mosaic sampled through Earth Engine reduceRegions
+
+    Requests go through a RequestScheduler, so the points of many footprints can be passed to
+    sample() at once. send replaces the reduceRegions call, e.g. with a local mock endpoint.
+    """
+    name = 'gee'
+
+    def __init__(self, collection="USGS/3DEP/1m", scale=1, send=None, **scheduler_kwargs):
+        self.collection = collection
+        self.scale = scale
+        self.cache_key = f"gee_{collection.replace('/', '_')}_{scale}m"
+        scheduler_kwargs.setdefault('name', 'elevation_requests')
+        self.scheduler = request_scheduler.RequestScheduler(send or self.fetch_batch, **scheduler_kwargs)
+
+    def fetch_batch(self, latitudes, longitudes):
+        import ee
+        points = ee.FeatureCollection([ee.Feature(ee.Geometry.Point([lon, lat])) for lat, lon in zip(latitudes, longitudes)])
+
+        # Define the 3DEP dataset
+        dataset = ee.ImageCollection(self.collection)
+        image = dataset.mosaic()
+
+        # Get the elevation at the points
+        elevations = image.reduceRegions(
+            collection=points,
+            reducer=ee.Reducer.first(),
+            scale=self.scale  # Use 1 meter scale since 3DEP data is at 1m resolution
+        )
+
+        # Extract the results
+        elevation_values = []
+        for feature in elevations.getInfo().get('features', []):
+            value = feature.get('properties', {}).get('first')
+            elevation_values.append(np.nan if value is None else value)
+        return np.array(elevation_values, dtype=float)
+
+    def sample(self, latitudes, longitudes):
+        values, failed = self.scheduler.run(latitudes, longitudes)
+        if np.any(failed):
+            raise ElevationFetchError(f"Error fetching elevation data for {np.count_nonzero(failed)} points",
+                                      values=values, failed=failed)
+        return values
+
+    def stats(self):
+        return self.scheduler.stats()
+
+
+class LocalRasterElevationSource(ElevationSource):
+    """Pre-downloaded 3DEP 1 m tiles (a GeoTIFF or a VRT mosaic) sampled with rasterio windowed reads"""
+    name = 'local'
+
+    def __init__(self, dem_path, block_size=1024):
+        self.dem_path = dem_path
+        self.block_size = block_size
+        self.cache_key = f"local_{os.path.splitext(os.path.basename(dem_path))[0]}"
+        self.src = rasterio.open(dem_path)
+        self._lock = threading.Lock()  # rasterio datasets must not be read from several threads at once
+        self.transformer = pyproj.Transformer.from_crs("EPSG:4326", self.src.crs, always_xy=True)
+
+    def sample(self, latitudes, longitudes):
+        latitudes = np.asarray(latitudes, dtype=float).ravel()
+        longitudes = np.asarray(longitudes, dtype=float).ravel()
+        x, y = self.transformer.transform(longitudes, latitudes)
+        cols, rows = ~self.src.transform * (x, y)
+        return raster_sampling.read_raster_points(self.src, np.floor(rows), np.floor(cols), self.block_size, self._lock)
+
+    def close(self):
+        self.src.close()
+
+
+ELEVATION_SOURCES = {
+    'gee': GEEElevationSource,
+    'local': LocalRasterElevationSource,
+}
+
+
+def sample_allowing_failures(elevation_source, latitudes, longitudes):
+    """sample(), but with failed points returned as NaN so that only the footprints they touch are dropped"""
+    try:
+        return elevation_source.sample(latitudes, longitudes)
+    except ElevationFetchError as e:
+        print(f"{e}")
+        if e.values is None:
+            return np.full(np.size(latitudes), np.nan)
+        return e.values
+
+
+def get_elevation_source(elevation_source='gee', **kwargs):
+    """Resolve an elevation backend by name ('gee', 'local'); instances are returned unchanged"""
+    if isinstance(elevation_source, ElevationSource):
+        return elevation_source
+    if elevation_source not in ELEVATION_SOURCES:
+        raise ValueError(f"Unknown elevation source: {elevation_source}. Choose from {list(ELEVATION_SOURCES)}")
+    return ELEVATION_SOURCES[elevation_source](**kwargs)
@@ -0,0 +1,200 @@
+import time
+import numpy as np
+from GEDI_elev_correction import Calculating_2D_Gaussian
+from GEDI_elev_correction.Calculating_2D_Gaussian import FIT_BOUNDS, gaussian_2d
+
+# Cells within this radius (m) of the minimum of the mean grid are used by quadratic and moment
+FAST_RADIUS = 8.0
+SIGMA_LADDER = np.geomspace(2.0, 20.0, 9)
+
+
+def _empty_result():
+    return {'x0': None, 'y0': None, 'sigma_x': None, 'sigma_y': None, 'A': None, 'fitted_data': None,
+            'bias': None, 'minRMSE': None, 'nfev': 0, 'njev': 0, 'status': None, 'success': False}
+
+
+def _no_data(mean_elev_diff):
+    """True (and reported) when the mean grid has no finite cell, so no estimator can run on it"""
+    if np.size(mean_elev_diff) and np.isfinite(mean_elev_diff).any():
+        return False
+    print("Error in offset estimate: no finite cells in the mean grid")
+    return True
+
+
+def _finite_data(mean_elev_diff):
+    X, Y, xdata = Calculating_2D_Gaussian.fit_grid(mean_elev_diff.shape)
+    zdata = mean_elev_diff.ravel()
+    finite = np.isfinite(zdata)
+    return X, Y, xdata[:, finite], zdata[finite]
+
+
+def _profile(xdata, zdata, centers, sigmas):
+    """Best isotropic gaussian_2d over candidate centres x sigmas, the amplitude A solved in closed form
+
+    Returns (center, sigma, A, sum of squared residuals) of the best candidate and the number of
+    candidates evaluated.
+    """
+    r2 = (xdata[0][np.newaxis, :] - centers[:, 0, np.newaxis]) ** 2 + \
+         (xdata[1][np.newaxis, :] - centers[:, 1, np.newaxis]) ** 2
+    best = (np.inf, None, None, None)
+    for sigma in sigmas:
+        g = 5 - np.exp(-r2 / (2 * sigma ** 2))
+        A = np.maximum(g @ zdata / np.einsum('ij,ij->i', g, g), 0)
+        sse = np.einsum('ij,ij->i', A[:, np.newaxis] * g - zdata, A[:, np.newaxis] * g - zdata)
+        k = np.argmin(sse)
+        if sse[k] < best[0]:
+            best = (sse[k], centers[k], sigma, A[k])
+    sse, center, sigma, A = best
+    return center, sigma, A, sse, len(centers) * len(sigmas)
+
+
+def _complete(result, mean_elev_diff, x0, y0, sigma_x, sigma_y, A, nfev, bounds):
+    """Fill fitted_data, bias and minRMSE of the estimate like fit_2d_inverted_gaussian_details does"""
+    lower, upper = bounds
+    if not (lower[0] <= x0 <= upper[0] and lower[1] <= y0 <= upper[1]):
+        print(f"Error in offset estimate: centre ({x0:.1f}, {y0:.1f}) outside the bounds")
+        result.update(nfev=nfev)
+        return result
+    X, Y, _ = Calculating_2D_Gaussian.fit_grid(mean_elev_diff.shape)
+    popt = (x0, y0, sigma_x, sigma_y, A)
+    fitted_data = gaussian_2d((X, Y), *popt).reshape(mean_elev_diff.shape)
+    bias = gaussian_2d((np.array([x0]), np.array([y0])), *popt)[0]
+    minRMSE = np.sqrt(np.nanmean((mean_elev_diff - fitted_data) ** 2))
+    result.update(x0=x0, y0=y0, sigma_x=sigma_x, sigma_y=sigma_y, A=A, fitted_data=fitted_data, bias=bias,
+                  minRMSE=minRMSE, nfev=nfev, status=0, success=True)
+    return result
+
+
+def _around_minimum(mean_elev_diff, radius):
+    _, _, xdata, zdata = _finite_data(mean_elev_diff)
+    k = np.argmin(zdata)
+    near = np.hypot(xdata[0] - xdata[0, k], xdata[1] - xdata[1, k]) <= radius
+    return xdata, zdata, xdata[:, near], zdata[near]
+
+
+def quadratic(mean_elev_diff, init_center_x=None, init_center_y=None, initial_params=None, bounds=FIT_BOUNDS,
+              radius=FAST_RADIUS):
+    """Centre of the quadratic surface fitted (linear least squares) to the cells around the minimum
+
+    Width and amplitude come from one _profile pass over SIGMA_LADDER at that centre. Fails when the
+    surface is not a bowl.
+    """
+    result = _empty_result()
+    if _no_data(mean_elev_diff):
+        return result
+    xdata, zdata, near, z = _around_minimum(mean_elev_diff, radius)
+    x, y = near
+    design = np.column_stack((np.ones_like(x), x, y, x ** 2, x * y, y ** 2))
+    _, b_x, b_y, a_xx, a_xy, a_yy = np.linalg.lstsq(design, z, rcond=None)[0]
+    hessian = np.array([[2 * a_xx, a_xy], [a_xy, 2 * a_yy]])
+    if len(z) < 6 or np.any(np.linalg.eigvalsh(hessian) <= 0):
+        print("Error in offset estimate: quadratic surface has no minimum")
+        return result
+    x0, y0 = np.linalg.solve(hessian, [-b_x, -b_y])
+    _, sigma, A, _, nfev = _profile(xdata, zdata, np.array([[x0, y0]]), SIGMA_LADDER)
+    return _complete(result, mean_elev_diff, x0, y0, sigma, sigma, A, nfev, bounds)
+
+
+def moment(mean_elev_diff, init_center_x=None, init_center_y=None, initial_params=None, bounds=FIT_BOUNDS,
+           radius=FAST_RADIUS):
+    """Centroid of the cells around the minimum, weighted by their depth below the highest of them
+
+    Width and amplitude come from one _profile pass over SIGMA_LADDER at the centroid.
+    """
+    result = _empty_result()
+    if _no_data(mean_elev_diff):
+        return result
+    xdata, zdata, near, z = _around_minimum(mean_elev_diff, radius)
+    weights = np.max(z) - z
+    if weights.sum() <= 0:
+        print("Error in offset estimate: flat mean grid")
+        return result
+    x0, y0 = near @ weights / weights.sum()
+    _, sigma, A, _, nfev = _profile(xdata, zdata, np.array([[x0, y0]]), SIGMA_LADDER)
+    return _complete(result, mean_elev_diff, x0, y0, sigma, sigma, A, nfev, bounds)
+
+
+def grid_search(mean_elev_diff, init_center_x=None, init_center_y=None, initial_params=None, bounds=FIT_BOUNDS,
+                spacings=(5.0, 1.0, 0.2, 0.05)):
+    """Coarse-to-fine search of an isotropic gaussian_2d: every level scans centres `spacing` apart over
+    +-2 spacings of the previous level's best (the whole bounds at the first level) and the width around
+    its best; the amplitude is solved exactly for every candidate, so nothing can diverge.
+    """
+    result = _empty_result()
+    if _no_data(mean_elev_diff):
+        return result
+    _, _, xdata, zdata = _finite_data(mean_elev_diff)
+    lower, upper = bounds
+    low, high = np.array(lower[:2], dtype=float), np.array(upper[:2], dtype=float)
+    center, sigma, sigmas, nfev = None, None, SIGMA_LADDER, 0
+    for level, spacing in enumerate(spacings):
+        if level > 0:
+            low, high = np.maximum(center - 2 * spacings[level - 1], lower[:2]), \
+                np.minimum(center + 2 * spacings[level - 1], upper[:2])
+            sigmas = sigma * np.array([0.8, 0.9, 1.0, 1.1, 1.25])
+        xs = np.arange(low[0], high[0] + spacing / 2, spacing)
+        ys = np.arange(low[1], high[1] + spacing / 2, spacing)
+        centers = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+        center, sigma, A, _, evaluated = _profile(xdata, zdata, centers, sigmas)
+        nfev += evaluated
+    return _complete(result, mean_elev_diff, center[0], center[1], sigma, sigma, A, nfev, bounds)
+
+
+def least_squares(mean_elev_diff, init_center_x, init_center_y, initial_params=None, bounds=FIT_BOUNDS):
+    if _no_data(mean_elev_diff):
+        return _empty_result()
+    return Calculating_2D_Gaussian.fit_2d_inverted_gaussian_details(mean_elev_diff, init_center_x, init_center_y,
+                                                                    initial_params, bounds)
+
+
+def hybrid(mean_elev_diff, init_center_x, init_center_y, initial_params=None, bounds=FIT_BOUNDS):
+    """least_squares seeded with the quadratic (else moment) estimate; grid_search when the fit fails
+
+    Given initial_params (e.g. the warm start of a bootstrap resample), least_squares starts from them instead.
+    """
+    if _no_data(mean_elev_diff):
+        return _empty_result()
+    seeded_by = None
+    if initial_params is None:
+        seed, seeded_by = quadratic(mean_elev_diff, bounds=bounds), 'quadratic'
+        if seed['x0'] is None:
+            seed, seeded_by = moment(mean_elev_diff, bounds=bounds), 'moment'
+        if seed['x0'] is not None:
+            initial_params = (seed['x0'], seed['y0'], seed['sigma_x'], seed['sigma_y'], seed['A'])
+        else:
+            seeded_by = None
+    fit = least_squares(mean_elev_diff, init_center_x, init_center_y, initial_params, bounds)
+    if fit['x0'] is not None:
+        fit['estimator'] = f'{seeded_by}+least_squares' if seeded_by else 'least_squares'
+        return fit
+    fit = grid_search(mean_elev_diff, init_center_x, init_center_y, bounds=bounds)
+    fit['estimator'] = 'grid_search'
+    return fit
+
+
+# Part 3 offset estimators, selected by name. All take (mean_elev_diff, init_x, init_y, initial_params, bounds)
+# and return the dict of fit_2d_inverted_gaussian_details, so their results are saved and plotted alike.
+#   least_squares  bounded nonlinear fit of gaussian_2d (the default, unchanged)
+#   quadratic      closed-form quadratic surface through the cells around the minimum of the mean grid
+#   moment         weighted centroid of the depression around the minimum
+#   grid_search    coarse-to-fine search of the centre and width of gaussian_2d (amplitude solved exactly)
+#   hybrid         least_squares started from the quadratic (else moment) estimate, grid_search if it fails
+ESTIMATORS = {
+    'least_squares': least_squares,
+    'quadratic': quadratic,
+    'moment': moment,
+    'grid_search': grid_search,
+    'hybrid': hybrid,
+}
+
+
+def estimate(mean_elev_diff, init_center_x, init_center_y, initial_params=None, bounds=FIT_BOUNDS,
+             estimator='least_squares'):
+    """Run the named estimator; the result also records the estimator that produced it and its run time (s)"""
+    if estimator not in ESTIMATORS:
+        raise ValueError(f"Unknown estimator: {estimator}. Choose from {list(ESTIMATORS)}")
+    start = time.perf_counter()
+    result = ESTIMATORS[estimator](mean_elev_diff, init_center_x, init_center_y, initial_params, bounds)
+    result.setdefault('estimator', estimator)
+    result['estimator_seconds'] = time.perf_counter() - start
+    return result
@@ -0,0 +1,155 @@
+import os
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+
+# pyarrow is imported by the functions that need it, so CSV-only runs never load it
+FOOTPRINTS_DIR = os.path.join('GEDI_data', 'footprints')
+RESULTS_DIR = os.path.join('GEDI_data', 'results')
+
+FOOTPRINT_COLUMNS = [
+    ('Latitude', 'float64'),
+    ('Longitude', 'float64'),
+    ('Elevation', 'float64'),
+    ('Instantaneous_Tan', 'float64'),
+    ('Smoothed_Tan', 'float64'),
+    ('Land_Cover', 'int16'),
+    ('Covered', 'bool'),
+    ('Granule', 'string'),
+]
+
+
+@lru_cache(maxsize=None)
+def footprint_schema():
+    import pyarrow as pa
+    return pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in FOOTPRINT_COLUMNS])
+
+
+def orbit_of(granule):
+    """Orbit of a granule name, e.g. GEDI02_A_2023011070157_O23114_03_T11296_02_003_02_V002 -> O23114"""
+    return granule.split('_')[3]
+
+
+def _write_partition(table, dataset_dir, granule, beam):
+    # Hive layout orbit=<orbit>/beam=<beam>/<granule>.parquet, so orbit and beam filters prune whole directories
+    import pyarrow.parquet as pq
+    partition_dir = os.path.join(dataset_dir, f'orbit={orbit_of(granule)}', f'beam={beam}')
+    os.makedirs(partition_dir, exist_ok=True)
+    path = os.path.join(partition_dir, f'{granule}.parquet')
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_footprints(df, granule, beam, dataset_dir=FOOTPRINTS_DIR):
+    """Write all footprints of one beam of one granule (every land-cover class) with typed columns"""
+    import pyarrow as pa
+    df = df.assign(Land_Cover=df['Land_Cover'].astype(np.int16), Granule=granule)
+    if 'Covered' not in df:
+        df = df.assign(Covered=True)
+    schema = footprint_schema()
+    table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+    return _write_partition(table, dataset_dir, granule, beam)
+
+
+def _dataset(dataset_dir):
+    import pyarrow.dataset as ds
+    return ds.dataset(dataset_dir, format='parquet', partitioning='hive', exclude_invalid_files=True)
+
+
+def _all(conditions):
+    condition = None
+    for term in conditions:
+        condition = term if condition is None else condition & term
+    return condition
+
+
+def read_footprints(dataset_dir=FOOTPRINTS_DIR, columns=None, orbit=None, beam=None, land_cover=None, bbox=None,
+                    covered_only=False, dataset=None):
+    """Footprints matching the filters as a pyarrow Table
+
+    orbit/beam prune partitions; land_cover (a class ID or a list of them) and bbox (west, south, east,
+    north) are pushed down to the Parquet row-group statistics. Columns are read as typed arrays, so
+    table['Latitude'].to_numpy() needs no parsing or copy. dataset is an already opened dataset of
+    dataset_dir, so repeated reads do not list and open every file again.
+    """
+    import pyarrow.dataset as ds
+    conditions = []
+    if orbit is not None:
+        conditions.append(ds.field('orbit') == orbit)
+    if beam is not None:
+        conditions.append(ds.field('beam') == beam)
+    if land_cover is not None:
+        conditions.append(ds.field('Land_Cover').isin(np.atleast_1d(land_cover).tolist()))
+    if bbox is not None:
+        west, south, east, north = bbox
+        conditions.extend([ds.field('Longitude') >= west, ds.field('Longitude') <= east,
+                           ds.field('Latitude') >= south, ds.field('Latitude') <= north])
+    if covered_only:
+        conditions.append(ds.field('Covered'))
+    if dataset is None:
+        dataset = _dataset(dataset_dir)
+    return dataset.to_table(columns=columns, filter=_all(conditions))
+
+
+def iter_beam_footprints(dataset_dir=FOOTPRINTS_DIR, beams=None, **filters):
+    """Yield (granule, beam, table) for every granule/beam with footprints that pass the filters"""
+    if not os.path.isdir(dataset_dir):
+        return
+    import pyarrow.compute as pc
+    # The dataset (file listing and Parquet footers) is opened once; each partition is a filter on it
+    dataset = _dataset(dataset_dir)
+    for orbit_partition in sorted(os.listdir(dataset_dir)):
+        for beam_partition in sorted(os.listdir(os.path.join(dataset_dir, orbit_partition))):
+            beam = beam_partition.split('=', 1)[1]
+            if beams is not None and beam not in beams:
+                continue
+            table = read_footprints(dataset_dir, beam=beam, orbit=orbit_partition.split('=', 1)[1], dataset=dataset,
+                                    **filters)
+            for granule in pc.unique(table['Granule']).to_pylist():
+                yield granule, beam, table.filter(pc.equal(table['Granule'], granule))
+
+
+def write_result(result, granule, beam, dataset_dir=RESULTS_DIR):
+    """Write the one-row part 3 result of a beam"""
+    import pyarrow as pa
+    table = pa.Table.from_pandas(pd.DataFrame([result]).assign(Granule=granule), preserve_index=False)
+    return _write_partition(table, dataset_dir, granule, beam)
+
+
+def read_results(dataset_dir=RESULTS_DIR, orbit=None, beam=None):
+    """Part 3 results of all matching beams as a DataFrame (with orbit and beam columns)"""
+    if not os.path.isdir(dataset_dir):
+        return pd.DataFrame()
+    import pyarrow.dataset as ds
+    conditions = []
+    if orbit is not None:
+        conditions.append(ds.field('orbit') == orbit)
+    if beam is not None:
+        conditions.append(ds.field('beam') == beam)
+    return _dataset(dataset_dir).to_table(filter=_all(conditions)).to_pandas()
+
+
+def result_path(dir_path, beam, dataset_dir=RESULTS_DIR):
+    """Path of the part 3 result of a beam of the granule in dir_path (results dataset, else results_{beam}.csv)"""
+    granule = os.path.basename(os.path.normpath(dir_path))
+    if granule.startswith('GEDI02_A_'):
+        path = os.path.join(dataset_dir, f'orbit={orbit_of(granule)}', f'beam={beam}', f'{granule}.parquet')
+        if os.path.exists(path):
+            return path
+    results_file = os.path.join(dir_path, f'results_{beam}.csv')
+    if os.path.exists(results_file):
+        return results_file
+    return None
+
+
+def load_result(dir_path, beam, dataset_dir=RESULTS_DIR):
+    """One-row result of a beam of the granule in dir_path: from the results dataset, else results_{beam}.csv"""
+    path = result_path(dir_path, beam, dataset_dir)
+    if path is None:
+        return None
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pandas()
+    return pd.read_csv(path)
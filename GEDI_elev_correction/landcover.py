@@ -0,0 +1,111 @@
+import os
+import threading
+import numpy as np
+import rasterio
+from GEDI_elev_correction import raster_sampling, request_scheduler
+
+NO_LAND_COVER = -999
+
+
+class WorldCoverTileIndex:
+    """Locally downloaded ESA WorldCover tiles (e.g. ESA_WorldCover_10m_2020_v100_N36W105_Map.tif)
+
+    The bounds of every GeoTIFF under tile_dir are bucketed by whole-degree cell, so the tiles covering
+    a set of points are found with one dictionary lookup per cell instead of a scan over all tiles.
+    """
+
+    def __init__(self, tile_dir, block_size=1024):
+        self.tile_dir = tile_dir
+        self.block_size = block_size
+        self.tiles = []
+        self.cells = {}
+        self._open = {}
+        self._lock = threading.Lock()
+        for root, _, files in os.walk(tile_dir):
+            for file in sorted(files):
+                if not file.lower().endswith(('.tif', '.tiff', '.vrt')):
+                    continue
+                path = os.path.join(root, file)
+                with rasterio.open(path) as src:
+                    bounds = src.bounds
+                tile_id = len(self.tiles)
+                self.tiles.append((path, bounds))
+                for lat in range(int(np.floor(bounds.bottom)), int(np.ceil(bounds.top))):
+                    for lon in range(int(np.floor(bounds.left)), int(np.ceil(bounds.right))):
+                        self.cells.setdefault((lat, lon), []).append(tile_id)
+        print(f"Indexed {len(self.tiles)} WorldCover tiles in {tile_dir}")
+
+    def _dataset(self, tile_id):
+        if tile_id not in self._open:
+            self._open[tile_id] = rasterio.open(self.tiles[tile_id][0])
+        return self._open[tile_id]
+
+    def sample(self, latitudes, longitudes):
+        """Land-cover class of every point in one pass, NO_LAND_COVER where no tile covers it"""
+        latitudes = np.asarray(latitudes, dtype=float).ravel()
+        longitudes = np.asarray(longitudes, dtype=float).ravel()
+        values = np.full(latitudes.size, np.nan)
+
+        cell_lat = np.floor(latitudes).astype(np.int64)
+        cell_lon = np.floor(longitudes).astype(np.int64)
+        for lat, lon in set(zip(cell_lat.tolist(), cell_lon.tolist())):
+            in_cell = np.flatnonzero((cell_lat == lat) & (cell_lon == lon))
+            for tile_id in self.cells.get((lat, lon), []):
+                todo = in_cell[np.isnan(values[in_cell])]
+                if todo.size == 0:
+                    break
+                src = self._dataset(tile_id)
+                cols, rows = ~src.transform * (longitudes[todo], latitudes[todo])
+                values[todo] = raster_sampling.read_raster_points(src, np.floor(rows), np.floor(cols),
+                                                                  self.block_size, self._lock)
+
+        return np.where(np.isnan(values), NO_LAND_COVER, values).astype(np.int64)
+
+    def close(self):
+        for src in self._open.values():
+            src.close()
+        self._open = {}
+
+
+def fetch_land_cover_batch(latitudes, longitudes):
+    """ESA/WorldCover/v100 classes of one batch of points through Earth Engine reduceRegions"""
+    import ee
+    # Create a FeatureCollection of points
+    points = ee.FeatureCollection(
+        [ee.Feature(ee.Geometry.Point([lon, lat])) for lat, lon in zip(latitudes, longitudes)])
+
+    # Landcover dataset
+    dataset = ee.ImageCollection("ESA/WorldCover/v100")
+    image = dataset.first()
+
+    land_cover = image.reduceRegions(
+        collection=points,
+        reducer=ee.Reducer.first(),
+        scale=10
+    )
+
+    batch_land_cover_values = []
+    for feature in land_cover.getInfo().get('features', []):
+        value = feature.get('properties', {}).get('first', NO_LAND_COVER)
+        batch_land_cover_values.append(NO_LAND_COVER if value is None else value)
+    return batch_land_cover_values
+
+
+def get_land_cover(latitudes, longitudes, landcover_source='gee', tile_index=None, batch_size=500,
+                   max_workers=4, max_retries=3):
+    """Land-cover classes of all points, from local WorldCover tiles or from Earth Engine
+
+    The GEE path sends batches of batch_size points concurrently and retries each failed batch on its
+    own; only the points of batches that still fail get NO_LAND_COVER.
+    """
+    if landcover_source == 'local':
+        return tile_index.sample(latitudes, longitudes)
+    if landcover_source != 'gee':
+        raise ValueError(f"Unknown land cover source: {landcover_source}")
+
+    scheduler = request_scheduler.RequestScheduler(fetch_land_cover_batch, max_in_flight=max_workers,
+                                                   batch_size=batch_size, min_batch_size=min(100, batch_size),
+                                                   max_retries=max_retries, name='land_cover_requests')
+    values, failed = scheduler.run(latitudes, longitudes)
+    print(f"Land cover requests: {scheduler.stats()}")
+    return np.where(failed | np.isnan(values), NO_LAND_COVER, values).astype(np.int64)
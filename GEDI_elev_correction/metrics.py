@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import math
+import time
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_DIR = 'metrics'
+
+# Metrics are always collected in memory (a lock and a few additions per call); they are only written
+# when enable() was called, one JSON object per line in <directory>/<run_id>.jsonl.
+_lock = threading.Lock()
+_counters = Counter()
+_histograms = {}
+_config = {'directory': None, 'profile_interval': None, 'run_id': None}
+_active_stages = []
+
+
+class Histogram:
+    """Count/sum/min/max plus power-of-two buckets, so latencies and payload sizes of any scale fit"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = Counter()
+
+    def add(self, value, n=1):
+        value = float(value)
+        self.count += n
+        self.total += value * n
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        # bucket k holds values in (2**(k-1), 2**k]
+        self.buckets[math.ceil(math.log2(value)) if value > 0 else None] += n
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        seen = 0
+        for k in sorted(self.buckets, key=lambda k: -math.inf if k is None else k):
+            seen += self.buckets[k]
+            if seen >= q * self.count:
+                return 0.0 if k is None else min(2.0 ** k, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.total, 'mean': self.total / self.count if self.count else None,
+                'min': self.min, 'max': self.max, 'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'buckets': {('<=0' if k is None else f'<=2^{k}'): n for k, n in sorted(
+                    self.buckets.items(), key=lambda item: -math.inf if item[0] is None else item[0])}}
+
+
+def count(name, value=1):
+    """Add value to a counter, e.g. count('part2.rejected.threshold', n)"""
+    with _lock:
+        _counters[name] += int(value)
+
+
+def observe(name, value, n=1):
+    """Add a value (latency in s, payload size, ...) to a histogram"""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(value, n)
+
+
+@contextmanager
+def timer(name):
+    """Time a block into the histogram `name` (seconds)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def snapshot():
+    """Current counters and histogram summaries, plus a hit_rate for every <x>.hits/<x>.misses pair"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {name: histogram.summary() for name, histogram in _histograms.items()}
+    rates = {}
+    for name in counters:
+        if name.endswith('.hits'):
+            prefix = name[:-len('.hits')]
+            total = counters[name] + counters.get(prefix + '.misses', 0)
+            rates[prefix + '.hit_rate'] = counters[name] / total if total else None
+    return {'counters': counters, 'histograms': histograms, 'rates': rates}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def enable(directory=METRICS_DIR, profile_interval=None):
+    """Write metrics of every stage of this run to directory; profile_interval (s) turns on the sampler"""
+    os.makedirs(directory, exist_ok=True)
+    _config.update(directory=directory, profile_interval=profile_interval,
+                   run_id=f"{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}")
+    return os.path.join(directory, f"{_config['run_id']}.jsonl")
+
+
+def _write(lines):
+    if _config['directory'] is None:
+        return
+    path = os.path.join(_config['directory'], f"{_config['run_id']}.jsonl")
+    with _lock, open(path, 'a') as f:
+        for line in lines:
+            f.write(json.dumps(line, default=float) + '\n')
+
+
+def write_stage(stage, elapsed=None, profile=None):
+    """Append one line per counter / histogram / rate of the finished stage (and its profile) to the run file"""
+    data = snapshot()
+    base = {'run': _config['run_id'], 'stage': stage, 'time': datetime.now().isoformat()}
+    lines = [dict(base, kind='stage', elapsed=elapsed)] if elapsed is not None else []
+    lines += [dict(base, kind='counter', name=name, value=value) for name, value in sorted(data['counters'].items())]
+    lines += [dict(base, kind='rate', name=name, value=value) for name, value in sorted(data['rates'].items())]
+    lines += [dict(base, kind='histogram', name=name, **summary)
+              for name, summary in sorted(data['histograms'].items())]
+    if profile is not None:
+        lines += [dict(base, kind='profile', **entry) for entry in profile]
+    _write(lines)
+
+
+def stage(name):
+    """Decorator of a stage entry point: resets the metrics, times the stage and writes its metrics
+
+    A stage called from inside another one (e.g. part 2 from the pipeline) only adds its timer.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active_stages:
+                with timer(f'{name}.total'):
+                    return function(*args, **kwargs)
+            _active_stages.append(name)
+            reset()
+            profiler = SamplingProfiler(_config['profile_interval']) if _config['profile_interval'] else None
+            if profiler is not None:
+                profiler.start()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                profile = profiler.stop() if profiler is not None else None
+                _active_stages.pop()
+                write_stage(name, elapsed, profile)
+        return wrapper
+    return decorate
+
+
+class SamplingProfiler:
+    """Background thread that samples the stacks of all other threads every `interval` seconds
+
+    Uses sys._current_frames(), so it needs no tracing hooks and costs nothing between samples.
+    stop() returns the most frequent stacks (outermost first) and leaf functions with their sample counts.
+    """
+
+    def __init__(self, interval=0.01, max_depth=40, top=50):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.top = top
+        self.stacks = Counter()
+        self.leaves = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-profiler', daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                entries = []
+                while frame is not None and len(entries) < self.max_depth:
+                    code = frame.f_code
+                    entries.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                    frame = frame.f_back
+                # Idle pool threads waiting on their queue are not interesting
+                if entries and entries[0].startswith('threading.py:wait'):
+                    continue
+                self.leaves[entries[0]] += 1
+                self.stacks[';'.join(reversed(entries))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return ([{'name': 'leaf', 'frame': frame, 'samples': n} for frame, n in self.leaves.most_common(self.top)] +
+                [{'name': 'stack', 'stack': stack, 'samples': n} for stack, n in self.stacks.most_common(self.top)] +
+                [{'name': 'total', 'samples': self.samples, 'interval': self.interval}])
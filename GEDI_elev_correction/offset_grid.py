@@ -0,0 +1,56 @@
+import numpy as np
+import pyproj
+
+# Same WGS-84 ellipsoid and geodesic solver (Karney) that geopy.distance.geodesic uses,
+# so the batched grids match the per-cell geopy loop to ~1e-13 degrees (well below 1 um on the ground).
+GRID_TOLERANCE_DEG = 1e-9
+
+_GEOD = pyproj.Geod(ellps='WGS84')
+
+
+def get_offset_axis(spacing=1, extent=35, buffer_extent=10):
+    """Offsets (m) of the sample grid along one axis, including the smoothing buffer"""
+    half_extent = extent
+    return np.arange(-half_extent - buffer_extent, half_extent + spacing + buffer_extent, spacing)
+
+
+def get_offset_points(center_lats, center_lons, tan_directions, xx, yy):
+    """Rotate the (xx, yy) offsets by each footprint's track direction and return their WGS-84 lat/lon
+
+    Every offset is applied as in the original per-cell loop: a geodesic step of y_rot metres to the
+    north, followed by a step of x_rot metres to the east. Returns two arrays of shape (N,) + xx.shape.
+    """
+    center_lats = np.atleast_1d(np.asarray(center_lats, dtype=float))
+    center_lons = np.atleast_1d(np.asarray(center_lons, dtype=float))
+    angle = np.arctan(np.atleast_1d(np.asarray(tan_directions, dtype=float)))
+    xx = np.asarray(xx, dtype=float)
+    yy = np.asarray(yy, dtype=float)
+
+    expand = (slice(None),) + (np.newaxis,) * xx.ndim
+    cos_angle = np.cos(angle)[expand]
+    sin_angle = np.sin(angle)[expand]
+
+    # Calculate rotation in the UTM coordinate system
+    x_rot = xx * cos_angle - yy * sin_angle
+    y_rot = xx * sin_angle + yy * cos_angle
+
+    shape = x_rot.shape
+    origin_lats = np.broadcast_to(center_lats[expand], shape).ravel()
+    origin_lons = np.broadcast_to(center_lons[expand], shape).ravel()
+
+    # Convert UTM displacement to WGS-84 lat/lon: north by y_rot, then east by x_rot
+    mid_lons, mid_lats, _ = _GEOD.fwd(origin_lons, origin_lats, np.zeros(origin_lats.size), y_rot.ravel())
+    points_lon, points_lat, _ = _GEOD.fwd(mid_lons, mid_lats, np.full(origin_lats.size, 90.0), x_rot.ravel())
+
+    return points_lat.reshape(shape), points_lon.reshape(shape)
+
+
+def get_offset_grids(center_lats, center_lons, tan_directions, spacing=1, extent=35, buffer_extent=10):
+    """Batched rotated sample grids for many footprints at once
+
+    Returns (points_lat, points_lon), each of shape (N, n, n) with n = 2 * (extent + buffer_extent) / spacing + 1,
+    laid out like the matrices get_matrix_elev_diff builds for a single footprint.
+    """
+    x = get_offset_axis(spacing, extent, buffer_extent)
+    xx, yy = np.meshgrid(x, x)
+    return get_offset_points(center_lats, center_lons, tan_directions, xx, yy)
@@ -0,0 +1,319 @@
+import os
+import json
+import hashlib
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from GEDI_elev_correction import Load_GEDI_L2A_files, Calculating_elev_diffs, Calculating_2D_Gaussian, estimators
+from GEDI_elev_correction import coverage_index, landcover, smoothing, offset_grid
+from GEDI_elev_correction import metrics
+
+BEAMS = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
+STATE_FILE = os.path.join('GEDI_data', 'pipeline_state.json')
+# Sample window of part 2 (metres); the stage functions use these defaults
+WINDOW = {'spacing': 1, 'extent': 35, 'buffer_extent': 10}
+
+
+class Task:
+    """One unit of work of the pipeline: a stage function applied to one granule or to one beam of a granule
+
+    The task is up to date when the hash of its params, the source of its code modules and the content
+    of its input files equals the hash recorded after its last successful run, and the outputs that run
+    produced still exist. run() returns the list of files it wrote (or None to use `outputs`).
+    """
+
+    def __init__(self, task_id, run, inputs=(), outputs=(), params=None, code=(), deps=(), cleanup=(),
+                 serial=False):
+        self.task_id = task_id
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.code = list(code)
+        self.deps = list(deps)
+        self.cleanup = list(cleanup)
+        # serial tasks (matplotlib) never run at the same time as each other
+        self.serial = serial
+
+
+class Pipeline:
+    """DAG of Tasks, run with up to max_workers independent tasks in flight, skipping up-to-date ones"""
+
+    def __init__(self, state_path=STATE_FILE, max_workers=4, adopt_existing=True):
+        self.state_path = state_path
+        self.max_workers = max_workers
+        # Record outputs written before the pipeline existed instead of recomputing them on the first run
+        self.adopt_existing = adopt_existing
+        self.tasks = {}
+        self.state = {'tasks': {}, 'files': {}}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        self._lock = threading.Lock()
+        self._serial_lock = threading.Lock()
+        self.counts = {'ran': 0, 'skipped': 0, 'adopted': 0, 'failed': 0}
+
+    def add(self, task):
+        self.tasks[task.task_id] = task
+        return task
+
+    def file_hash(self, path):
+        """sha256 of a file, recomputed only when its size or mtime changed since it was last hashed"""
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        with self._lock:
+            cached = self.state['files'].get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self._lock:
+            self.state['files'][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def task_key(self, task):
+        payload = {'task': task.task_id, 'params': task.params,
+                   'code': [self.file_hash(module if isinstance(module, str) else inspect.getsourcefile(module))
+                            for module in task.code],
+                   'inputs': {path: self.file_hash(path) for path in task.inputs}}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=repr).encode()).hexdigest()
+
+    def is_stale(self, task, key):
+        record = self.state['tasks'].get(task.task_id)
+        return record is None or record['key'] != key or not all(os.path.exists(path) for path in record['outputs'])
+
+    def save_state(self):
+        with self._lock:
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.state_path)
+
+    def _record(self, task, key, outputs):
+        with self._lock:
+            self.state['tasks'][task.task_id] = {'key': key, 'outputs': list(outputs)}
+        self.save_state()
+
+    def _execute(self, task):
+        try:
+            key = self.task_key(task)
+            if not self.is_stale(task, key):
+                return 'skipped'
+            if self.adopt_existing and task.task_id not in self.state['tasks'] and task.outputs and \
+                    os.path.exists(task.outputs[0]):
+                print(f"Adopting existing outputs of {task.task_id}")
+                self._record(task, key, [path for path in task.outputs if os.path.exists(path)])
+                return 'adopted'
+            print(f"Running {task.task_id}")
+            # Resume files (task.cleanup) of an interrupted run are kept when that run had the same key, so the
+            # stage can resume; they are only discarded when the inputs, params or code changed since then
+            with self._lock:
+                started = self.state.setdefault('started', {}).get(task.task_id)
+            for path in (task.cleanup if started is not None and started != key else []) + task.outputs:
+                if os.path.exists(path):
+                    os.remove(path)
+            with self._lock:
+                self.state['started'][task.task_id] = key
+            self.save_state()
+            # Timed per kind of task, e.g. pipeline.part2
+            with metrics.timer(f"pipeline.{task.task_id.split('/')[0]}"):
+                if task.serial:
+                    with self._serial_lock:
+                        outputs = task.run()
+                else:
+                    outputs = task.run()
+            if outputs is None:
+                outputs = [path for path in task.outputs if os.path.exists(path)]
+            self._record(task, key, outputs)
+            return 'ran'
+        except Exception as e:
+            print(f"Task {task.task_id} failed: {e}")
+            return 'failed'
+
+    def run(self):
+        """Run every stale task once all of its dependencies succeeded; dependents of failed tasks are skipped"""
+        pending = dict(self.tasks)
+        done, failed = set(), set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for task_id, task in list(pending.items()):
+                    if any(dep in failed for dep in task.deps):
+                        print(f"Skipping {task_id}: a dependency failed")
+                        failed.add(task_id)
+                        del pending[task_id]
+                    elif all(dep in done for dep in task.deps) and len(running) < self.max_workers:
+                        running[executor.submit(self._execute, task)] = task_id
+                        del pending[task_id]
+                if not running:
+                    if pending:
+                        raise ValueError(f"Unknown dependencies of tasks {sorted(pending)}")
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task_id = running.pop(future)
+                    outcome = future.result()
+                    self.counts[outcome] += 1
+                    metrics.count(f'pipeline.tasks.{outcome}')
+                    (failed if outcome == 'failed' else done).add(task_id)
+        self.save_state()
+        print(f"Pipeline: {self.counts}")
+        return self.counts
+
+
+def _module_path(name):
+    # Plot modules are hashed by path, so building the pipeline does not import matplotlib
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{name}.py')
+
+
+def _store_files(root, beam):
+    # Partial files of an interrupted FootprintStore; removed only when the beam's task key changed since
+    return [os.path.join(root, f'elev_diffs_{beam}{suffix}') for suffix in ('.partial', '.partial_meta', '.state.json')]
+
+
+def build_pipeline(base_dir='GEDI_data', elevation_source='gee', dem_path=None, landcover_source='gee',
+                   worldcover_dir=None, coverage_file=None, land_cover_class=60, geoid_file='g2012bu0.bin',
+                   corridor_mode=False, geoid_method='nearest', smoothing_method='direct',
+                   fit_bounds=Calculating_2D_Gaussian.FIT_BOUNDS, dem_cache_dir=None, dem_cache_size=4 * 1024 ** 3,
+                   figures_dir='figures', max_workers=4, state_path=STATE_FILE, adopt_existing=True,
+                   bootstrap_resamples=0, estimator='least_squares'):
+    """Pipeline of part 1 per granule, part 2 and part 3 per beam, and the part 4 figures
+
+    Works on the CSV/.npy intermediates of the four parts. Shared resources (elevation source, geoid,
+    WorldCover index, coverage index) are opened on first use, so a run with nothing stale opens none.
+    """
+    pipeline = Pipeline(state_path, max_workers, adopt_existing)
+    shared = {}
+    shared_lock = threading.Lock()
+
+    def resource(name, make):
+        with shared_lock:
+            if name not in shared:
+                shared[name] = make()
+            return shared[name]
+
+    def make_elevation_source():
+        return Calculating_elev_diffs.open_elevation_source(elevation_source, dem_path, dem_cache_dir, dem_cache_size)
+
+    def make_tile_index():
+        if landcover_source == 'gee':
+            Load_GEDI_L2A_files.GEE_authorizing()
+            return None
+        return landcover.WorldCoverTileIndex(worldcover_dir)
+
+    def make_coverage():
+        return coverage_index.CoverageIndex.from_file(coverage_file) if coverage_file else None
+
+    extra_inputs = [coverage_file] if coverage_file else []
+    part1_params = {'landcover_source': landcover_source, 'worldcover_dir': worldcover_dir,
+                    'coverage_file': coverage_file, 'land_cover_class': land_cover_class}
+    part2_params = {'elevation_source': elevation_source, 'dem_path': dem_path, 'coverage_file': coverage_file,
+                    'corridor_mode': corridor_mode, 'geoid_method': geoid_method, 'window': WINDOW,
+                    'sigma': smoothing.SIGMA, 'crop': smoothing.CROP, 'smoothing_method': smoothing_method,
+                    'threshold': Calculating_elev_diffs.ELEV_DIFF_THRESHOLD, 'dem_cache': dem_cache_dir is not None}
+    part3_params = {'fit_bounds': fit_bounds}
+    part3_code = []
+    if estimator != 'least_squares':
+        part3_params['estimator'] = estimator
+    if bootstrap_resamples:
+        part3_params['bootstrap_resamples'] = bootstrap_resamples
+        part3_code.append(_module_path('bootstrap'))
+
+    granules = {os.path.splitext(name)[0]: os.path.join(base_dir, name) for name in os.listdir(base_dir)
+                if name.endswith('.h5')}
+    for name in os.listdir(base_dir):
+        if name.startswith('GEDI02_A_') and os.path.isdir(os.path.join(base_dir, name)):
+            granules.setdefault(name, None)
+
+    part3_tasks = []
+    for granule, h5_path in sorted(granules.items()):
+        root = os.path.join(base_dir, granule)
+        part1_id = None
+        if h5_path is not None:
+            def run_part1(h5_path=h5_path):
+                data = Load_GEDI_L2A_files.get_center_data(h5_path, BEAMS)
+                Load_GEDI_L2A_files.extract_granule(h5_path, data, landcover_source,
+                                                    resource('tile_index', make_tile_index),
+                                                    resource('coverage', make_coverage),
+                                                    land_cover_class=land_cover_class)
+            part1_id = pipeline.add(Task(
+                f'part1/{granule}', run_part1, inputs=[h5_path] + extra_inputs,
+                outputs=[os.path.join(root, f'{beam}{suffix}') for beam in BEAMS
+                         for suffix in ('.csv', '_Filtered_data.csv')],
+                params=part1_params, code=[Load_GEDI_L2A_files, landcover, coverage_index])).task_id
+
+        granule_part3 = []
+        for beam in BEAMS:
+            csv_path = os.path.join(root, f'{beam}_Filtered_data.csv')
+            if part1_id is None and not os.path.exists(csv_path):
+                continue
+            part2_outputs = [os.path.join(root, f'{prefix}_{beam}{ext}') for prefix, ext in
+                             (('elev_diffs', '.npy'), ('abs_elev_diffs', '.npy'), ('accum_abs_elev_diffs', '.npz'))]
+
+            def run_part2(csv_path=csv_path, root=root, beam=beam):
+                geoid = resource('geoid', lambda: Calculating_elev_diffs.load_geoid(geoid_file))
+                Calculating_elev_diffs.process_beam(csv_path, root, beam, geoid,
+                                                    resource('elevation_source', make_elevation_source),
+                                                    corridor_mode, geoid_method,
+                                                    coverage=resource('coverage', make_coverage),
+                                                    smoothing_method=smoothing_method)
+            part2 = pipeline.add(Task(
+                f'part2/{granule}/{beam}', run_part2,
+                inputs=[csv_path, geoid_file] + ([dem_path] if dem_path else []) + extra_inputs,
+                outputs=part2_outputs, params=part2_params, deps=[part1_id] if part1_id else [],
+                code=[Calculating_elev_diffs, smoothing, offset_grid], cleanup=_store_files(root, beam)))
+
+            def run_part3(root=root, beam=beam, abs_path=part2_outputs[1]):
+                job = Calculating_2D_Gaussian.collect_beam_job(root, abs_path, beam)
+                if job is None:
+                    return []
+                fit = estimators.estimate(job[4], job[5], job[6], bounds=fit_bounds, estimator=estimator)
+                extra = None
+                if bootstrap_resamples:
+                    from GEDI_elev_correction import bootstrap
+                    # Beams already run in parallel pipeline threads: fit the resamples in this thread
+                    extra = bootstrap.bootstrap_beam(job, fit, bootstrap_resamples, max_workers=1,
+                                                     bounds=fit_bounds, estimator=estimator)
+                return Calculating_2D_Gaussian.save_beam_fit(
+                    job, fit, index_path=os.path.join(base_dir, 'results_index.sqlite'), extra=extra)
+            part3 = pipeline.add(Task(
+                f'part3/{granule}/{beam}', run_part3, inputs=part2_outputs[1:],
+                outputs=[os.path.join(root, f'abs_adjusted_elev_diffs_{beam}.npy'),
+                         os.path.join(root, f'results_{beam}.csv')],
+                params=part3_params, deps=[part2.task_id], code=[Calculating_2D_Gaussian, estimators] + part3_code))
+            granule_part3.append(part3)
+
+        if len(granule_part3) == len(BEAMS):
+            def run_bullseye(root=root):
+                from GEDI_elev_correction import plot_bullseye
+                plt = plot_bullseye.headless_pyplot()
+                os.makedirs(figures_dir, exist_ok=True)
+                plot_bullseye.plot_contours(BEAMS, os.path.join(root, 'abs_adjusted_elev_diffs_beamname.npy'),
+                                            os.path.join(root, 'results_beamname.csv'), figures_dir)
+                plt.close('all')
+            pipeline.add(Task(
+                f'part4/bullseye/{granule}', run_bullseye,
+                inputs=[path for task in granule_part3 for path in task.outputs],
+                outputs=[os.path.join(figures_dir, f'bulleyes_{granule}.png')],
+                deps=[task.task_id for task in granule_part3], code=[_module_path('plot_bullseye')], serial=True))
+        part3_tasks.extend(granule_part3)
+
+    def run_timeseries():
+        from GEDI_elev_correction import plot_bullseye, plot_timeseries
+        plt = plot_bullseye.headless_pyplot()
+        plot_timeseries.plot_timeseries()
+        plt.close('all')
+    pipeline.add(Task(
+        'part4/timeseries', run_timeseries, inputs=[task.outputs[1] for task in part3_tasks],
+        outputs=[os.path.join(figures_dir, f'GEDI_geolocation_offsets_group{group}.png') for group in (1, 2)],
+        deps=[task.task_id for task in part3_tasks], code=[_module_path('plot_timeseries')], serial=True))
+    return pipeline
+
+
+@metrics.stage('pipeline')
+def run_pipeline(**kwargs):
+    return build_pipeline(**kwargs).run()
@@ -1,101 +1,160 @@
 import os
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+from concurrent.futures import ProcessPoolExecutor
+from GEDI_elev_correction import intermediate, results_index, metrics
 
 
-def plot_contours(beams, geomatrix_path_beam, results_path_beam, output_path):
+def headless_pyplot():
+    """matplotlib.pyplot on the Agg backend, imported on first use rather than at module import"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_contours(beams, geomatrix_path_beam, results_path_beam, output_path, results=None):
+    """Bullseye figure of one granule; results are its rows of the results index (else read from the results files)"""
+    plt = headless_pyplot()
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
     fig, axes = plt.subplots(2, 4, figsize=(18, 10))
-    axes = axes.flatten()
-    Label = []
-    n = []
-    bias = []
-    minRMSE = []
-    init_x = []
-    init_y = []
-    adjusted_x = []
-    adjusted_y = []
-
-    for i, beam in enumerate(beams):
-        geomatrix_path = geomatrix_path_beam.replace("beamname", beam)
-        if not os.path.exists(geomatrix_path):
-            print(f"File not found: {geomatrix_path}, skipping this beam.")
-            return 0
-        gaussian_elev_diff = np.load(geomatrix_path)
-        # gaussian_elev_diff = np.nanmean(gaussian_elev_diff, axis=0)
-
-        results_path = results_path_beam.replace("beamname", beam)
-        if not os.path.exists(results_path):
-            print(f"File not found: {results_path}, skipping this beam.")
-            return 0
-        results = pd.read_csv(results_path)
-        Label.append(results['Label'][0])
-        n.append(results['n'][0])
-        bias.append(results['bias'][0])
-        minRMSE.append(results['minRMSE'][0])
-        init_x.append(results['init_x'][0])
-        init_y.append(results['init_y'][0])
-        adjusted_x.append(results['adjusted_x'][0])
-        adjusted_y.append(results['adjusted_y'][0])
-
-        X, Y = np.meshgrid(np.linspace(-35, 35, gaussian_elev_diff.shape[1]), np.linspace(-35, 35, gaussian_elev_diff.shape[0]))
-        cs = axes[i].contourf(X, Y, gaussian_elev_diff, levels=np.linspace(np.min(gaussian_elev_diff), np.max(gaussian_elev_diff), 100), cmap='viridis_r')
-        axes[i].contour(X, Y, gaussian_elev_diff, levels=7, colors='black', linewidths=0.3)
-
-        axes[i].set_xticks(np.arange(-30, 31, 10))
-        axes[i].set_yticks(np.arange(-30, 31, 10))
-
-        # crosshairs#1
-        axes[i].plot([init_x[i], init_x[i]], [-35, 35], color='saddlebrown', linewidth=0.1)
-        axes[i].plot([-35, 35], [init_y[i], init_y[i]], color='saddlebrown', linewidth=0.1)
-
-        # crosshairs#2
-        axes[i].plot([adjusted_x[i], adjusted_x[i]], [-35, 35], 'r--')
-        axes[i].plot([-35, 35], [adjusted_y[i], adjusted_y[i]], 'r--')
-
-        # height(colorbar)
-        divider = make_axes_locatable(axes[i])
-        cax = divider.append_axes("right", size="5%", pad=0.1)  # 增加pad以避免重叠
-        cbar = fig.colorbar(cs, cax=cax)
-        cbar.set_label('Elevation difference (m)')
-        cbar.ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{x:.1f}'))
-
-    # subgraphs shape
-    for i, ax in enumerate(axes):
-        ax.set_aspect('equal', adjustable='box')
-        ax.set_title(
-            f"{Label[i]}: n={n[i]}, bias={bias[i]:.2f}, minRMSE={minRMSE[i]:.2f}\ninit x: {init_x[i]:.0f} y: {init_y[i]:.0f}; adjusted x: {adjusted_x[i]:.1f} y: {adjusted_y[i]:.1f}",
-            fontsize = 10
-        )
-
-    # subgraphs interval
-    plt.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.05, wspace=0.3, hspace=0.3)
-
-    # Save the plot
-    output_file = os.path.join(output_path, 'bulleyes_' + os.path.basename(os.path.dirname(geomatrix_path_beam)) + '.png')
-    plt.savefig(output_file, dpi=300)
-    # plt.show()
-
-def plot_bullseye():
+    try:
+        axes = axes.flatten()
+        Label = []
+        n = []
+        bias = []
+        minRMSE = []
+        init_x = []
+        init_y = []
+        adjusted_x = []
+        adjusted_y = []
+
+        for i, beam in enumerate(beams):
+            geomatrix_path = geomatrix_path_beam.replace("beamname", beam)
+            if not os.path.exists(geomatrix_path):
+                print(f"File not found: {geomatrix_path}, skipping this beam.")
+                return 0
+            gaussian_elev_diff = np.load(geomatrix_path)
+            # gaussian_elev_diff = np.nanmean(gaussian_elev_diff, axis=0)
+
+            results_path = results_path_beam.replace("beamname", beam)
+            if results is not None:
+                row = results[results['beam'] == beam].reset_index(drop=True)
+            else:
+                row = intermediate.load_result(os.path.dirname(results_path), beam)
+            if row is None or not len(row):
+                print(f"File not found: {results_path}, skipping this beam.")
+                return 0
+            Label.append(row['Label'][0])
+            n.append(row['n'][0])
+            bias.append(row['bias'][0])
+            minRMSE.append(row['minRMSE'][0])
+            init_x.append(row['init_x'][0])
+            init_y.append(row['init_y'][0])
+            adjusted_x.append(row['adjusted_x'][0])
+            adjusted_y.append(row['adjusted_y'][0])
+
+            X, Y = np.meshgrid(np.linspace(-35, 35, gaussian_elev_diff.shape[1]), np.linspace(-35, 35, gaussian_elev_diff.shape[0]))
+            cs = axes[i].contourf(X, Y, gaussian_elev_diff, levels=np.linspace(np.min(gaussian_elev_diff), np.max(gaussian_elev_diff), 100), cmap='viridis_r')
+            axes[i].contour(X, Y, gaussian_elev_diff, levels=7, colors='black', linewidths=0.3)
+
+            axes[i].set_xticks(np.arange(-30, 31, 10))
+            axes[i].set_yticks(np.arange(-30, 31, 10))
+
+            # crosshairs#1
+            axes[i].plot([init_x[i], init_x[i]], [-35, 35], color='saddlebrown', linewidth=0.1)
+            axes[i].plot([-35, 35], [init_y[i], init_y[i]], color='saddlebrown', linewidth=0.1)
+
+            # crosshairs#2
+            axes[i].plot([adjusted_x[i], adjusted_x[i]], [-35, 35], 'r--')
+            axes[i].plot([-35, 35], [adjusted_y[i], adjusted_y[i]], 'r--')
+
+            # height(colorbar)
+            divider = make_axes_locatable(axes[i])
+            cax = divider.append_axes("right", size="5%", pad=0.1)  # 增加pad以避免重叠
+            cbar = fig.colorbar(cs, cax=cax)
+            cbar.set_label('Elevation difference (m)')
+            cbar.ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{x:.1f}'))
+
+        # subgraphs shape
+        for i, ax in enumerate(axes):
+            ax.set_aspect('equal', adjustable='box')
+            ax.set_title(
+                f"{Label[i]}: n={n[i]}, bias={bias[i]:.2f}, minRMSE={minRMSE[i]:.2f}\ninit x: {init_x[i]:.0f} y: {init_y[i]:.0f}; adjusted x: {adjusted_x[i]:.1f} y: {adjusted_y[i]:.1f}",
+                fontsize = 10
+            )
+
+        # subgraphs interval
+        plt.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.05, wspace=0.3, hspace=0.3)
+
+        # Save the plot
+        output_file = os.path.join(output_path, 'bulleyes_' + os.path.basename(os.path.dirname(geomatrix_path_beam)) + '.png')
+        plt.savefig(output_file, dpi=300)
+        # plt.show()
+        return output_file
+    finally:
+        # Free the figure on every path, so rendering many orbits in one process keeps memory flat
+        plt.close(fig)
+
+def is_up_to_date(output_file, input_files, extra_times=()):
+    """True when output_file exists and is newer than every existing input file and every time in extra_times"""
+    if not os.path.exists(output_file):
+        return False
+    input_times = [os.path.getmtime(path) for path in input_files if path is not None and os.path.exists(path)]
+    input_times += [t for t in extra_times if t is not None]
+    return not input_times or os.path.getmtime(output_file) >= max(input_times)
+
+def _plot_contours_job(job):
+    try:
+        return plot_contours(*job)
+    except Exception as e:
+        print(f"Failed to plot {job[1]}: {e}")
+        return None
+
+@metrics.stage('part4_bullseye')
+def plot_bullseye(max_workers=None, force=False):
 
     # Path to the GEDI_data directory
     base_dir = 'GEDI_data'
     output_dir = 'figures'
     os.makedirs(output_dir, exist_ok=True)
 
-    # List of subdirectories under GEDI_data
-    directories = [os.path.join(base_dir, d) for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))]
+    # Granule subdirectories under GEDI_data (not the footprints/results datasets or the DEM cache)
+    directories = [os.path.join(base_dir, d) for d in os.listdir(base_dir)
+                   if d.startswith('GEDI02_A_') and os.path.isdir(os.path.join(base_dir, d))]
 
     beams = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
 
-    # Process each directory
+    # Results of all granules come from one query of the results index
+    index = results_index.open_index(os.path.join(base_dir, 'results_index.sqlite'), base_dir)
+    with metrics.timer('part4.load_results'):
+        granule_results = dict(tuple(index.query(beams=beams).groupby('granule', sort=False)))
+
+    # Process each directory; figures newer than all of their .npy files and index rows are not rendered again
+    jobs = []
     for dir_path in directories:
         geomatrix_path = os.path.join(dir_path, 'abs_adjusted_elev_diffs_beamname.npy')
         results_path = os.path.join(dir_path, 'results_beamname.csv')
-        if not (os.path.exists(geomatrix_path.replace('beamname', beams[0])) and os.path.exists(results_path.replace('beamname', beams[0]))):
+        results = granule_results.get(os.path.basename(dir_path))
+        if not (os.path.exists(geomatrix_path.replace('beamname', beams[0])) and results is not None and
+                (results['beam'] == beams[0]).any()):
             print(f"Data not complete in {dir_path}, skipping this directory.")
             continue
-        plot_contours(beams, geomatrix_path, results_path, output_dir)
-
-    return 0
\ No newline at end of file
+        output_file = os.path.join(output_dir, 'bulleyes_' + os.path.basename(dir_path) + '.png')
+        input_files = [geomatrix_path.replace('beamname', beam) for beam in beams]
+        if not force and is_up_to_date(output_file, input_files, results['updated']):
+            print(f"{output_file} is up to date, skipping this directory.")
+            metrics.count('part4.figures.up_to_date')
+            continue
+        jobs.append((beams, geomatrix_path, results_path, output_dir, results))
+
+    # Figures are rendered headless (Agg) in a process pool
+    with metrics.timer('part4.render_bullseyes'):
+        if len(jobs) < 2 or max_workers == 1:
+            outputs = [_plot_contours_job(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                outputs = list(executor.map(_plot_contours_job, jobs))
+    metrics.count('part4.figures.rendered', sum(1 for output in outputs if output))
+    print(f"Rendered {sum(1 for output in outputs if output)} of {len(jobs)} bullseye figures")
+
+    return 0
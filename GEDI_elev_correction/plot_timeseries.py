@@ -1,59 +1,36 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
+from GEDI_elev_correction import results_index, plot_bullseye, metrics
 
-def julian_to_gregorian(year, julian_day, hhmmss):
-    base_date = datetime(year=year, month=1, day=1) + timedelta(days=(julian_day - 1))
-    hours = int(hhmmss[:2])
-    minutes = int(hhmmss[2:4])
-    seconds = int(hhmmss[4:6])
-    return base_date + timedelta(hours=hours, minutes=minutes, seconds=seconds)
-
-def extract_date_from_path(dir_name):
-    try:
-        year = int(dir_name[9:13])
-        julian_day = int(dir_name[13:16])
-        hhmmss = dir_name[16:22]
-        return julian_to_gregorian(year, julian_day, hhmmss)
-    except ValueError:
-        raise ValueError(f"Invalid date format in directory name: {dir_name}")
-
-def load_and_process_data(base_dir, beams):
-    all_data = []
-    all_dates = []
-
-    directories = [os.path.join(base_dir, d) for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))]
+def load_and_process_data(base_dir, beams, results=None):
+    """Date-indexed cross/along-track offsets of the granules with results for all beams
 
-    for dir_path in directories:
-        dir_name = os.path.basename(dir_path)
+    results are rows of the results index (queried from base_dir/results_index.sqlite when not given).
+    """
+    if results is None:
+        results = results_index.open_index(os.path.join(base_dir, 'results_index.sqlite'), base_dir).query(beams=beams)
+    all_data = []
 
-        try:
-            date = extract_date_from_path(dir_name)
-        except ValueError as e:
-            print(e)
+    for granule, rows in results[results['beam'].isin(beams)].groupby('granule', sort=False):
+        if rows['acquired'].isna().any():
+            print(f"Invalid date format in directory name: {granule}")
+            continue
+        rows = rows.set_index('beam')
+        missing = [beam for beam in beams if beam not in rows.index]
+        if missing:
+            print(f"Results not found for {missing[0]} in {granule}, skipping this granule.")
             continue
 
-        cross_track = []
-        along_track = []
-
-        for beam in beams:
-            results_file = os.path.join(dir_path, f'results_{beam}.csv')
-            if not os.path.exists(results_file):
-                print(f"Results file not found: {results_file}, skipping this beam.")
-                break
-
-            results = pd.read_csv(results_file)
-            cross_track.append(results['adjusted_x'][0])
-            along_track.append(results['adjusted_y'][0])
-        else:
-            all_data.append((date, cross_track, along_track))
-            all_dates.append(date)
+        cross_track = [rows.at[beam, 'adjusted_x'] for beam in beams]
+        along_track = [rows.at[beam, 'adjusted_y'] for beam in beams]
+        all_data.append((rows['acquired'].iloc[0].to_pydatetime(), cross_track, along_track))
 
     return pd.DataFrame(all_data, columns=['Date', 'CrossTrack', 'AlongTrack']).set_index('Date')
 
 def plot_data(df, beams, output_file):
+    plt = plot_bullseye.headless_pyplot()
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(15, 10), sharex=True)
 
     for i, beam in enumerate(beams):
@@ -88,9 +65,10 @@ def plot_data(df, beams, output_file):
     ax2.grid(False)
 
     plt.savefig(output_file, dpi=300)
-    plt.show()
+    plt.close(fig)
 
-def plot_timeseries():
+@metrics.stage('part4_timeseries')
+def plot_timeseries(force=False):
     base_dir = 'GEDI_data'
     output_dir = 'figures'
     os.makedirs(output_dir, exist_ok=True)
@@ -98,8 +76,19 @@ def plot_timeseries():
     beams_group1 = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011']
     beams_group2 = ['BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
 
-    df_group1 = load_and_process_data(base_dir, beams_group1)
-    df_group2 = load_and_process_data(base_dir, beams_group2)
+    # One query of the results index; nothing to do when both figures are newer than the index
+    # (every part 3 upsert or delete writes to it)
+    index_path = os.path.join(base_dir, 'results_index.sqlite')
+    index = results_index.open_index(index_path, base_dir)
+    output_files = [os.path.join(output_dir, f'GEDI_geolocation_offsets_group{group}.png') for group in (1, 2)]
+    if not force and all(plot_bullseye.is_up_to_date(output_file, [index_path]) for output_file in output_files):
+        print("Time-series figures are up to date.")
+        return 0
+
+    with metrics.timer('part4.load_results'):
+        results = index.query(beams=beams_group1 + beams_group2)
+        df_group1 = load_and_process_data(base_dir, beams_group1, results)
+        df_group2 = load_and_process_data(base_dir, beams_group2, results)
 
     if not df_group1.empty:
         plot_data(df_group1, beams_group1, os.path.join(output_dir, 'GEDI_geolocation_offsets_group1.png'))
@@ -110,5 +99,4 @@ def plot_timeseries():
         plot_data(df_group2, beams_group2, os.path.join(output_dir, 'GEDI_geolocation_offsets_group2.png'))
     else:
         print("No valid data found for group 2.")
-
-plot_timeseries()
+    return 0
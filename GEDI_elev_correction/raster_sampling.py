@@ -0,0 +1,35 @@
+import numpy as np
+from rasterio.windows import Window
+
+
+def read_raster_points(src, rows, cols, block_size=1024, lock=None, band=1):
+    """Values of a rasterio dataset at integer pixel positions, NaN outside the raster or at nodata
+
+    Points are grouped by the block_size x block_size raster block they fall in, and each group is
+    served by one windowed read covering just its points, so scattered points never pull in a whole
+    tile. lock, if given, serialises the reads (rasterio datasets are not thread-safe).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.full(rows.shape, np.nan)
+    inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+    if not np.any(inside):
+        return values
+
+    idx = np.flatnonzero(inside)
+    block_keys = (rows[idx] // block_size) * (src.width // block_size + 1) + cols[idx] // block_size
+    order = np.argsort(block_keys, kind='stable')
+    idx = idx[order]
+    _, starts = np.unique(block_keys[order], return_index=True)
+    for group in np.split(idx, starts[1:]):
+        row_off, col_off = rows[group].min(), cols[group].min()
+        window = Window(col_off, row_off, cols[group].max() - col_off + 1, rows[group].max() - row_off + 1)
+        if lock is not None:
+            with lock:
+                block = src.read(band, window=window, masked=True)
+        else:
+            block = src.read(band, window=window, masked=True)
+        picked = block[rows[group] - row_off, cols[group] - col_off]
+        values[group] = np.ma.filled(picked.astype(float), np.nan)
+
+    return values
@@ -0,0 +1,162 @@
+import time
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from GEDI_elev_correction import metrics
+
+QUOTA_MARKERS = ('quota', 'too many requests', 'too many concurrent', 'rate limit', '429', 'resource exhausted')
+# Requests too big for the backend, worth retrying as smaller batches
+PAYLOAD_MARKERS = ('payload', 'too large', 'request size', '413', 'memory limit', 'too many elements')
+# Failures of the connection or the service that may pass on their own
+TRANSIENT_MARKERS = ('timeout', 'timed out', 'connection', 'temporarily', 'unavailable', 'internal error',
+                     'deadline', '500', '502', '503', '504')
+
+
+def is_quota_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in QUOTA_MARKERS)
+
+
+def is_payload_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in PAYLOAD_MARKERS)
+
+
+def is_transient_error(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in TRANSIENT_MARKERS)
+
+
+class RequestScheduler:
+    """Pipelines point lookups through a request function in size-bounded, concurrent payloads
+
+    send(latitudes, longitudes) must return one value per point or raise. Points from any number of
+    footprints are cut into batches whose size adapts to the observed latency (grow while requests
+    finish under target_latency, shrink multiplicatively when they do not) and never exceeds the
+    payload limit. At most max_in_flight requests run at once. Quota errors are retried with
+    exponential backoff and temporarily lower the concurrency, transient errors are retried with backoff
+    and payload errors are retried at once on halved batches; any other error fails its points without
+    retrying. Results are written back by position, so callers route them to footprints by slicing.
+    Latencies, payload sizes, retries and failures are recorded as metrics under `name`; stats() uses the
+    last latency_window latencies.
+    """
+
+    def __init__(self, send, max_in_flight=8, batch_size=1000, min_batch_size=100, max_batch_size=5000,
+                 max_payload_bytes=10485760, bytes_per_point=200, target_latency=10.0,
+                 max_retries=5, backoff=2.0, max_backoff=120.0, name='requests', latency_window=1000):
+        self.send = send
+        self.name = name
+        self.bytes_per_point = bytes_per_point
+        self.max_in_flight = max_in_flight
+        self.in_flight_limit = max_in_flight
+        self.min_batch_size = min_batch_size
+        # Earth Engine rejects requests over 10 MB; each point costs about bytes_per_point
+        self.max_batch_size = max(min_batch_size, min(max_batch_size, max_payload_bytes // bytes_per_point))
+        self.batch_size = int(np.clip(batch_size, self.min_batch_size, self.max_batch_size))
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.requests = 0
+        self.retries = 0
+        self.quota_errors = 0
+        self.failed_points = 0
+        self.latencies = deque(maxlen=latency_window)
+
+    def _timed_send(self, latitudes, longitudes):
+        start = time.monotonic()
+        values = np.asarray(self.send(latitudes, longitudes), dtype=float)
+        if values.shape != latitudes.shape:
+            raise ValueError(f"Expected {latitudes.size} values, got {values.size}")
+        latency = time.monotonic() - start
+        metrics.observe(f'{self.name}.latency', latency)
+        metrics.observe(f'{self.name}.payload_points', latitudes.size)
+        metrics.observe(f'{self.name}.payload_bytes', latitudes.size * self.bytes_per_point)
+        return values, latency
+
+    def _adapt(self, size, latency):
+        if latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, int(size * 0.7))
+        elif size >= self.batch_size:
+            self.batch_size = min(self.max_batch_size, int(self.batch_size * 1.25) + 1)
+        if self.in_flight_limit < self.max_in_flight:
+            self.in_flight_limit += 1
+
+    def run(self, latitudes, longitudes):
+        """Look up all points; returns (values, failed) with values NaN where failed is True"""
+        latitudes = np.asarray(latitudes, dtype=float).ravel()
+        longitudes = np.asarray(longitudes, dtype=float).ravel()
+        n = latitudes.size
+        values = np.full(n, np.nan)
+        failed = np.zeros(n, dtype=bool)
+        cursor = 0
+        retry_queue = deque()
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while cursor < n or retry_queue or in_flight:
+                now = time.monotonic()
+                while len(in_flight) < self.in_flight_limit:
+                    if retry_queue and retry_queue[0][3] <= now:
+                        start, stop, attempt, _ = retry_queue.popleft()
+                    elif cursor < n:
+                        start, stop, attempt = cursor, min(n, cursor + self.batch_size), 0
+                        cursor = stop
+                    else:
+                        break
+                    future = executor.submit(self._timed_send, latitudes[start:stop], longitudes[start:stop])
+                    in_flight[future] = (start, stop, attempt)
+                    self.requests += 1
+                    metrics.count(f'{self.name}.requests')
+
+                if not in_flight:
+                    time.sleep(max(0.0, retry_queue[0][3] - now))
+                    continue
+                timeout = max(0.0, retry_queue[0][3] - now) if retry_queue else None
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    start, stop, attempt = in_flight.pop(future)
+                    try:
+                        batch_values, latency = future.result()
+                    except Exception as e:
+                        quota, payload = is_quota_error(e), is_payload_error(e)
+                        splittable = payload and stop - start > self.min_batch_size
+                        if attempt >= self.max_retries or not (quota or splittable or is_transient_error(e)):
+                            print(f"Giving up on points {start}-{stop} after {attempt + 1} attempts: {e}")
+                            failed[start:stop] = True
+                            self.failed_points += stop - start
+                            metrics.count(f'{self.name}.failed_points', stop - start)
+                            continue
+                        self.retries += 1
+                        metrics.count(f'{self.name}.retries')
+                        delay = min(self.max_backoff, self.backoff * 2 ** attempt) * (1 + random.random())
+                        if quota:
+                            self.quota_errors += 1
+                            metrics.count(f'{self.name}.quota_errors')
+                            self.in_flight_limit = max(1, self.in_flight_limit // 2)
+                            retry_queue.append((start, stop, attempt + 1, time.monotonic() + delay))
+                        elif splittable:
+                            # Oversized payload: retry as two halves right away, waiting does not help
+                            self.batch_size = max(self.min_batch_size, (stop - start) // 2)
+                            middle = start + (stop - start) // 2
+                            retry_queue.append((start, middle, attempt + 1, time.monotonic()))
+                            retry_queue.append((middle, stop, attempt + 1, time.monotonic()))
+                        else:
+                            retry_queue.append((start, stop, attempt + 1, time.monotonic() + delay))
+                        retry_queue = deque(sorted(retry_queue, key=lambda item: item[3]))
+                        continue
+                    values[start:stop] = batch_values
+                    self.latencies.append(latency)
+                    self._adapt(stop - start, latency)
+
+        return values, failed
+
+    def stats(self):
+        latencies = np.array(self.latencies) if self.latencies else np.array([np.nan])
+        return {'requests': self.requests, 'retries': self.retries, 'quota_errors': self.quota_errors,
+                'failed_points': self.failed_points, 'batch_size': self.batch_size,
+                'median_latency': float(np.median(latencies))}
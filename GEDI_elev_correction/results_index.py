@@ -0,0 +1,151 @@
+import os
+import time
+import sqlite3
+import pandas as pd
+from datetime import datetime, timedelta
+from GEDI_elev_correction import intermediate
+
+INDEX_FILE = os.path.join('GEDI_data', 'results_index.sqlite')
+BEAMS = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    granule TEXT NOT NULL,
+    beam TEXT NOT NULL,
+    orbit TEXT,
+    acquired TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (granule, beam)
+);
+CREATE INDEX IF NOT EXISTS results_acquired ON results (acquired);
+CREATE INDEX IF NOT EXISTS results_orbit ON results (orbit);
+CREATE INDEX IF NOT EXISTS results_beam ON results (beam);
+'''
+KEY_COLUMNS = ['granule', 'beam', 'orbit', 'acquired', 'updated']
+
+
+def julian_to_gregorian(year, julian_day, hhmmss):
+    base_date = datetime(year=year, month=1, day=1) + timedelta(days=(julian_day - 1))
+    hours = int(hhmmss[:2])
+    minutes = int(hhmmss[2:4])
+    seconds = int(hhmmss[4:6])
+    return base_date + timedelta(hours=hours, minutes=minutes, seconds=seconds)
+
+def extract_date_from_path(dir_name):
+    """Acquisition time of a granule name, e.g. GEDI02_A_2023011070157_... -> 2023-01-11 07:01:57"""
+    try:
+        year = int(dir_name[9:13])
+        julian_day = int(dir_name[13:16])
+        hhmmss = dir_name[16:22]
+        return julian_to_gregorian(year, julian_day, hhmmss)
+    except ValueError:
+        raise ValueError(f"Invalid date format in directory name: {dir_name}")
+
+
+def _timestamp(value):
+    # acquired is stored as ISO text, so date-range filters are plain string comparisons on the index
+    return pd.Timestamp(value).isoformat()
+
+
+class ResultsIndex:
+    """One SQLite table with the part 3 result of every granule/beam, keyed by (granule, beam)
+
+    Result fields are columns; a field not seen before (e.g. from a newer part 3) is added on upsert.
+    Orbit and acquisition time are parsed from the granule name, and acquired, orbit and beam are indexed.
+    """
+
+    def __init__(self, db_path=INDEX_FILE):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def columns(self, connection=None):
+        if connection is None:
+            with self._connect() as connection:
+                return self.columns(connection)
+        return [row[1] for row in connection.execute('PRAGMA table_info(results)')]
+
+    def upsert(self, granule, beam, result):
+        """Insert or replace the result (a dict of fields) of one beam of one granule"""
+        try:
+            acquired = extract_date_from_path(granule).isoformat()
+            orbit = intermediate.orbit_of(granule)
+        except (ValueError, IndexError):
+            acquired, orbit = None, None
+        row = {key: (value.item() if hasattr(value, 'item') else value) for key, value in result.items()
+               if key not in KEY_COLUMNS}
+        row.update(granule=granule, beam=beam, orbit=orbit, acquired=acquired, updated=time.time())
+        connection = self._connect()
+        try:
+            existing = self.columns(connection)
+            for column in row:
+                if column not in existing:
+                    try:
+                        connection.execute(f'ALTER TABLE results ADD COLUMN "{column}"')
+                    except sqlite3.OperationalError as e:
+                        if 'duplicate column' not in str(e):  # another process added it first
+                            raise
+            names = ', '.join(f'"{column}"' for column in row)
+            with connection:
+                connection.execute(f'INSERT OR REPLACE INTO results ({names}) VALUES ({", ".join("?" * len(row))})',
+                                   list(row.values()))
+        finally:
+            connection.close()
+
+    def delete(self, granule, beam):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM results WHERE granule = ? AND beam = ?', (granule, beam))
+
+    def query(self, start=None, end=None, beams=None, orbits=None, granules=None, columns=None):
+        """Results as a DataFrame ordered by acquisition time, filtered by [start, end], beams, orbits, granules
+
+        start/end take anything pd.Timestamp accepts; beams/orbits/granules are lists (or one value).
+        """
+        conditions, params = [], []
+        if start is not None:
+            conditions.append('acquired >= ?')
+            params.append(_timestamp(start))
+        if end is not None:
+            conditions.append('acquired <= ?')
+            params.append(_timestamp(end))
+        for column, values in (('beam', beams), ('orbit', orbits), ('granule', granules)):
+            if values is not None:
+                values = [values] if isinstance(values, str) else list(values)
+                conditions.append(f'{column} IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+        selected = ', '.join(f'"{column}"' for column in columns) if columns else '*'
+        sql = f'SELECT {selected} FROM results'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        with self._connect() as connection:
+            df = pd.read_sql_query(sql + ' ORDER BY acquired, granule, beam', connection, params=params)
+        if 'acquired' in df:
+            df['acquired'] = pd.to_datetime(df['acquired'])
+        return df
+
+    def rebuild(self, base_dir='GEDI_data', beams=BEAMS):
+        """Upsert every results_{beam}.csv / results dataset row found under base_dir; returns the count"""
+        count = 0
+        for d in sorted(os.listdir(base_dir)):
+            dir_path = os.path.join(base_dir, d)
+            if not os.path.isdir(dir_path):
+                continue
+            for beam in beams:
+                results = intermediate.load_result(dir_path, beam)
+                if results is not None and len(results):
+                    self.upsert(d, beam, results.iloc[0].drop(['Granule', 'orbit', 'beam'], errors='ignore').to_dict())
+                    count += 1
+        return count
+
+
+def open_index(db_path=INDEX_FILE, base_dir='GEDI_data'):
+    """The results index, backfilled from the per-beam results files when it does not exist yet"""
+    exists = os.path.exists(db_path)
+    index = ResultsIndex(db_path)
+    if not exists and os.path.isdir(base_dir):
+        print(f"Indexed {index.rebuild(base_dir)} existing beam results in {db_path}")
+    return index
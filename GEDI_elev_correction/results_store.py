@@ -0,0 +1,235 @@
+import os
+import json
+import numpy as np
+import h5py
+from GEDI_elev_correction import accumulators
+
+METADATA_COLUMNS = ['Index', 'Latitude', 'Longitude', 'Smoothed_Tan', 'Geoid_Height']
+STORAGE_MODES = ('npy', 'h5')
+
+
+class FootprintStore:
+    """Append-only, resumable store of one beam's footprint difference matrices
+
+    Accepted matrices are buffered and appended every flush_every footprints to a raw float64 file
+    (readable as a growable np.memmap), together with one metadata row per footprint. A small JSON state
+    file, replaced atomically after each flush, records how many matrices are on disk and the index of
+    the next footprint to process, so a restarted run resumes there. finalize() turns the raw files into
+    the usual elev_diffs_{beam}.npy / abs_elev_diffs_{beam}.npy in chunks, keeping memory bounded, or into
+    a single compressed float32 elev_diffs_{beam}.h5 (storage='h5', see write_h5_stack).
+    A GridAccumulator of |elev_diff| is kept alongside (accum_abs_elev_diffs_{beam}.npz) for part 3.
+    """
+
+    def __init__(self, root, beam_name, shape=(71, 71), flush_every=50):
+        self.root = root
+        self.beam_name = beam_name
+        self.shape = tuple(shape)
+        self.flush_every = flush_every
+        self.data_path = os.path.join(root, f'elev_diffs_{beam_name}.partial')
+        self.metadata_path = os.path.join(root, f'elev_diffs_{beam_name}.partial_meta')
+        self.state_path = os.path.join(root, f'elev_diffs_{beam_name}.state.json')
+        self.accumulator_path = os.path.join(root, f'accum_abs_elev_diffs_{beam_name}.npz')
+        self._buffer = []
+        self._metadata = []
+        self._pending = 0
+
+        self.count = 0
+        self.next_index = 0
+        self.valid_footprints = 0
+        self.invalid_footprints = 0
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.count = state['count']
+            self.next_index = state['next_index']
+            self.valid_footprints = state['valid_footprints']
+            self.invalid_footprints = state['invalid_footprints']
+        # Drop anything appended after the last recorded state (e.g. a crash in the middle of a flush)
+        for path, row_size in ((self.data_path, self._matrix_size), (self.metadata_path, len(METADATA_COLUMNS))):
+            with open(path, 'ab') as f:
+                f.truncate(self.count * row_size * 8)
+
+        # Running sum/count of |elev_diff| for part 3; rebuilt from the flushed matrices if out of step
+        self.accumulator = None
+        if os.path.exists(self.accumulator_path):
+            self.accumulator = accumulators.GridAccumulator.load(self.accumulator_path)
+        if self.accumulator is None or self.accumulator.n != self.count:
+            self.accumulator = accumulators.GridAccumulator.from_stack(self.elev_diffs(), transform=np.abs)
+
+    @property
+    def _matrix_size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def resumed(self):
+        return self.next_index > 0
+
+    def append(self, index, elev_diff, metadata):
+        """Record an accepted footprint; metadata holds the METADATA_COLUMNS after Index"""
+        self._buffer.append(np.asarray(elev_diff, dtype=np.float64))
+        self._metadata.append([index, *metadata])
+        self.valid_footprints += 1
+        self.next_index = max(self.next_index, int(index) + 1)
+        self._pending += 1
+
+    def reject(self, index):
+        self.invalid_footprints += 1
+        self.next_index = max(self.next_index, int(index) + 1)
+        self._pending += 1
+
+    def maybe_flush(self):
+        """Flush once flush_every footprints (accepted or rejected) have been recorded since the last flush"""
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            with open(self.data_path, 'ab') as f:
+                f.write(np.stack(self._buffer).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.metadata_path, 'ab') as f:
+                f.write(np.array(self._metadata, dtype=np.float64).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.count += len(self._buffer)
+            self.accumulator.add(np.abs(np.stack(self._buffer)))
+            self.accumulator.save(self.accumulator_path)
+            self._buffer = []
+            self._metadata = []
+        self._pending = 0
+
+        state = {'count': self.count, 'next_index': self.next_index, 'shape': list(self.shape),
+                 'valid_footprints': self.valid_footprints, 'invalid_footprints': self.invalid_footprints}
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def elev_diffs(self):
+        """Flushed matrices as a read-only (count, *shape) memmap"""
+        if self.count == 0:
+            return np.empty((0,) + self.shape)
+        return np.memmap(self.data_path, dtype=np.float64, mode='r', shape=(self.count,) + self.shape)
+
+    def metadata(self):
+        if self.count == 0:
+            return np.empty((0, len(METADATA_COLUMNS)))
+        return np.fromfile(self.metadata_path, dtype=np.float64).reshape(self.count, len(METADATA_COLUMNS))
+
+    def finalize(self, chunk_size=256, storage='npy', quantize_decimals=None):
+        """Write the final stack(s) of the beam and remove the partial files
+
+        storage='npy' writes elev_diffs_{beam}.npy and abs_elev_diffs_{beam}.npy; storage='h5' writes only
+        elev_diffs_{beam}.h5 (signed float32 plus per-footprint metadata; readers take np.abs themselves).
+        """
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage mode: {storage}")
+        self.flush()
+        source = self.elev_diffs()
+        filenames = []
+        if storage == 'h5':
+            filename = os.path.join(self.root, f'elev_diffs_{self.beam_name}.h5')
+            write_h5_stack(filename, source, self.metadata(), chunk_size, quantize_decimals)
+            filenames.append(filename)
+        else:
+            for prefix, transform in (('elev_diffs', None), ('abs_elev_diffs', np.abs)):
+                filename = os.path.join(self.root, f'{prefix}_{self.beam_name}.npy')
+                filenames.append(filename)
+                if self.count == 0:
+                    np.save(filename, np.array([]))
+                    continue
+                tmp_path = filename + '.tmp.npy'
+                target = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64, shape=source.shape)
+                for start in range(0, self.count, chunk_size):
+                    chunk = source[start:start + chunk_size]
+                    target[start:start + chunk_size] = chunk if transform is None else transform(chunk)
+                target.flush()
+                del target
+                os.replace(tmp_path, filename)
+        del source
+        for path in (self.data_path, self.metadata_path, self.state_path):
+            os.remove(path)
+        return filenames
+
+
+def write_h5_stack(filename, stack, metadata=None, chunk_size=256, quantize_decimals=None, shape=(71, 71)):
+    """Write a (N, 71, 71) stack of signed elevation differences as one compressed, chunked float32 dataset
+
+    Chunks hold up to 64 footprints and are gzip/shuffle compressed; quantize_decimals=3 additionally
+    applies HDF5 scale-offset quantization to 1 mm. metadata is a (N, 5) array of METADATA_COLUMNS
+    (NaN where unknown, e.g. for migrated .npy stacks). The file is written under a temporary name and
+    moved into place, so an existing file is never left half-written.
+    """
+    count = stack.shape[0] if np.ndim(stack) == 3 else 0
+    shape = tuple(stack.shape[1:]) if count else tuple(shape)
+    if metadata is None:
+        metadata = np.full((count, len(METADATA_COLUMNS)), np.nan)
+    tmp_path = filename + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        options = {}
+        if count:
+            options = {'chunks': (min(64, count),) + shape, 'compression': 'gzip', 'compression_opts': 4}
+            if quantize_decimals is None:
+                options['shuffle'] = True
+            else:
+                options['scaleoffset'] = quantize_decimals
+        dataset = f.create_dataset('elev_diffs', shape=(count,) + shape, dtype=np.float32, **options)
+        for start in range(0, count, chunk_size):
+            dataset[start:start + chunk_size] = np.asarray(stack[start:start + chunk_size], dtype=np.float32)
+        for column, values in zip(METADATA_COLUMNS, np.asarray(metadata, dtype=np.float64).T):
+            f.create_dataset(column, data=values)
+        f.attrs['count'] = count
+        if quantize_decimals is not None:
+            f.attrs['quantize_decimals'] = quantize_decimals
+    os.replace(tmp_path, filename)
+    return filename
+
+
+def find_beam_stack(root, beam_name):
+    """Path of the beam's signed stack: elev_diffs_{beam}.h5 if present, else elev_diffs_{beam}.npy, else None"""
+    for extension in ('h5', 'npy'):
+        path = os.path.join(root, f'elev_diffs_{beam_name}.{extension}')
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def abs_accumulator(path, chunk_size=256):
+    """GridAccumulator of |elev_diff| streamed in chunks from an .h5 or .npy stack (abs taken on the fly)"""
+    if path.endswith('.h5'):
+        with h5py.File(path, 'r') as f:
+            return accumulators.GridAccumulator.from_stack(f['elev_diffs'], chunk_size, transform=np.abs)
+    return accumulators.GridAccumulator.from_stack(np.load(path, mmap_mode='r'), chunk_size, transform=np.abs)
+
+
+def migrate_npy_stacks(base_dir='GEDI_data', quantize_decimals=None, remove=False):
+    """Convert existing elev_diffs_{beam}.npy / abs_elev_diffs_{beam}.npy pairs to elev_diffs_{beam}.h5
+
+    Footprint metadata was not kept by the .npy outputs, so it is stored as NaN. The accumulator used by
+    part 3 is written as well when missing. remove=True deletes both .npy files after a successful write.
+    """
+    migrated = []
+    for root, dirs, files in os.walk(base_dir):
+        for file in files:
+            if not (file.startswith('elev_diffs_BEAM') and file.endswith('.npy')):
+                continue
+            beam_name = file[len('elev_diffs_'):-len('.npy')]
+            npy_path = os.path.join(root, file)
+            h5_path = os.path.join(root, f'elev_diffs_{beam_name}.h5')
+            if os.path.exists(h5_path):
+                print(f"{h5_path} already exists. Skipping migration.")
+                continue
+            stack = np.load(npy_path, mmap_mode='r')
+            write_h5_stack(h5_path, stack, quantize_decimals=quantize_decimals)
+            accumulator_path = os.path.join(root, f'accum_abs_elev_diffs_{beam_name}.npz')
+            if not os.path.exists(accumulator_path):
+                accumulators.GridAccumulator.from_stack(stack, transform=np.abs).save(accumulator_path)
+            del stack
+            if remove:
+                for path in (npy_path, os.path.join(root, f'abs_elev_diffs_{beam_name}.npy')):
+                    if os.path.exists(path):
+                        os.remove(path)
+            print(f"Migrated {npy_path} to {h5_path}")
+            migrated.append(h5_path)
+    return migrated
@@ -0,0 +1,311 @@
+import os
+import time
+import shutil
+import socket
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from GEDI_elev_correction import Calculating_elev_diffs, accumulators, coverage_index, metrics
+
+QUEUE_FILE = os.path.join('GEDI_data', 'part2_queue.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    csv_path TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    error TEXT,
+    UNIQUE (csv_path, start)
+);
+CREATE TABLE IF NOT EXISTS beams (
+    csv_path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    beam TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'open'
+);
+'''
+
+
+def shard_dir(root, beam):
+    return os.path.join(root, f'shards_{beam}')
+
+
+def shard_name(beam, start):
+    return f'{beam}_{start:07d}'
+
+
+class WorkQueue:
+    """SQLite queue of part 2 work units (a range of footprints of one *_Filtered_data.csv beam)
+
+    A unit is claimed with a lease that its worker renews while it runs; units whose lease expired (a
+    crashed or killed worker) are handed out again, up to max_attempts times in total; units that expire or
+    fail that often are marked failed and their beam is not merged. Enqueueing the beam again (the enqueue
+    stage) puts its failed units back to pending with no attempts. The database can live on a filesystem
+    shared by several hosts as long as that filesystem supports POSIX locks.
+    """
+
+    def __init__(self, db_path=QUEUE_FILE, max_attempts=3):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _transaction(self, statements):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim the same unit
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            result = statements(connection)
+            connection.execute('COMMIT')
+            return result
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def enqueue_beam(self, csv_path, root, beam, n_footprints, unit_size=512):
+        def statements(connection):
+            connection.execute('INSERT OR IGNORE INTO beams (csv_path, root, beam) VALUES (?, ?, ?)',
+                               (csv_path, root, beam))
+            # An empty beam still gets one (empty) unit, so that its merge writes the usual empty outputs.
+            # Existing units are kept, except failed ones, which are requeued
+            for start in range(0, max(n_footprints, 1), unit_size):
+                connection.execute("INSERT INTO units (csv_path, start, stop) VALUES (?, ?, ?) "
+                                   "ON CONFLICT (csv_path, start) DO UPDATE SET status = 'pending', attempts = 0, "
+                                   "worker = NULL, lease_expires = NULL WHERE status = 'failed'",
+                                   (csv_path, start, min(start + unit_size, n_footprints)))
+        self._transaction(statements)
+
+    def claim(self, worker, lease_seconds):
+        def statements(connection):
+            now = time.time()
+            expired = connection.execute(
+                "SELECT id, csv_path, start, stop FROM units WHERE status = 'leased' AND lease_expires < ? "
+                "AND attempts >= ?", (now, self.max_attempts)).fetchall()
+            for unit in expired:
+                print(f"Unit {unit['id']} (footprints {unit['start']}-{unit['stop']} of {unit['csv_path']}) "
+                      f"failed: lease expired after {self.max_attempts} attempts")
+                connection.execute("UPDATE units SET status = 'failed', lease_expires = NULL, "
+                                   "error = 'lease expired after max attempts' WHERE id = ?", (unit['id'],))
+            metrics.count('part2_worker.units.expired', len(expired))
+            unit = connection.execute(
+                "SELECT units.*, beams.root, beams.beam FROM units JOIN beams USING (csv_path) "
+                "WHERE (units.status = 'pending' OR (units.status = 'leased' AND units.lease_expires < ?)) "
+                "AND units.attempts < ? ORDER BY units.id LIMIT 1", (now, self.max_attempts)).fetchone()
+            if unit is None:
+                return None
+            connection.execute("UPDATE units SET status = 'leased', worker = ?, lease_expires = ?, "
+                               "attempts = attempts + 1 WHERE id = ?", (worker, now + lease_seconds, unit['id']))
+            return dict(unit)
+        return self._transaction(statements)
+
+    def renew(self, unit_id, worker, lease_seconds):
+        """Extend the lease; False when the unit is no longer leased by this worker"""
+        def statements(connection):
+            return connection.execute("UPDATE units SET lease_expires = ? WHERE id = ? AND worker = ? "
+                                      "AND status = 'leased'", (time.time() + lease_seconds, unit_id, worker)).rowcount
+        return self._transaction(statements) == 1
+
+    def complete(self, unit_id, worker):
+        """Mark the unit done; False when it is no longer leased by this worker"""
+        def statements(connection):
+            return connection.execute("UPDATE units SET status = 'done', lease_expires = NULL, error = NULL "
+                                      "WHERE id = ? AND worker = ? AND status = 'leased'", (unit_id, worker)).rowcount
+        return self._transaction(statements) == 1
+
+    def fail(self, unit_id, worker, error):
+        def statements(connection):
+            connection.execute("UPDATE units SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                               "lease_expires = NULL, error = ? WHERE id = ? AND worker = ?",
+                               (self.max_attempts, error, unit_id, worker))
+        self._transaction(statements)
+
+    def claim_merge(self):
+        """Mark one beam whose units are all done as merging and return it"""
+        def statements(connection):
+            beam = connection.execute(
+                "SELECT * FROM beams WHERE status = 'open' AND NOT EXISTS "
+                "(SELECT 1 FROM units WHERE units.csv_path = beams.csv_path AND units.status != 'done') "
+                "LIMIT 1").fetchone()
+            if beam is None:
+                return None
+            connection.execute("UPDATE beams SET status = 'merging' WHERE csv_path = ?", (beam['csv_path'],))
+            return dict(beam)
+        return self._transaction(statements)
+
+    def set_beam_status(self, csv_path, status):
+        self._transaction(lambda connection: connection.execute(
+            'UPDATE beams SET status = ? WHERE csv_path = ?', (status, csv_path)))
+
+    def beam_units(self, csv_path):
+        with self._connect() as connection:
+            return [dict(row) for row in connection.execute(
+                'SELECT * FROM units WHERE csv_path = ? ORDER BY start', (csv_path,))]
+
+    def status(self):
+        with self._connect() as connection:
+            units = dict(connection.execute('SELECT status, COUNT(*) FROM units GROUP BY status').fetchall())
+            beams = dict(connection.execute('SELECT status, COUNT(*) FROM beams GROUP BY status').fetchall())
+        return {'units': units, 'beams': beams}
+
+
+def enqueue_part2(db_path=QUEUE_FILE, base_dir='GEDI_data', unit_size=512):
+    """Split every *_Filtered_data.csv beam without final part 2 outputs into work units"""
+    queue = WorkQueue(db_path)
+    beam_prefixes = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
+    for root, dirs, files in os.walk(base_dir):
+        for file in files:
+            if any(file.startswith(prefix) and file.endswith('Filtered_data.csv') for prefix in beam_prefixes):
+                beam_name = file.split('_')[0]
+                if os.path.exists(os.path.join(root, f'abs_elev_diffs_{beam_name}.npy')):
+                    continue
+                csv_path = os.path.join(root, file)
+                n_footprints = len(pd.read_csv(csv_path, usecols=[0]))
+                queue.enqueue_beam(csv_path, root, beam_name, n_footprints, unit_size)
+    print(f"Part 2 queue: {queue.status()}")
+    return queue
+
+
+def merge_beam(root, beam, units, chunk_size=256):
+    """Concatenate the shard outputs of a beam, in footprint order, into the usual part 2 outputs"""
+    directory = shard_dir(root, beam)
+    shards = []
+    accumulator = accumulators.GridAccumulator()
+    for unit in units:
+        name = shard_name(beam, unit['start'])
+        stack = np.load(os.path.join(directory, f'elev_diffs_{name}.npy'), mmap_mode='r')
+        if stack.ndim == 3:
+            shards.append(stack)
+        accumulator_path = os.path.join(directory, f'accum_abs_elev_diffs_{name}.npz')
+        if os.path.exists(accumulator_path):
+            accumulator.merge(accumulators.GridAccumulator.load(accumulator_path))
+
+    count = sum(stack.shape[0] for stack in shards)
+    for prefix, transform in (('elev_diffs', None), ('abs_elev_diffs', np.abs)):
+        filename = os.path.join(root, f'{prefix}_{beam}.npy')
+        if count == 0:
+            np.save(filename, np.array([]))
+            continue
+        tmp_path = filename + '.tmp.npy'
+        target = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64,
+                                           shape=(count,) + shards[0].shape[1:])
+        offset = 0
+        for stack in shards:
+            for start in range(0, stack.shape[0], chunk_size):
+                chunk = np.asarray(stack[start:start + chunk_size])
+                target[offset:offset + chunk.shape[0]] = chunk if transform is None else transform(chunk)
+                offset += chunk.shape[0]
+        target.flush()
+        del target
+        os.replace(tmp_path, filename)
+    if count:
+        accumulator.save(os.path.join(root, f'accum_abs_elev_diffs_{beam}.npz'))
+    del shards
+    shutil.rmtree(directory)
+    print(f"Merged {len(units)} units ({count} footprints) of {beam} in {root}")
+
+
+def merge_completed(db_path=QUEUE_FILE):
+    """Merge every beam whose units are all done; safe to call from any number of workers"""
+    queue = WorkQueue(db_path)
+    while True:
+        beam = queue.claim_merge()
+        if beam is None:
+            return 0
+        try:
+            merge_beam(beam['root'], beam['beam'], queue.beam_units(beam['csv_path']))
+            queue.set_beam_status(beam['csv_path'], 'merged')
+        except Exception as e:
+            print(f"Failed to merge {beam['beam']} of {beam['csv_path']}: {e}")
+            queue.set_beam_status(beam['csv_path'], 'open')
+            return 1
+
+
+@metrics.stage('part2_worker')
+def run_worker(db_path=QUEUE_FILE, worker_id=None, lease_seconds=1800, max_attempts=3, elevation_source='gee',
+               dem_path=None, corridor_mode=False, dem_cache_dir=None,
+               dem_cache_size=4 * 1024 ** 3, geoid_file='g2012bu0.bin', geoid_method='nearest',
+               footprint_block_size=32, flush_every=50, coverage_file=None, smoothing_method='direct'):
+    """Claim and process part 2 units until the queue is empty, merging beams as they complete
+
+    Start one per process and host (python -c "from GEDI_elev_correction import work_queue;
+    work_queue.run_worker()"). Each unit is a process_beam call restricted to its footprint range and
+    written to GEDI_data/<granule>/shards_<beam>/, so a retried unit resumes from its last flush.
+    """
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    queue = WorkQueue(db_path, max_attempts)
+    resources = None
+    processed = 0
+    while True:
+        unit = queue.claim(worker_id, lease_seconds)
+        if unit is None:
+            break
+        if resources is None:
+            resources = (Calculating_elev_diffs.open_elevation_source(elevation_source, dem_path, dem_cache_dir,
+                                                                      dem_cache_size),
+                         Calculating_elev_diffs.load_geoid(geoid_file),
+                         coverage_index.CoverageIndex.from_file(coverage_file) if coverage_file else None)
+        source, geoid, coverage = resources
+        print(f"{worker_id} processing footprints {unit['start']}-{unit['stop']} of {unit['csv_path']}")
+
+        # Renew the lease while the unit runs. If a renewal fails (the lease expired and the unit may already be
+        # held by another worker, or the database is unreachable) the unit is aborted before its next write,
+        # so two workers never write the same shard files
+        stop_renewing = threading.Event()
+        lease_lost = threading.Event()
+
+        def renew(unit_id=unit['id']):
+            while not stop_renewing.wait(lease_seconds / 3):
+                try:
+                    renewed = queue.renew(unit_id, worker_id, lease_seconds)
+                except sqlite3.Error as e:
+                    print(f"{worker_id} could not renew the lease of unit {unit_id}: {e}")
+                    renewed = False
+                if not renewed:
+                    lease_lost.set()
+                    return
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            directory = shard_dir(unit['root'], unit['beam'])
+            os.makedirs(directory, exist_ok=True)
+            Calculating_elev_diffs.process_beam(unit['csv_path'], directory, shard_name(unit['beam'], unit['start']),
+                                                geoid, source, corridor_mode, geoid_method, footprint_block_size,
+                                                flush_every, coverage, smoothing_method=smoothing_method,
+                                                footprint_range=(unit['start'], unit['stop']), abort=lease_lost)
+            stop_renewing.set()
+            renewer.join()
+            if lease_lost.is_set():
+                raise Calculating_elev_diffs.BeamAborted(f"lease of unit {unit['id']} lost before completion")
+            if not queue.complete(unit['id'], worker_id):
+                raise Calculating_elev_diffs.BeamAborted(f"unit {unit['id']} is no longer leased by {worker_id}")
+            processed += 1
+            metrics.count('part2_worker.units.done')
+        except Exception as e:
+            print(f"{worker_id} failed on unit {unit['id']}: {e}")
+            metrics.count('part2_worker.units.aborted' if lease_lost.is_set() else 'part2_worker.units.failed')
+            try:
+                # Only releases the unit if it is still leased by this worker
+                queue.fail(unit['id'], worker_id, repr(e))
+            except sqlite3.Error as db_error:
+                print(f"{worker_id} could not release unit {unit['id']}: {db_error}")
+        finally:
+            stop_renewing.set()
+            renewer.join()
+        merge_completed(db_path)
+
+    merge_completed(db_path)
+    print(f"{worker_id} processed {processed} units; queue: {queue.status()}")
+    return 0
@@ -0,0 +1,91 @@
+"""RequestScheduler against a fake endpoint that injects quota, payload and permanent errors
+
+    python -m benchmarks.request_scheduler_benchmark --points 200000 --quota-rate 0.2
+
+The fake send sleeps latency + per_point * batch size, raises a quota error on a random share of the
+requests, rejects batches over --payload-limit points and fails every batch holding a "poisoned" point
+with a permanent error. Each scenario checks that every value comes back at its position, that only
+poisoned batches fail, and that permanent errors are not retried.
+"""
+import sys
+import time
+import argparse
+import threading
+import numpy as np
+from GEDI_elev_correction import request_scheduler
+
+
+class FakeEndpoint:
+    """send(latitudes, longitudes) returning latitude + longitude, with injected errors"""
+
+    def __init__(self, quota_rate=0.0, payload_limit=None, poisoned=(), latency=0.002, per_point=1e-6, seed=0):
+        self.quota_rate = quota_rate
+        self.payload_limit = payload_limit
+        self.poisoned = set(poisoned)
+        self.latency = latency
+        self.per_point = per_point
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.permanent_calls = 0
+
+    def __call__(self, latitudes, longitudes):
+        with self.lock:
+            self.calls += 1
+            quota = self.rng.random() < self.quota_rate
+        time.sleep(self.latency + self.per_point * latitudes.size)
+        if quota:
+            raise RuntimeError('429 Too Many Requests: quota exceeded')
+        if self.payload_limit is not None and latitudes.size > self.payload_limit:
+            raise RuntimeError(f'Request payload size exceeds the limit: {latitudes.size} points')
+        if self.poisoned.intersection(latitudes.tolist()):
+            with self.lock:
+                self.permanent_calls += 1
+            raise ValueError('Image.reduceRegions: Parameter "collection" is invalid')
+        return latitudes + longitudes
+
+
+def run_scenario(name, n_points, endpoint, **scheduler_kwargs):
+    latitudes = np.arange(n_points, dtype=float)
+    longitudes = np.full(n_points, 0.5)
+    scheduler = request_scheduler.RequestScheduler(endpoint, name=f'benchmark_{name}', **scheduler_kwargs)
+    start = time.perf_counter()
+    values, failed = scheduler.run(latitudes, longitudes)
+    seconds = time.perf_counter() - start
+
+    poisoned = np.isin(latitudes, list(endpoint.poisoned))
+    ok = bool(np.array_equal(values[~failed], (latitudes + longitudes)[~failed]) and np.all(failed[poisoned])
+              and np.all(np.isnan(values[failed])))
+    # A permanent error must not be retried: every poisoned point costs one failing request at most
+    ok = ok and endpoint.permanent_calls <= len(endpoint.poisoned)
+    result = dict(scheduler.stats(), seconds=seconds, calls=endpoint.calls, failed=int(failed.sum()),
+                  permanent_calls=endpoint.permanent_calls, passed=ok)
+    print(f"{name:<10} {seconds:7.2f} s {result['calls']:>6} calls {result['retries']:>5} retries "
+          f"{result['quota_errors']:>5} quota {result['failed']:>7} failed points  "
+          f"batch {result['batch_size']:>5}  {'PASS' if ok else 'FAIL'}")
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=100000)
+    parser.add_argument('--quota-rate', type=float, default=0.2, help='share of requests rejected by quota')
+    parser.add_argument('--payload-limit', type=int, default=1500, help='largest batch the endpoint accepts')
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    # Short backoff, so the benchmark measures the scheduler rather than its sleeps
+    kwargs = dict(max_in_flight=args.max_in_flight, batch_size=1000, min_batch_size=100, backoff=0.01,
+                  max_backoff=0.2, max_retries=8)
+    poisoned = np.linspace(0, args.points - 1, 5).astype(int).astype(float)
+    results = [
+        run_scenario('clean', args.points, FakeEndpoint(), **kwargs),
+        run_scenario('quota', args.points, FakeEndpoint(quota_rate=args.quota_rate), **kwargs),
+        run_scenario('payload', args.points, FakeEndpoint(payload_limit=args.payload_limit), **kwargs),
+        run_scenario('permanent', args.points, FakeEndpoint(poisoned=poisoned), **kwargs),
+    ]
+    return 0 if all(result['passed'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""Throughput and peak memory of the hot functions of the four parts on synthetic data
+
+    python -m benchmarks.run_benchmarks --scales 100 1000 --output benchmark_report.json
+
+For every scale (footprints per beam) a synthetic granule with a known geolocation offset is generated
+over a synthetic DEM and geoid (benchmarks/synthetic.py); no .h5 granules or Earth Engine credentials
+are needed. Each benchmark is timed once as is and, unless --no-memory, run again under tracemalloc for
+its peak allocation. The offset fitted from the mean |elev_diff| grid is checked against the truth.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from benchmarks import synthetic
+from GEDI_elev_correction import Load_GEDI_L2A_files, Calculating_elev_diffs, Calculating_2D_Gaussian
+from GEDI_elev_correction import elevation_sources, plot_bullseye, estimators
+
+
+def measure(function, items, unit, memory=True):
+    """Run function, returning (its result, a report entry with seconds, throughput and peak memory)"""
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    entry = {'items': items, 'unit': unit, 'seconds': seconds,
+             'throughput': items / seconds if seconds > 0 else None, 'peak_memory_mb': None}
+    if memory:
+        tracemalloc.start()
+        function()
+        entry['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+    return result, entry
+
+
+def _process_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_scale(work_dir, n_footprints, offset, memory=True, max_window_footprints=None, tolerance=1.5):
+    """All benchmarks on one synthetic granule with n_footprints shots per beam"""
+    truth = synthetic.make_dataset(work_dir, n_footprints, offset)
+    beams = synthetic.BEAMS
+    results = {}
+
+    # Part 1: HDF5 ingestion of all beams
+    centers, results['get_center_data'] = measure(
+        lambda: Load_GEDI_L2A_files.get_center_data(truth['granule'], beams),
+        n_footprints * len(beams), 'shots', memory)
+    data = centers['BEAM0000']
+    if max_window_footprints is not None:
+        data = data[:max_window_footprints]
+    lats, lons, elevations, tans = data[:, 0], data[:, 1], data[:, 2], data[:, 4]
+
+    # Part 2: geoid lookups, one point at a time and vectorized
+    geoid = Calculating_elev_diffs.load_geoid(truth['geoid'])
+    _, results['get_geoid_height'] = measure(
+        lambda: [Calculating_elev_diffs.get_geoid_height(lat, lon, *geoid) for lat, lon in zip(lats, lons)],
+        len(lats), 'points', memory)
+    (geoid_heights, _), results['get_geoid_heights'] = measure(
+        lambda: Calculating_elev_diffs.get_geoid_heights(lats, lons, *geoid), len(lats), 'points', memory)
+    elev_GEDI = elevations - geoid_heights
+
+    # Part 2: 91x91 windows of the local DEM, per footprint and in blocks of 32 footprints
+    source = elevation_sources.LocalRasterElevationSource(truth['dem'])
+    _, results['get_matrix_elev_diff'] = measure(
+        lambda: [Calculating_elev_diffs.get_matrix_elev_diff(lat, lon, elev, tan, elevation_source=source)
+                 for lat, lon, elev, tan in zip(lats, lons, elev_GEDI, tans)],
+        len(lats), 'footprints', memory)
+
+    def batched():
+        diffs, accepted = [], []
+        for block in np.array_split(np.arange(len(lats)), max(1, int(np.ceil(len(lats) / 32)))):
+            windows = Calculating_elev_diffs.get_elevation_windows(lats[block], lons[block], tans[block], source)
+            block_diffs, block_accepted = Calculating_elev_diffs.get_elev_diffs_from_dems(windows, elev_GEDI[block])
+            diffs.append(block_diffs)
+            accepted.append(block_accepted)
+        return np.concatenate(diffs), np.concatenate(accepted)
+    (elev_diffs, accepted), results['get_elev_diffs_from_dems'] = measure(batched, len(lats), 'footprints', memory)
+    source.close()
+
+    # Part 3: fit of the mean |elev_diff| grid, initialised at its minimum like part 3
+    mean_grid = np.mean(np.abs(elev_diffs[accepted]), axis=0)
+    min_pos = np.unravel_index(np.argmin(mean_grid), mean_grid.shape)
+    init_x = -35 + min_pos[1] * (70 / mean_grid.shape[1])
+    init_y = -35 + min_pos[0] * (70 / mean_grid.shape[0])
+    fit, results['fit_2d_inverted_gaussian'] = measure(
+        lambda: Calculating_2D_Gaussian.fit_2d_inverted_gaussian(mean_grid, init_x, init_y), 1, 'fits', memory)
+    x0, y0, _, _, fitted_data, bias, min_rmse = fit
+
+    # Part 3: the selectable offset estimators on the same grid, with their offset errors
+    estimator_errors = {}
+    for name in estimators.ESTIMATORS:
+        estimate, results[f'estimator_{name}'] = measure(
+            lambda: estimators.estimate(mean_grid, init_x, init_y, estimator=name), 1, 'fits', memory)
+        estimator_errors[name] = float(np.hypot(estimate['x0'] - truth['offset_x'], estimate['y0'] - truth['offset_y'])) \
+            if estimate['x0'] is not None else None
+
+    # Part 4: bullseye figure of the 8 beams (every beam gets the fitted grid of BEAM0000)
+    figure_dir = os.path.join(work_dir, f'figure_{n_footprints}', 'granule')
+    os.makedirs(figure_dir, exist_ok=True)
+    for beam in beams:
+        np.save(os.path.join(figure_dir, f'abs_adjusted_elev_diffs_{beam}.npy'), fitted_data)
+        pd.DataFrame([{'Label': beam, 'n': int(accepted.sum()), 'bias': bias, 'minRMSE': min_rmse,
+                       'init_x': init_x, 'init_y': init_y, 'adjusted_x': x0, 'adjusted_y': y0}]).to_csv(
+            os.path.join(figure_dir, f'results_{beam}.csv'), index=False)
+    _, results['plot_contours'] = measure(
+        lambda: plot_bullseye.plot_contours(beams, os.path.join(figure_dir, 'abs_adjusted_elev_diffs_beamname.npy'),
+                                            os.path.join(figure_dir, 'results_beamname.csv'), work_dir),
+        1, 'figures', memory)
+
+    error = float(np.hypot(x0 - truth['offset_x'], y0 - truth['offset_y'])) if x0 is not None else None
+    recovery = {'injected': [truth['offset_x'], truth['offset_y']],
+                'fitted': [float(x0), float(y0)] if x0 is not None else None,
+                'error_m': error, 'tolerance_m': tolerance, 'passed': error is not None and error <= tolerance,
+                'accepted_footprints': int(accepted.sum()), 'footprints': len(lats),
+                'estimator_errors_m': estimator_errors}
+    return {'benchmarks': results, 'offset_recovery': recovery}
+
+
+def print_report(report):
+    print(f"{'scale':>7} {'benchmark':<26} {'items':>7} {'seconds':>9} {'throughput':>22} {'peak MB':>9}")
+    for scale, result in report['scales'].items():
+        for name, entry in result['benchmarks'].items():
+            peak = f"{entry['peak_memory_mb']:9.1f}" if entry['peak_memory_mb'] is not None else f"{'-':>9}"
+            print(f"{scale:>7} {name:<26} {entry['items']:>7} {entry['seconds']:>9.3f} "
+                  f"{entry['throughput']:>9.1f} {entry['unit'] + '/s':<12} {peak}")
+        recovery = result['offset_recovery']
+        print(f"{scale:>7} offset injected {recovery['injected']}, fitted {recovery['fitted']}, "
+              f"error {recovery['error_m']} m: {'PASS' if recovery['passed'] else 'FAIL'}")
+    print(f"Process peak RSS: {report['peak_rss_mb']} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000], help='footprints per beam')
+    parser.add_argument('--offset', type=float, nargs=2, default=[4.0, -3.0], metavar=('X', 'Y'),
+                        help='injected geolocation offset (m) in the sample-window frame')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed offset recovery error (m)')
+    parser.add_argument('--max-window-footprints', type=int,
+                        help='cap on the footprints of the part 2 window benchmarks')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc runs')
+    parser.add_argument('--work-dir', help='keep the synthetic data here instead of a temporary directory')
+    parser.add_argument('--output', default='benchmark_report.json')
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='gedi_benchmarks_')
+    report = {'time': datetime.now().isoformat(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'platform': platform.platform(), 'scales': {}}
+    try:
+        for scale in args.scales:
+            print(f"Benchmarking {scale} footprints per beam")
+            report['scales'][scale] = run_scale(work_dir, scale, args.offset, not args.no_memory,
+                                                args.max_window_footprints, args.tolerance)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report['peak_rss_mb'] = _process_peak_rss_mb()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+    print(f"Report written to {args.output}")
+    return 0 if all(result['offset_recovery']['passed'] for result in report['scales'].values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
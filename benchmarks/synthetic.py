@@ -0,0 +1,161 @@
+"""Synthetic stand-ins for a GEDI L2A granule, a 3DEP 1 m DEM and the GEOID12B grid
+
+The terrain is a sum of plane waves, so the surface GEDI sees (the DEM smoothed by the sigma=5.5 m
+Gaussian of part 2) is known in closed form. Footprint elevations are that surface at the true
+position, i.e. the reported position moved by a known (x, y) offset in the rotated sample-window frame
+of part 2, plus the geoid height at the reported position. The fit of part 3 should recover the offset.
+"""
+import os
+import json
+import numpy as np
+import h5py
+import pyproj
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from GEDI_elev_correction import Load_GEDI_L2A_files, Calculating_elev_diffs, offset_grid, smoothing
+
+BEAMS = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
+GRANULE = 'GEDI02_A_2023011070157_O23114_03_T11296_02_003_02_V002'
+DEM_CRS = 'EPSG:32613'
+# Top-left corner of the DEM (UTM 13N), near 38.8N 105W
+DEM_ORIGIN = (500000.0, 4300000.0)
+# Footprints stay this far (m) from the DEM edge, so their 91x91 windows plus the offset fit inside
+MARGIN = 120.0
+ALONG_TRACK_SPACING = 60.0
+
+
+class SyntheticTerrain:
+    """Sum of plane waves over local DEM coordinates (u east, v south of DEM_ORIGIN, in metres)
+
+    Many short waves in random directions decorrelate within a few tens of metres, so the mean |elev_diff|
+    grid of part 2 is a round bullseye whose centre is the injected offset.
+    """
+
+    def __init__(self, seed=0, n_waves=64, base=1500.0, min_wavelength=25.0, max_wavelength=50.0,
+                 slope=0.1):
+        rng = np.random.default_rng(seed)
+        self.base = base
+        self.wavelengths = rng.uniform(min_wavelength, max_wavelength, n_waves)
+        # amplitude proportional to wavelength: every wave has the same maximum slope
+        self.amplitudes = slope * self.wavelengths / (2 * np.pi)
+        directions = rng.uniform(0, np.pi, n_waves)
+        self.ku = 2 * np.pi / self.wavelengths * np.cos(directions)
+        self.kv = 2 * np.pi / self.wavelengths * np.sin(directions)
+        self.phases = rng.uniform(0, 2 * np.pi, n_waves)
+
+    def elevation(self, u, v, sigma=0.0):
+        """Terrain at (u, v); sigma > 0 gives the surface smoothed by a Gaussian of sigma metres"""
+        u = np.asarray(u, dtype=float)
+        v = np.asarray(v, dtype=float)
+        z = np.full(np.broadcast(u, v).shape, self.base)
+        for amplitude, wavelength, ku, kv, phase in zip(self.amplitudes, self.wavelengths, self.ku, self.kv,
+                                                        self.phases):
+            damping = np.exp(-0.5 * (2 * np.pi / wavelength * sigma) ** 2)
+            z += amplitude * damping * np.sin(ku * u + kv * v + phase)
+        return z
+
+
+def _to_local(lats, lons):
+    x, y = pyproj.Transformer.from_crs('EPSG:4326', DEM_CRS, always_xy=True).transform(lons, lats)
+    return np.asarray(x) - DEM_ORIGIN[0], DEM_ORIGIN[1] - np.asarray(y)
+
+
+def _to_wgs84(u, v):
+    lons, lats = pyproj.Transformer.from_crs(DEM_CRS, 'EPSG:4326', always_xy=True).transform(
+        DEM_ORIGIN[0] + np.asarray(u), DEM_ORIGIN[1] - np.asarray(v))
+    return np.asarray(lats), np.asarray(lons)
+
+
+def write_dem(path, terrain, size=3000, block_rows=256):
+    """size x size m GeoTIFF at 1 m, written in blocks of rows"""
+    profile = dict(driver='GTiff', height=size, width=size, count=1, dtype='float32', crs=DEM_CRS,
+                   transform=from_origin(DEM_ORIGIN[0], DEM_ORIGIN[1], 1, 1), nodata=-9999, tiled=True,
+                   blockxsize=256, blockysize=256)
+    u = np.arange(size) + 0.5
+    with rasterio.open(path, 'w', **profile) as dst:
+        for start in range(0, size, block_rows):
+            v = np.arange(start, min(start + block_rows, size)) + 0.5
+            block = terrain.elevation(u[np.newaxis, :], v[:, np.newaxis]).astype(np.float32)
+            dst.write(block, 1, window=Window(0, start, size, block.shape[0]))
+    return path
+
+
+def write_geoid(path, resolution=0.05):
+    """GEOID12B-like grid (longitudes 0-360) around the DEM, smooth and around -20 m"""
+    west, north = 252.0, 41.0
+    n_rows, n_cols = int(round(4 / resolution)), int(round(6 / resolution))
+    rows, cols = np.mgrid[0:n_rows, 0:n_cols]
+    heights = (-20.0 + 1.5 * np.sin(rows / 17.0) + 1.0 * np.cos(cols / 23.0)).astype(np.float32)
+    with rasterio.open(path, 'w', driver='GTiff', height=n_rows, width=n_cols, count=1, dtype='float32',
+                       crs='EPSG:4326', transform=from_origin(west, north, resolution, resolution)) as dst:
+        dst.write(heights, 1)
+    return path
+
+
+def _track(n_footprints, beam_index, dem_size, heading):
+    """Reported (u, v) of a beam: parallel track segments across the DEM, ALONG_TRACK_SPACING apart"""
+    usable = dem_size - 2 * MARGIN
+    length = usable / (np.abs(np.cos(heading)) + np.abs(np.sin(heading))) * 0.9
+    per_segment = max(1, int(length // ALONG_TRACK_SPACING))
+    k = np.arange(n_footprints)
+    segment = k // per_segment + beam_index * 1000
+    along = (k % per_segment) * ALONG_TRACK_SPACING
+    cross_range = usable - length * np.abs(np.sin(heading))
+    cross = (segment * 37.0) % max(cross_range, 1.0)
+    u = MARGIN + along * np.cos(heading)
+    v = MARGIN + cross + along * np.sin(heading)
+    return u, v
+
+
+def write_granule(path, terrain, geoid_file, n_footprints, offset=(4.0, -3.0), beams=BEAMS, dem_size=3000,
+                  heading=0.35, noise=0.3, invalid_fraction=0.05, seed=0):
+    """GEDI L2A-shaped HDF5 file with n_footprints shots per beam and a known geolocation offset
+
+    Each beam group holds lat_lowestmode, lon_lowestmode, elev_lowestmode and surface_flag. Returns the
+    truth: the injected offset (m, in the x/y frame of the part 2 sample window) and the footprint count.
+    """
+    rng = np.random.default_rng(seed)
+    with h5py.File(path, 'w') as file:
+        for beam_index, beam in enumerate(beams):
+            u, v = _track(n_footprints, beam_index, dem_size, heading)
+            lats, lons = _to_wgs84(u, v)
+            group = file.create_group(beam)
+            group.create_dataset('lat_lowestmode', data=lats)
+            group.create_dataset('lon_lowestmode', data=lons)
+            group.create_dataset('surface_flag', data=(rng.random(n_footprints) >= invalid_fraction).astype(np.uint8))
+            group.create_dataset('elev_lowestmode', data=np.full(n_footprints, -9999.0, dtype=np.float32))
+
+    # Elevations use the track directions part 1 derives from the reported positions
+    geoid_data, transform, geoid_crs = Calculating_elev_diffs.load_geoid(geoid_file)
+    centers = Load_GEDI_L2A_files.get_center_data(path, beams)
+    with h5py.File(path, 'r+') as file:
+        for beam in beams:
+            lats, lons, _, _, tans = centers[beam].T
+            true_lats, true_lons = offset_grid.get_offset_points(lats, lons, tans, np.float64(offset[0]),
+                                                                 np.float64(offset[1]))
+            surface = terrain.elevation(*_to_local(true_lats, true_lons), sigma=smoothing.SIGMA)
+            geoid_heights, _ = Calculating_elev_diffs.get_geoid_heights(lats, lons, geoid_data, transform, geoid_crs)
+            elev = file[f'/{beam}/elev_lowestmode'][()]
+            elev[file[f'/{beam}/surface_flag'][()] == 1] = surface + geoid_heights + rng.normal(0, noise, len(lats))
+            file[f'/{beam}/elev_lowestmode'][...] = elev
+    return {'offset_x': float(offset[0]), 'offset_y': float(offset[1]), 'n_footprints': n_footprints,
+            'beams': list(beams)}
+
+
+def make_dataset(directory, n_footprints, offset=(4.0, -3.0), dem_size=3000, seed=0):
+    """DEM, geoid and one granule in directory (the DEM and geoid are reused when present)"""
+    os.makedirs(directory, exist_ok=True)
+    terrain = SyntheticTerrain(seed)
+    dem_path = os.path.join(directory, f'dem_{dem_size}m_seed{seed}.tif')
+    geoid_path = os.path.join(directory, 'geoid.tif')
+    if not os.path.exists(dem_path):
+        write_dem(dem_path, terrain, dem_size)
+    if not os.path.exists(geoid_path):
+        write_geoid(geoid_path)
+    granule_path = os.path.join(directory, f'{GRANULE}_{n_footprints}.h5')
+    truth = write_granule(granule_path, terrain, geoid_path, n_footprints, offset, dem_size=dem_size, seed=seed)
+    truth.update(dem=dem_path, geoid=geoid_path, granule=granule_path)
+    with open(os.path.splitext(granule_path)[0] + '_truth.json', 'w') as f:
+        json.dump(truth, f, indent=2)
+    return truth
@@ -1,7 +1,11 @@
 from GEDI_elev_correction import core
 
 if __name__ == '__main__':
-    core.run_part1()  # extracting GEDI data from raw ".h5" files
-    core.run_part2()  # matching GEDI data and 3DEP data
-    core.run_part3()  # proceed 2D Gaussian fit model
-    core.run_part4()  # plot figures
+    # Incremental run: only granules/beams whose inputs or parameters changed are reprocessed
+    core.run_pipeline()
+
+    # Full recomputation of every part:
+    # core.run_part1()  # extracting GEDI data from raw ".h5" files
+    # core.run_part2()  # matching GEDI data and 3DEP data
+    # core.run_part3()  # proceed 2D Gaussian fit model
+    # core.run_part4()  # plot figures